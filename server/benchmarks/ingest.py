@@ -0,0 +1,91 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Benchmark report ingestion of a running server.
+
+Posts unique reports to /report concurrently and prints throughput
+and latency percentiles:
+
+    python benchmarks/ingest.py http://localhost:8585 -n 5000 -c 32
+"""
+import argparse
+import concurrent.futures
+import json
+import secrets
+import statistics
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+
+def report(chalks: int) -> dict:
+    now = datetime.now(timezone.utc)
+    return {
+        "_OPERATION": "build",
+        "_TIMESTAMP": int(now.timestamp() * 1000),
+        "_DATETIME": now.isoformat(),
+        "_CHALKS": [
+            {
+                "CHALK_ID": secrets.token_hex(8),
+                "METADATA_ID": secrets.token_hex(8),
+                "METADATA_HASH": secrets.token_hex(32),
+                "HASH": secrets.token_hex(32),
+            }
+            for _ in range(chalks)
+        ],
+    }
+
+
+def post(url: str, chalks: int) -> tuple[float, int]:
+    data = json.dumps([report(chalks)]).encode()
+    request = urllib.request.Request(
+        f"{url}/report",
+        data=data,
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - started, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("url", nargs="?", default="http://localhost:8585")
+    parser.add_argument("-n", "--reports", type=int, default=5000)
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("--chalks", type=int, default=1, help="chalks per report")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(
+            pool.map(lambda _: post(args.url, args.chalks), range(args.reports))
+        )
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(i for i, _ in results)
+    statuses: dict[int, int] = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"reports:    {args.reports} ({args.concurrency} concurrent)")
+    print(f"statuses:   {statuses}")
+    print(f"throughput: {args.reports / elapsed:.0f} reports/s")
+    print(
+        "latency:    "
+        f"p50 {quantiles[49] * 1000:.1f}ms "
+        f"p95 {quantiles[94] * 1000:.1f}ms "
+        f"p99 {quantiles[98] * 1000:.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,18 @@
 # (see https://crashoverride.com/docs/chalk)
 import argparse
 import logging
+import multiprocessing
 import sys
+import tempfile
+import time
 import typing
 from pathlib import Path
 
 import os
 import uvicorn
+from uvicorn.supervisors import Multiprocess
 
-from . import api
+from . import api, backup, columnar, counts, export, ingest, metrics, shards, writer
 from .__version__ import __version__
 from .api import title
 from .certs.selfsigned import generate_selfsigned_cert
@@ -79,6 +83,15 @@ group.add_argument(
     help="number of workers for the server",
     type=int,
 )
+server.add_argument(
+    "--single-writer",
+    help=(
+        "store reports from all workers in a single writer process "
+        "which commits concurrent reports together"
+    ),
+    action="store_true",
+    default=False,
+)
 certfile = server.add_argument(
     "--certfile",
     help="path to TLS cert",
@@ -145,6 +158,119 @@ cert.add_argument(
 )
 
 
+reindex = subparsers.add_parser(
+    "reindex",
+    description=(
+        "Rebuild lookup tables derived from stored chalks and reports. "
+        "Useful for data stored before those tables were added."
+    ),
+    help="Rebuild derived lookup tables",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+reindex.set_defaults(command="reindex")
+
+reconcile = subparsers.add_parser(
+    "reconcile",
+    description=(
+        "Recount stored chalks and reports and fix counters "
+        "used by /counts and /facets if they drifted."
+    ),
+    help="Recount /counts and /facets counters",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+reconcile.set_defaults(command="reconcile")
+
+exporter = subparsers.add_parser(
+    "export",
+    description=(
+        "Export stored chalks or reports as Parquet or Arrow IPC stream. "
+        "Common keys are columns and other keys are JSON in extra column. "
+        "Requires chalk-server[export]."
+    ),
+    help="Export chalks or reports to Parquet/Arrow",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+exporter.add_argument(
+    "table",
+    choices=["reports", "chalks"],
+    help="what to export",
+)
+exporter.add_argument(
+    "-o",
+    "--output",
+    help="path where to save export",
+    type=lambda p: Path(p).absolute(),
+    required=True,
+)
+exporter.add_argument(
+    "--format",
+    help="output format",
+    choices=list(export.FORMATS),
+    default="parquet",
+)
+exporter.add_argument(
+    "--after",
+    help="only export reports with id > after and their chalks",
+    type=int,
+    default=0,
+)
+exporter.add_argument(
+    "--batch-size",
+    help="rows read and written at a time",
+    type=int,
+    default=export.BATCH_SIZE,
+)
+exporter.set_defaults(command="export")
+
+backup_command = subparsers.add_parser(
+    "backup",
+    description=(
+        "Back up SQLite database while the server keeps running "
+        "using SQLite online backup API. "
+        "With --wal, ship WAL frames committed since previous run to "
+        "target directory for incremental backups. "
+        "That requires SQLITE_JOURNAL_MODE=wal."
+    ),
+    help="Back up SQLite database",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+backup_command.add_argument(
+    "target",
+    help="file to save backup to or with --wal directory to ship WAL to",
+    type=lambda p: Path(p).absolute(),
+)
+backup_command.add_argument(
+    "--wal",
+    help="incremental backup by WAL shipping",
+    action="store_true",
+    default=False,
+)
+backup_command.add_argument(
+    "--interval",
+    help="with --wal, keep shipping WAL every interval seconds",
+    type=float,
+)
+backup_command.set_defaults(command="backup")
+
+restore_command = subparsers.add_parser(
+    "restore",
+    description="Restore SQLite database from WAL shipped by backup --wal",
+    help="Restore SQLite database from shipped WAL",
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+)
+restore_command.add_argument(
+    "source",
+    help="directory WAL was shipped to",
+    type=lambda p: Path(p).absolute(),
+)
+restore_command.add_argument(
+    "target",
+    help="path where to save restored database",
+    type=lambda p: Path(p).absolute(),
+)
+restore_command.set_defaults(command="restore")
+
+
 def run_server(
     host: str,
     port: int,
@@ -152,13 +278,23 @@ def run_server(
     workers: typing.Optional[int],
     keyfile: typing.Optional[Path],
     certfile: typing.Optional[Path],
+    single_writer: bool = False,
 ):
     app = f"{api.__name__}:app"
     workers = workers or os.cpu_count()
     if reload:
         workers = None
-    uvicorn.run(
-        app,
+    if (workers and workers > 1) or single_writer:
+        # workers and the writer process need to share metrics
+        # for /metrics to aggregate them
+        metrics.prepare_multiprocess(
+            os.environ.get(metrics.MULTIPROC_DIR)
+            or tempfile.mkdtemp(prefix="chalkserver-metrics-")
+        )
+    process = None
+    if single_writer:
+        process = start_writer()
+    options: dict[str, typing.Any] = dict(
         port=port,
         host=host,
         workers=workers,
@@ -166,6 +302,45 @@ def run_server(
         ssl_keyfile=keyfile,
         ssl_certfile=certfile,
     )
+    try:
+        if single_writer and workers == 1:
+            # metrics of this process were created before they were shared
+            # so the worker runs in its own process the same as with -k N
+            config = uvicorn.Config(app, **options)
+            Multiprocess(
+                config,
+                target=uvicorn.Server(config).run,
+                sockets=[config.bind_socket()],
+            ).run()
+        else:
+            uvicorn.run(app, **options)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+
+def start_writer() -> multiprocessing.Process:
+    """
+    start writer process and point workers to its socket
+    """
+    path = Path(
+        os.environ.get("WRITER_SOCKET")
+        or Path(tempfile.mkdtemp(prefix="chalkserver-writer-")) / "writer.sock"
+    ).absolute()
+    path.unlink(missing_ok=True)
+    # inherited by workers which import writer module after this
+    os.environ["WRITER_SOCKET"] = str(path)
+    process = multiprocessing.get_context("spawn").Process(
+        target=writer.serve, args=(path,), name="chalkserver-writer"
+    )
+    process.start()
+    deadline = time.time() + 30
+    while not path.exists():
+        if not process.is_alive() or time.time() > deadline:
+            raise RuntimeError("Writer process did not start")
+        time.sleep(0.05)
+    return process
 
 
 def generate_cert(
@@ -191,11 +366,101 @@ def main():
         print(__version__)
         return 0
 
+    if getattr(args, "command", None) == "reindex":
+        if shards.DATABASE_SHARDS:
+            for i, shard in enumerate(shards.shards):
+                with shard() as db:
+                    ingest.reindex(db, append=i > 0)
+                shards.locate_all(i)
+        else:
+            with api.SessionLocal() as db:
+                ingest.reindex(db)
+        logger.info("Reindexed stored chalks and reports")
+        return 0
+
+    if getattr(args, "command", None) == "reconcile":
+        if not counts.COUNTS:
+            logger.error(counts.DISABLED)
+            return 1
+        with api.SessionLocal() as db:
+            fixed = shards.reconcile(db)
+        for name, i in fixed.items():
+            logger.info("Fixed %s count %s -> %s", name, i["stored"], i["actual"])
+        logger.info("Reconciled counters")
+        return 0
+
+    if getattr(args, "command", None) == "export":
+        if not columnar.available():
+            logger.error(columnar.MISSING)
+            return 1
+        if shards.DATABASE_SHARDS:
+            logger.error("%s. export each shard with DATABASE_URL", shards.UNSUPPORTED)
+            return 1
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        tmp = args.output.with_name(f".{args.output.name}.tmp")
+        with api.SessionLocal() as db, tmp.open("wb") as f:
+            until = export.snapshot(db)
+            for chunk in export.export(
+                db, args.table, args.format, args.after, until, args.batch_size
+            ):
+                f.write(chunk)
+        tmp.replace(args.output)
+        logger.info(
+            "Exported %s until report id %s to %s", args.table, until, args.output
+        )
+        return 0
+
+    if getattr(args, "command", None) == "backup":
+        logged = 0.0
+
+        def log_progress(progress: backup.Progress):
+            nonlocal logged
+            if time.time() - logged < 1:
+                return
+            logged = time.time()
+            report = progress.report()
+            logger.info(
+                "Copied %s/%s pages (%s%%) at %.1f MiB/s",
+                report["copied"],
+                report["pages"],
+                report["percent"],
+                report["bytes_per_s"] / 2**20,
+            )
+
+        while True:
+            progress = backup.Progress(target=str(args.target), callback=log_progress)
+            if args.wal:
+                backup.ship(args.target, progress)
+            else:
+                backup.backup(args.target, progress)
+            report = progress.report()
+            logger.info(
+                "Backed up to %s in %ss at %.1f MiB/s "
+                "(%s pages, %s bytes of WAL, %s restarts)",
+                args.target,
+                report["elapsed_s"],
+                report["bytes_per_s"] / 2**20,
+                report["copied"],
+                report["shipped_bytes"],
+                report["restarts"],
+            )
+            if not (args.wal and args.interval):
+                return 0
+            time.sleep(args.interval)
+
+    if getattr(args, "command", None) == "restore":
+        backup.restore(args.source, args.target)
+        logger.info("Restored %s to %s", args.source, args.target)
+        return 0
+
     # not running any command
     if not getattr(args, "port", None) and not getattr(args, "domains", None):
         parser.print_help(sys.stderr)
         return 1
 
+    if getattr(args, "single_writer", False) and shards.DATABASE_SHARDS:
+        parser.error("--single-writer cannot be used with DATABASE_SHARDS")
+
     certfile_exists = args.certfile and args.certfile.is_file()
     keyfile_exists = args.keyfile and args.keyfile.is_file()
 
@@ -251,6 +516,7 @@ def main():
         workers=args.workers,
         keyfile=args.keyfile,
         certfile=args.certfile,
+        single_writer=args.single_writer,
     )
 
     return 0
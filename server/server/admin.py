@@ -0,0 +1,97 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import dataclasses
+from typing import Literal
+
+import os
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import FileResponse
+
+from . import backup, counts, maintenance, profiling, shards
+from .db import timing
+from .db.database import SessionLocal
+
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+
+@router.get("/slow-queries")
+def slow_queries(
+    limit: int = 20,
+    order_by: Literal["total_ms", "max_ms", "count", "slow"] = "total_ms",
+):
+    # timings are per worker so include pid to tell responses apart
+    return {
+        "pid": os.getpid(),
+        "threshold_ms": timing.SLOW_QUERY_MS,
+        "queries": [dataclasses.asdict(i) for i in timing.top(limit, order_by)],
+    }
+
+
+@router.delete("/slow-queries")
+def reset_slow_queries():
+    timing.reset()
+    return {"pid": os.getpid()}
+
+
+@router.post("/counts/reconcile")
+def reconcile_counts():
+    """
+    recount stored reports and chalks and fix counters which drifted
+    """
+    if not counts.COUNTS:
+        raise HTTPException(status_code=501, detail=counts.DISABLED)
+    with SessionLocal() as db:
+        fixed = shards.reconcile(db)
+    return {"fixed": fixed}
+
+
+@router.get("/maintenance")
+def maintenance_status():
+    """
+    last run of each maintenance task and worker holding maintenance lease
+    """
+    with SessionLocal() as db:
+        return maintenance.status(db)
+
+
+if backup.BACKUP_DIR:
+
+    @router.post("/backup", status_code=status.HTTP_202_ACCEPTED)
+    def start_backup(wal: bool = False):
+        """
+        back up SQLite database to BACKUP_DIR in the background.
+        with wal, ship WAL frames since previous run to BACKUP_DIR/wal
+        """
+        progress = backup.job.start(wal)
+        if progress is None:
+            raise HTTPException(
+                status_code=409, detail="Backup is already running in this worker"
+            )
+        return {"pid": os.getpid(), **progress.report()}
+
+    @router.get("/backup")
+    def backup_progress():
+        """
+        progress and throughput of current or last backup of this worker
+        """
+        progress = backup.job.progress
+        if progress is None:
+            raise HTTPException(status_code=404)
+        return {"pid": os.getpid(), **progress.report()}
+
+
+if profiling.PROFILE_DIR:
+
+    @router.get("/profiles")
+    def list_profiles():
+        return profiling.list_profiles()
+
+    @router.get("/profiles/{name}", response_class=FileResponse)
+    def get_profile(name: str):
+        path = profiling.get_profile(name)
+        if path is None:
+            raise HTTPException(status_code=404)
+        return FileResponse(path, media_type="text/plain")
@@ -0,0 +1,240 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Append-only columnar mirror of reports and chalks for analytics.
+
+Enabled by ANALYTICS_DIR. Stored reports and chalks are flattened
+(see columnar.py) and buffered in memory by each worker, then written
+as Parquet files in rolling batches of up to ANALYTICS_BATCH rows or
+every ANALYTICS_FLUSH_INTERVAL seconds. /analytics/query runs read-only
+SQL with DuckDB over those files without touching the ingest database.
+
+Buffered rows are lost if a worker is killed. `reindex` rewrites the
+mirror from the database.
+
+Requires pyarrow and duckdb which are optional dependencies.
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+import os
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from . import columnar
+from .db import models
+
+try:
+    import duckdb
+    import pyarrow.parquet
+except ImportError:
+    duckdb = None
+
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_DIR = os.environ.get("ANALYTICS_DIR")
+ANALYTICS_BATCH = int(os.environ.get("ANALYTICS_BATCH") or 10000)
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get("ANALYTICS_FLUSH_INTERVAL") or 60)
+ANALYTICS_TIMEOUT = float(os.environ.get("ANALYTICS_TIMEOUT") or 30)
+ANALYTICS_MAX_ROWS = int(os.environ.get("ANALYTICS_MAX_ROWS") or 10000)
+
+if ANALYTICS_DIR and (duckdb is None or not columnar.available()):
+    raise ImportError(
+        "ANALYTICS_DIR requires pyarrow and duckdb. " "install chalk-server[analytics]"
+    )
+
+TABLES = list(columnar.HOT_KEYS)
+SUFFIX = ".parquet"
+
+Captured = dict[str, list[dict[str, Any]]]
+
+
+def directory(table: str) -> Path:
+    assert ANALYTICS_DIR
+    return Path(ANALYTICS_DIR).absolute() / table
+
+
+def write(table: str, rows: list[dict[str, Any]]):
+    """
+    write a new Parquet file. written to a temp file first
+    so that queries never read partial files
+    """
+    path = directory(table)
+    path.mkdir(parents=True, exist_ok=True)
+    name = f"{time.time_ns()}-{os.getpid()}{SUFFIX}"
+    tmp = path / f".{name}.tmp"
+    batch = columnar.record_batch(table, rows)
+    pyarrow.parquet.write_table(pyarrow.Table.from_batches([batch]), tmp)
+    tmp.replace(path / name)
+
+
+class Mirror:
+    def __init__(self):
+        self.rows: Captured = {i: [] for i in TABLES}
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+
+    def append(self, captured: Captured) -> bool:
+        """
+        returns whether buffer is full and should be flushed
+        """
+        with self.lock:
+            for table, rows in captured.items():
+                self.rows[table].extend(rows)
+            return any(len(i) >= ANALYTICS_BATCH for i in self.rows.values())
+
+    def flush(self):
+        with self.flushing:
+            with self.lock:
+                rows, self.rows = self.rows, {i: [] for i in TABLES}
+            for table, table_rows in rows.items():
+                for i in range(0, len(table_rows), ANALYTICS_BATCH):
+                    write(table, table_rows[i : i + ANALYTICS_BATCH])
+
+
+mirror = Mirror()
+
+
+def capture(
+    reports: list[models.Report],
+    chalks: list[models.Chalk],
+) -> Optional[Captured]:
+    """
+    flattened rows of stored reports and chalks.
+    must be called after flush so that report ids are assigned
+    """
+    if not ANALYTICS_DIR:
+        return None
+    return {
+        "reports": [
+            columnar.flatten_report(r.id, r.received_at, r.raw) for r in reports
+        ],
+        "chalks": [columnar.flatten_chalk(c.report.id, c.raw) for c in chalks],
+    }
+
+
+def append(captured: Optional[Captured]):
+    """
+    add rows of committed reports and chalks to the mirror
+    """
+    if captured is None:
+        return
+    if mirror.append(captured):
+        asyncio.get_running_loop().run_in_executor(None, flush)
+
+
+def flush():
+    try:
+        mirror.flush()
+    except Exception:
+        logger.exception("Could not write analytics mirror")
+
+
+def rebuild(db: Session, batch_size: int = 1000, append: bool = False):
+    """
+    rewrite the mirror from the database.
+    with append, rows are added to the mirror such as of each shard
+    """
+    for table in TABLES if not append else []:
+        path = directory(table)
+        if path.is_dir():
+            for i in path.glob(f"*{SUFFIX}"):
+                i.unlink()
+    reports = db.query(
+        models.Report.id, models.Report.received_at, models.Report.raw
+    ).order_by(models.Report.id)
+    chalks = db.query(models.Chalk.report_id, models.Chalk.raw).order_by(
+        models.Chalk.report_id
+    )
+    for table, query, flatten in (
+        ("reports", reports, columnar.flatten_report),
+        ("chalks", chalks, columnar.flatten_chalk),
+    ):
+        rows = []
+        for row in query.yield_per(batch_size):
+            rows.append(flatten(*row))
+            if len(rows) >= ANALYTICS_BATCH:
+                write(table, rows)
+                rows = []
+        if rows:
+            write(table, rows)
+
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+        await asyncio.to_thread(flush)
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    if not ANALYTICS_DIR:
+        yield
+        return
+    task = asyncio.create_task(flush_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+        flush()
+
+
+def connect():
+    """
+    in-memory DuckDB with a view per table over its Parquet files
+    which cannot access any other files
+    """
+    assert ANALYTICS_DIR and duckdb is not None
+    conn = duckdb.connect(":memory:")
+    for table in TABLES:
+        path = directory(table)
+        if any(path.glob(f"*{SUFFIX}")):
+            source = f"read_parquet('{path}/*{SUFFIX}', union_by_name=true)"
+            conn.execute(f"CREATE VIEW {table} AS SELECT * FROM {source}")
+        else:
+            conn.register(f"_{table}", columnar.schema(table).empty_table())
+            conn.execute(f"CREATE VIEW {table} AS SELECT * FROM _{table}")
+    root = Path(ANALYTICS_DIR).absolute()
+    conn.execute(f"SET allowed_directories=['{root}/']")
+    conn.execute("SET enable_external_access=false")
+    conn.execute("SET lock_configuration=true")
+    return conn
+
+
+def query(sql: str, max_rows: int) -> dict[str, Any]:
+    conn = connect()
+    try:
+        try:
+            statements = conn.extract_statements(sql)
+        except duckdb.Error as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+            raise HTTPException(
+                status_code=400, detail="Only a single SELECT query is allowed"
+            )
+        timer = threading.Timer(ANALYTICS_TIMEOUT, conn.interrupt)
+        timer.start()
+        try:
+            cursor = conn.execute(sql)
+            rows = cursor.fetchmany(max_rows + 1)
+        except duckdb.InterruptException:
+            raise HTTPException(status_code=408, detail="Query timed out")
+        except duckdb.Error as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        finally:
+            timer.cancel()
+        return {
+            "columns": [i[0] for i in cursor.description],
+            "rows": [list(i) for i in rows[:max_rows]],
+            "truncated": len(rows) > max_rows,
+        }
+    finally:
+        conn.close()
@@ -3,23 +3,58 @@
 # This file is part of Chalk
 # (see https://crashoverride.com/docs/chalk)
 import asyncio
+import contextlib
 import dataclasses
 import logging.config
 import pathlib
 import secrets
 import shutil
 import tempfile
-from typing import Any, Optional
+from typing import Any, Literal, Optional
 
 import os
 import sqlalchemy
-from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
-from fastapi.responses import PlainTextResponse, RedirectResponse
+from fastapi import (
+    Depends,
+    FastAPI,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    status,
+)
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.orm import Session
 
+from . import (
+    admin,
+    analytics,
+    cache,
+    changes,
+    columnar,
+    counts,
+    export,
+    ingest,
+    inventory,
+    lag,
+    lineage,
+    live,
+    lookup,
+    maintenance,
+    metrics,
+    passthrough,
+    profiling,
+    search,
+    shards,
+    stats,
+    writer,
+)
 from .__version__ import __version__
 from .db import models, schemas
-from .db.database import SessionLocal, engine
+from .db.database import SessionLocal, engine, migrate
+from .filters import ChalkFilters, InventoryFilters, ReportFilters
+from .projection import Fields
 from .log import config
 
 
@@ -29,7 +64,10 @@ logger = logging.getLogger(__name__)
 try:
     # sqlite does not have DDL locks therefore when multiple workers
     # start at the same time, some of them can fail creating tables
-    models.Base.metadata.create_all(bind=engine)
+    for i in (engine, *shards.engines):
+        migrate(i)
+        if search.SEARCH_FIELDS:
+            search.create(i)
 except Exception as error:
     logger.error(error)
 
@@ -37,10 +75,28 @@ except Exception as error:
 title = "Local Chalk Ingestion Server"
 
 
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with (
+        metrics.lifespan(),
+        live.lifespan(),
+        stats.lifespan(),
+        analytics.lifespan(),
+        maintenance.lifespan(),
+    ):
+        yield
+
+
 app = FastAPI(
     title=title,
     version=__version__,
+    lifespan=lifespan,
 )
+app.add_middleware(metrics.MetricsMiddleware)
+if profiling.PROFILE_DIR:
+    app.add_middleware(profiling.ProfilingMiddleware)
+app.include_router(metrics.router)
+app.include_router(admin.router)
 
 
 @dataclasses.dataclass()
@@ -83,11 +139,13 @@ if os.environ.get("REDIRECT"):
 
 
 @app.post("/ping")
-async def ping(stats: list[schemas.Stat], db: Session = Depends(get_db)):
+async def ping(beacons: list[schemas.Stat], db: Session = Depends(get_db)):
     try:
-        model_stats = [models.Stat(**dict(s)) for s in stats]
-        db.add_all(model_stats)
-        db.commit()
+        stats.counters.add(beacons)
+        if stats.STATS_RAW:
+            model_stats = [models.Stat(**dict(s)) for s in beacons]
+            db.add_all(model_stats)
+            db.commit()
     except Exception as e:
         logger.exception(f"beacon {e}", exc_info=True)
     finally:
@@ -117,76 +175,522 @@ async def accept_report(
     response: Response,
     db: Session = Depends(get_db),
 ):
+    received_at = lag.now_ms()
+    metrics.reports_per_request.observe(len(reports))
+    if writer.WRITER_SOCKET and not shards.DATABASE_SHARDS:
+        status_code, detail = await writer.submit(reports, received_at)
+        if status_code >= 400:
+            raise HTTPException(status_code=status_code, detail=detail)
+        response.status_code = status_code
+        changes.notify()
+        return
     try:
-        for report in reports:
-            operation = report.get("_OPERATION")
-            if not isinstance(operation, str):
-                logger.error("Skipping report %s", str(report))
-                continue
-            operation = operation.lower()
-            # save any sent reports
-            db.add(models.Report(operation=operation, raw=report))
-            # if operation creates new chalkmark,
-            # save normalized chalkmark into db
-            if operation not in {"insert", "build"}:
-                continue
-            if "_CHALKS" not in report:
-                continue
-            for c in report["_CHALKS"]:
-                if "CHALK_ID" not in c:
-                    logger.error("Skipping chalk %s", str(c))
-                    continue
-                db.add(
-                    models.Chalk(
-                        chalk_id=c["CHALK_ID"],
-                        metadata_hash=c["METADATA_HASH"],
-                        metadata_id=c["METADATA_ID"],
-                        raw={
-                            **c,
-                            **{k: v for k, v in report.items() if k != "_CHALKS"},
-                        },
-                    )
+        if shards.DATABASE_SHARDS:
+            try:
+                # waits for every shard so it does not block the event loop
+                committed = await asyncio.to_thread(shards.store, reports, received_at)
+            except shards.PartiallyStored as e:
+                for stored in e.stored:
+                    ingest.committed(stored)
+                changes.notify()
+                logger.error("Reports partially stored: %s", e)
+                # so that clients only retry reports which were not stored
+                raise HTTPException(
+                    status_code=500,
+                    detail={"error": "Partially stored", "stored": e.reports},
                 )
-        try:
-            db.commit()
-        except (
-            sqlalchemy.exc.IntegrityError,
-            sqlalchemy.exc.PendingRollbackError,
-        ) as e:
-            logger.warning("Duplicate chalks %s", e)
-            response.status_code = status.HTTP_202_ACCEPTED
-            return
+            for stored in committed:
+                ingest.committed(stored)
+            changes.notify()
+        else:
+            stored = ingest.store(db, reports, received_at)
+            with metrics.db_commit_duration.time():
+                db.commit()
+            ingest.stamp(db, [stored])
+            ingest.committed(stored)
+            changes.notify()
+    except (
+        sqlalchemy.exc.IntegrityError,
+        sqlalchemy.exc.PendingRollbackError,
+    ) as e:
+        metrics.duplicates_total.inc()
+        metrics.rollbacks_total.labels(type(e).__name__).inc()
+        logger.warning("Duplicate chalks %s", e)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return
     except KeyError as e:
         raise HTTPException(status_code=400, detail=f"Chalk missing: {e}")
     except HTTPException:
         raise
-    except Exception:
+    except Exception as e:
+        metrics.rollbacks_total.labels(type(e).__name__).inc()
         logger.exception("report", exc_info=True)
         raise HTTPException(status_code=500, detail="Unhandled data")
 
 
-@app.get("/chalks")
-async def list_chalks(db: Session = Depends(get_db)) -> list[dict[str, Any]]:
-    chalks = db.query(models.Chalk).all()
-    return [c.raw for c in chalks]
+def dialect(db: Session) -> str:
+    return db.get_bind().dialect.name
+
+
+@app.get("/chalks", response_model=list[dict[str, Any]])
+async def list_chalks(
+    request: Request,
+    db: Session = Depends(get_db),
+    filters: ChalkFilters = Depends(),
+    fields: Fields = Depends(),
+    limit: Optional[int] = Query(None, ge=0),
+    offset: Optional[int] = Query(None, ge=0),
+):
+    """
+    returns NDJSON when requested with Accept: application/x-ndjson
+    """
+    chalks = shards.rows(
+        db,
+        lambda db: db.query(
+            models.Chalk.metadata_id,
+            *(
+                fields.columns(dialect(db), models.Chalk.raw)
+                if fields
+                else [passthrough.text(models.Chalk.raw)]
+            ),
+        ).filter(*filters.conditions(dialect(db))),
+        order_by=[models.Chalk.metadata_id],
+        key=lambda c: c[0],
+        limit=limit,
+        offset=offset,
+    )
+    if fields:
+        return [fields.row(c[1:]) for c in chalks]
+    return passthrough.response(request, (c for _, c in chalks))
+
+
+def load_chalks(
+    db: Session,
+    metadata_ids: list[str],
+    fields: Fields,
+) -> dict[str, dict[str, Any]]:
+    def load(db: Session, metadata_ids: list[str]) -> dict[str, dict[str, Any]]:
+        chalks = {}
+        columns = (
+            fields.columns(dialect(db), models.Chalk.raw)
+            if fields
+            else [models.Chalk.raw]
+        )
+        for chunk in lookup.chunks(metadata_ids):
+            rows = db.query(models.Chalk.metadata_id, *columns).filter(
+                models.Chalk.metadata_id.in_(chunk)
+            )
+            for metadata_id, *values in rows:
+                chalks[metadata_id] = fields.row(values) if fields else values[0]
+        return chalks
+
+    return {
+        k: v
+        for chalks in shards.by_metadata_id(db, metadata_ids, load)
+        for k, v in chalks.items()
+    }
 
 
-@app.get("/chalks/{metadata_id}")
-async def get_chalk(metadata_id: str, db: Session = Depends(get_db)) -> dict[str, Any]:
-    chalk = db.query(models.Chalk).get(metadata_id)
-    if chalk is None:
+@app.post("/chalks/batch")
+async def get_chalks_batch(
+    body: schemas.ChalkBatch,
+    db: Session = Depends(get_db),
+    fields: Fields = Depends(),
+) -> dict[str, Any]:
+    """
+    chalkmarks by metadata id for all requested METADATA_IDs and CHALK_IDs.
+    chalk_ids maps each found CHALK_ID to its metadata ids
+    """
+    chalk_ids = shards.find_chalk_ids(db, body.chalk_ids)
+    metadata_ids = {i for ids in chalk_ids.values() for i in ids}
+    chalks = load_chalks(db, sorted(metadata_ids | set(body.metadata_ids)), fields)
+    return {
+        "chalks": chalks,
+        "chalk_ids": chalk_ids,
+        "missing": {
+            "metadata_ids": [i for i in body.metadata_ids if i not in chalks],
+            "chalk_ids": [i for i in body.chalk_ids if i not in chalk_ids],
+        },
+    }
+
+
+@app.get("/chalks/{metadata_id}", response_model=dict[str, Any])
+async def get_chalk(
+    metadata_id: str,
+    request: Request,
+    db: Session = Depends(get_db),
+    fields: Fields = Depends(),
+):
+    """
+    full chalkmarks are served from cache with an ETag.
+    send If-None-Match to get 304 when the chalkmark is unchanged
+    """
+    if fields:
+        row = shards.point(
+            db,
+            metadata_id,
+            lambda db: db.query(*fields.columns(dialect(db), models.Chalk.raw))
+            .filter(models.Chalk.metadata_id == metadata_id)
+            .first(),
+        )
+        if row is None:
+            raise HTTPException(status_code=404)
+        return fields.row(row)
+    cached = cache.chalks.get(metadata_id)
+    if cached is None:
+        chalk = shards.point(
+            db,
+            metadata_id,
+            lambda db: db.query(passthrough.text(models.Chalk.raw))
+            .filter(models.Chalk.metadata_id == metadata_id)
+            .scalar(),
+        )
+        # missing chalkmarks are not cached as they can be reported later
+        if chalk is None:
+            raise HTTPException(status_code=404)
+        cached = cache.chalks.put(metadata_id, chalk.encode())
+    return cache.response(request, cached)
+
+
+@app.get("/lookup/hash/{digest}")
+async def lookup_hash(
+    digest: str,
+    db: Session = Depends(get_db),
+    fields: Fields = Depends(),
+) -> list[dict[str, Any]]:
+    """
+    chalkmarks which have the digest in any of their hash keys
+    such as HASH, _CURRENT_HASH, _IMAGE_ID or _REPO_DIGESTS
+    """
+    if not lookup.HASH_LOOKUP:
+        raise HTTPException(status_code=501, detail=lookup.DISABLED)
+    normalized = lookup.normalize(digest)
+    found = lookup.merge(shards.each(db, lambda db: lookup.find(db, [normalized])))
+    metadata_ids = found.get(normalized)
+    if not metadata_ids:
         raise HTTPException(status_code=404)
-    return chalk.raw
+    return list(load_chalks(db, metadata_ids, fields).values())
+
 
+@app.post("/lookup/hash")
+async def lookup_hashes(
+    body: schemas.HashLookup,
+    db: Session = Depends(get_db),
+    fields: Fields = Depends(),
+) -> dict[str, Any]:
+    """
+    batch lookup. returns metadata ids for each found digest,
+    chalkmarks by metadata id and list of digests which were not found
+    """
+    if not lookup.HASH_LOOKUP:
+        raise HTTPException(status_code=501, detail=lookup.DISABLED)
+    normalized = {d: lookup.normalize(d) for d in body.digests}
+    found = lookup.merge(
+        shards.each(db, lambda db: lookup.find(db, list(normalized.values())))
+    )
+    digests = {d: found[n] for d, n in normalized.items() if n in found}
+    metadata_ids = sorted({i for ids in digests.values() for i in ids})
+    return {
+        "digests": digests,
+        "chalks": load_chalks(db, metadata_ids, fields),
+        "missing": [d for d in body.digests if d not in digests],
+    }
 
-@app.get("/reports")
+
+@app.get("/reports", response_model=list[dict[str, Any]])
 async def list_reports(
-    db: Session = Depends(get_db), operation: Optional[str] = None
+    request: Request,
+    db: Session = Depends(get_db),
+    filters: ReportFilters = Depends(),
+    fields: Fields = Depends(),
+    limit: Optional[int] = Query(None, ge=0),
+    offset: Optional[int] = Query(None, ge=0),
+):
+    """
+    returns NDJSON when requested with Accept: application/x-ndjson
+    """
+    reports = shards.rows(
+        db,
+        lambda db: db.query(
+            models.Report.id,
+            *(
+                fields.columns(dialect(db), models.Report.raw)
+                if fields
+                else [passthrough.text(models.Report.raw)]
+            ),
+        ).filter(*filters.conditions(dialect(db))),
+        order_by=[models.Report.id],
+        key=lambda r: r[0],
+        limit=limit,
+        offset=offset,
+    )
+    if fields:
+        return [fields.row(r[1:]) for r in reports]
+    return passthrough.response(request, (r for _, r in reports))
+
+
+@app.get("/reports/live", response_class=StreamingResponse)
+async def stream_reports(
+    operation: Optional[str] = None,
+    chalk_id: Optional[str] = Query(None, description="any of _CHALKS"),
+    metadata_id: Optional[str] = Query(None, description="any of _CHALKS"),
+    hash: Optional[str] = Query(None, description="any of _CHALKS"),
+    artifact_type: Optional[str] = Query(None, description="any of _CHALKS"),
+):
+    """
+    Server-Sent Events stream of reports as they are stored.
+    slow clients are sent a dropped event and disconnected
+    """
+    chalks = {
+        "CHALK_ID": chalk_id,
+        "METADATA_ID": metadata_id,
+        "HASH": hash,
+        "ARTIFACT_TYPE": artifact_type,
+    }
+    subscriber = live.Subscriber(
+        operation, {k: v for k, v in chalks.items() if v is not None}
+    )
+    return StreamingResponse(
+        live.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/reports/lag")
+async def get_reports_lag(
+    db: Session = Depends(get_db),
+    operation: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+) -> dict[str, Any]:
+    """
+    cumulative histograms (ms) of delivery lag (_TIMESTAMP to received)
+    and ingest lag (received to committed) per operation.
+    since/until filter by received time in ms since epoch
+    """
+    return lag.merge(
+        shards.each(
+            db,
+            lambda db: lag.histogram(db, operation=operation, since=since, until=until),
+        )
+    )
+
+
+@app.get("/changes")
+async def list_changes(
+    db: Session = Depends(get_db),
+    since: int = Query(0, ge=0, description="seq of the last seen change"),
+    limit: int = Query(100, ge=1, le=1000),
+    wait: float = Query(0, ge=0, le=60, description="seconds to wait for changes"),
+) -> dict[str, Any]:
+    """
+    reports stored after since with chalkmarks they created, in order.
+    pass returned next as since to get following changes
+    """
+    if shards.DATABASE_SHARDS:
+        raise HTTPException(status_code=501, detail=shards.UNSUPPORTED)
+    return await changes.poll(db, since=since, limit=limit, wait=wait)
+
+
+@app.get("/counts")
+async def get_counts(db: Session = Depends(get_db)) -> dict[str, int]:
+    """
+    number of stored reports and chalks
+    """
+    if not counts.COUNTS:
+        raise HTTPException(status_code=501, detail=counts.DISABLED)
+    return counts.totals(counts.merge(shards.each(db, counts.stored)))
+
+
+@app.get("/facets")
+async def get_facets(
+    db: Session = Depends(get_db),
+) -> dict[str, dict[str, dict[str, int]]]:
+    """
+    number of reports per operation and platform and
+    chalks per artifact type and platform
+    """
+    if not counts.COUNTS:
+        raise HTTPException(status_code=501, detail=counts.DISABLED)
+    return counts.facets(counts.merge(shards.each(db, counts.stored)))
+
+
+@app.get("/search")
+async def search_documents(
+    q: str,
+    db: Session = Depends(get_db),
+    kind: Optional[Literal["report", "chalk"]] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+) -> list[dict[str, Any]]:
+    """
+    full-text search of reports and chalkmarks, best matches first.
+    all terms must match. trailing * matches a prefix
+    """
+    if not search.SEARCH_FIELDS:
+        raise HTTPException(status_code=501, detail=search.DISABLED)
+    if not shards.DATABASE_SHARDS:
+        return search_shard(db, q, kind, limit, offset)
+    # scores depend on statistics of each shard and are not comparable
+    # so best matches of each shard are interleaved by their position
+    found = shards.each(db, lambda db: search_shard(db, q, kind, offset + limit, 0))
+    merged = sorted(
+        (
+            (position, shard, i)
+            for shard, results in enumerate(found)
+            for position, i in enumerate(results)
+        ),
+        key=lambda i: i[:2],
+    )
+    return [i for _, _, i in merged[offset : offset + limit]]
+
+
+def search_shard(
+    db: Session,
+    q: str,
+    kind: Optional[str],
+    limit: int,
+    offset: int,
+) -> list[dict[str, Any]]:
+    found = search.find(db, q, kind=kind, limit=limit, offset=offset)
+    report_ids = [int(ref) for k, ref, _ in found if k == "report"]
+    metadata_ids = [ref for k, ref, _ in found if k == "chalk"]
+    documents = {
+        ("report", str(i)): raw
+        for chunk in lookup.chunks(report_ids)
+        for i, raw in db.query(models.Report.id, models.Report.raw).filter(
+            models.Report.id.in_(chunk)
+        )
+    }
+    for chunk in lookup.chunks(metadata_ids):
+        for metadata_id, raw in db.query(
+            models.Chalk.metadata_id, models.Chalk.raw
+        ).filter(models.Chalk.metadata_id.in_(chunk)):
+            documents[("chalk", metadata_id)] = raw
+    return [
+        {"kind": k, "id": ref, "rank": rank, "document": documents[(k, ref)]}
+        for k, ref, rank in found
+        if (k, ref) in documents
+    ]
+
+
+if analytics.ANALYTICS_DIR:
+
+    @app.post("/analytics/query")
+    async def analytics_query(body: schemas.AnalyticsQuery) -> dict[str, Any]:
+        """
+        read-only SQL over reports and chalks tables of the columnar mirror.
+        hot keys are columns and other keys are a JSON object in extra column
+        """
+        max_rows = min(
+            body.max_rows or analytics.ANALYTICS_MAX_ROWS,
+            analytics.ANALYTICS_MAX_ROWS,
+        )
+        return await asyncio.to_thread(analytics.query, body.sql, max_rows)
+
+
+@app.get("/export/{table}", response_class=StreamingResponse)
+async def export_table(
+    table: Literal["reports", "chalks"],
+    format: Literal["parquet", "arrow"] = "parquet",
+    after: int = Query(
+        0, ge=0, description="only reports with id > after and their chalks"
+    ),
+    batch_size: int = Query(export.BATCH_SIZE, ge=1, le=100000),
+):
+    """
+    stream reports or chalks as Parquet or Arrow IPC stream.
+    X-Chalk-Export-Until header is the latest exported report id
+    which can be passed as after to the next export
+    """
+    if not columnar.available():
+        raise HTTPException(status_code=501, detail=columnar.MISSING)
+    if shards.DATABASE_SHARDS:
+        raise HTTPException(status_code=501, detail=shards.UNSUPPORTED)
+    db = SessionLocal()
+    try:
+        until = export.snapshot(db)
+    except Exception:
+        db.close()
+        raise
+    filename = f"{table}{export.SUFFIXES[format]}"
+    return StreamingResponse(
+        export.export(db, table, format, after, until, batch_size),
+        media_type=export.FORMATS[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Chalk-Export-Until": str(until),
+        },
+        # runs after the response is streamed
+        background=BackgroundTask(db.close),
+    )
+
+
+@app.get("/inventory")
+async def list_inventory(
+    db: Session = Depends(get_db),
+    filters: InventoryFilters = Depends(),
+    limit: Optional[int] = Query(None, ge=0),
+    offset: Optional[int] = Query(None, ge=0),
 ) -> list[dict[str, Any]]:
-    reports = db.query(models.Report)
-    if operation:
-        reports = reports.filter_by(operation=operation.lower())
-    return [c.raw for c in reports.all()]
+    """
+    latest exec/heartbeat sighting of each CHALK_ID on each host,
+    most recently seen first
+    """
+    if not inventory.INVENTORY:
+        raise HTTPException(status_code=501, detail=inventory.DISABLED)
+    table = models.Inventory.__table__
+    rows = shards.rows(
+        db,
+        lambda db: db.query(table).filter(*filters.conditions()),
+        order_by=[
+            models.Inventory.last_seen.desc(),
+            models.Inventory.chalk_id,
+            models.Inventory.host,
+        ],
+        # same as order_by where NULL last_seen sorts last
+        key=lambda r: (r.last_seen is None, -(r.last_seen or 0), r.chalk_id, r.host),
+        limit=limit,
+        offset=offset,
+        ordered=True,
+    )
+    return [row._asdict() for row in rows]
+
+
+@app.get("/lineage/{value}")
+async def get_lineage(
+    value: str,
+    db: Session = Depends(get_db),
+    kind: Optional[str] = Query(
+        None,
+        description="; ".join(f"{v}: {k}" for k, v in lineage.NODE_KINDS.items()),
+    ),
+    depth: int = Query(5, ge=0, le=20),
+    max_nodes: int = Query(500, ge=1, le=10000),
+) -> dict[str, Any]:
+    """
+    graph of identifiers linked to the value, such as
+    commit -> chalk -> mark -> image -> container -> exec -> action.
+    value can be any of the identifiers, optionally restricted by kind
+    """
+    if not lineage.LINEAGE:
+        raise HTTPException(status_code=501, detail=lineage.DISABLED)
+    if kind is not None and kind not in lineage.NODE_KINDS.values():
+        raise HTTPException(status_code=400, detail=f"Unknown kind: {kind}")
+
+    def neighbours(nodes: list[str]) -> set[tuple[str, str]]:
+        return set().union(*shards.each(db, lambda db: lineage.neighbours(db, nodes)))
+
+    graph = lineage.traverse(
+        neighbours,
+        lineage.start_nodes(value, kind),
+        max_depth=depth,
+        max_nodes=max_nodes,
+    )
+    if graph is None:
+        raise HTTPException(status_code=404)
+    return graph
 
 
 @app.get("/stats")
@@ -195,6 +699,18 @@ async def list_stats(db: Session = Depends(get_db)) -> list[schemas.Stat]:
     return [schemas.Stat.model_validate(vars(c)) for c in chalk_stats]
 
 
+@app.get("/stats/summary")
+async def summarize_stats(
+    db: Session = Depends(get_db),
+    summary: stats.Summary = Depends(),
+) -> list[dict[str, Any]]:
+    """
+    number of pings (count) and sum of _OP_CHALK_COUNT (chalks)
+    grouped by requested columns and _TIMESTAMP bucket
+    """
+    return stats.summarize(db, summary)
+
+
 cosign = {}
 
 
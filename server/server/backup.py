@@ -0,0 +1,460 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Online backup of the SQLite database while the server keeps ingesting.
+
+backup() copies the database with the SQLite online backup API
+BACKUP_PAGES pages at a time and sleeps BACKUP_SLEEP seconds between
+steps so that writers are not starved. In WAL mode the whole copy reads
+from one read transaction which does not block writers, so the backup
+is a consistent snapshot as of when it started. In rollback journal mode
+a held read transaction would block writers, so locks are only held
+per step. SQLite then restarts the copy whenever another connection
+writes. After BACKUP_MAX_RESTARTS restarts, the rest is copied in a
+single step.
+
+ship() does incremental backups by WAL shipping. The first run takes
+a base backup and each run copies the WAL frames committed since the
+previous run as a new segment. The write lock is held to checkpoint
+the frames and to open a read transaction which pins them, as the WAL
+cannot restart while it is open, so they are copied after the lock is
+released. Frames committed meanwhile are shipped by another pass and
+once at most BACKUP_COPY_BYTES are left, they are copied while holding
+the write lock. The WAL then only restarts after all of its frames were
+shipped. That requires the server to not checkpoint on its own
+(SQLITE_WAL_AUTOCHECKPOINT=0). If the WAL was restarted by someone else
+in between anyway, frames could be missing so a new base backup
+(generation) is started.
+restore() rebuilds the database from the latest generation.
+"""
+import dataclasses
+import fcntl
+import json
+import logging
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import os
+
+from .db.database import engine
+
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.environ.get("BACKUP_DIR")
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES") or 256)
+BACKUP_SLEEP = float(os.environ.get("BACKUP_SLEEP") or 0.01)
+BACKUP_MAX_RESTARTS = int(os.environ.get("BACKUP_MAX_RESTARTS") or 3)
+# seconds writers wait for the lock held while WAL frames are checkpointed
+BACKUP_BUSY_TIMEOUT = float(os.environ.get("BACKUP_BUSY_TIMEOUT") or 30)
+BACKUP_COPY_BYTES = int(os.environ.get("BACKUP_COPY_BYTES") or 1024 * 1024)
+# passes over the WAL before the rest is shipped while holding the write lock
+SHIP_PASSES = 4
+
+WAL_HEADER = struct.Struct(">IIIIII")
+WAL_HEADER_SIZE = 32
+WAL_FRAME_HEADER_SIZE = 24
+BASE = "base.sqlite"
+STATE = "state.json"
+SUFFIX = ".wal"
+
+
+class Restarted(Exception):
+    pass
+
+
+@dataclasses.dataclass()
+class Progress:
+    target: str
+    started_at: float = dataclasses.field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    page_size: int = 0
+    pages: int = 0
+    copied: int = 0
+    restarts: int = 0
+    shipped_bytes: int = 0
+    error: Optional[str] = None
+    callback: Optional[Callable[["Progress"], None]] = dataclasses.field(
+        default=None, repr=False
+    )
+
+    def step(self, copied: int, pages: int):
+        self.copied = copied
+        self.pages = pages
+        if self.callback is not None:
+            self.callback(self)
+
+    def report(self) -> dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        copied_bytes = self.copied * self.page_size + self.shipped_bytes
+        return {
+            "target": self.target,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "pages": self.pages,
+            "copied": self.copied,
+            "percent": round(self.copied / self.pages * 100, 1) if self.pages else 0,
+            "restarts": self.restarts,
+            "shipped_bytes": self.shipped_bytes,
+            "elapsed_s": round(elapsed, 3),
+            "bytes_per_s": round(copied_bytes / elapsed) if elapsed else 0,
+            "error": self.error,
+        }
+
+
+def database() -> Path:
+    if engine.dialect.name != "sqlite" or engine.url.database in {None, "", ":memory:"}:
+        raise ValueError("Online backup is only supported for SQLite database files")
+    return Path(engine.url.database).absolute()  # type: ignore
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    # transactions are managed explicitly
+    return sqlite3.connect(path, isolation_level=None, timeout=BACKUP_BUSY_TIMEOUT)
+
+
+def journal_mode(conn: sqlite3.Connection) -> str:
+    return conn.execute("PRAGMA journal_mode").fetchone()[0].lower()
+
+
+def copy(
+    source: sqlite3.Connection,
+    target: Path,
+    progress: Progress,
+    pages: int = BACKUP_PAGES,
+    sleep: float = BACKUP_SLEEP,
+):
+    """
+    copy database of source connection to target file.
+    target only appears once the copy is complete
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    progress.page_size = source.execute("PRAGMA page_size").fetchone()[0]
+    dest = sqlite3.connect(tmp)
+    try:
+        for attempt in range(BACKUP_MAX_RESTARTS + 1):
+            copied = 0
+
+            def on_step(status: int, remaining: int, total: int):
+                nonlocal copied
+                if status == sqlite3.SQLITE_OK and 0 < total - remaining <= copied:
+                    # source was modified by another connection
+                    # so the step copied first pages again
+                    raise Restarted()
+                copied = total - remaining
+                progress.step(copied, total)
+                if remaining:
+                    time.sleep(sleep)
+
+            try:
+                source.backup(
+                    dest,
+                    pages=pages if attempt < BACKUP_MAX_RESTARTS else -1,
+                    progress=on_step,
+                )
+                break
+            except Restarted:
+                progress.restarts += 1
+    finally:
+        dest.close()
+    tmp.replace(target)
+
+
+def backup(
+    target: Path,
+    progress: Optional[Progress] = None,
+    pages: int = BACKUP_PAGES,
+    sleep: float = BACKUP_SLEEP,
+) -> Progress:
+    progress = progress or Progress(target=str(target))
+    source = connect(database())
+    try:
+        if journal_mode(source) == "wal":
+            # snapshot for the whole copy which does not block writers
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+        copy(source, target, progress, pages=pages, sleep=sleep)
+    finally:
+        source.close()
+    progress.finished_at = time.time()
+    return progress
+
+
+def wal_header(path: Path) -> Optional[tuple[int, int, int, int]]:
+    """
+    (page size, checkpoint sequence, salt 1, salt 2) of WAL file
+    """
+    try:
+        with path.open("rb") as f:
+            data = f.read(WAL_HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(data) < WAL_HEADER.size:
+        return None
+    _, _, page_size, sequence, salt1, salt2 = WAL_HEADER.unpack(data)
+    return page_size, sequence, salt1, salt2
+
+
+def read_state(directory: Path) -> Optional[dict[str, Any]]:
+    try:
+        return json.loads((directory / STATE).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def write_state(directory: Path, state: dict[str, Any]):
+    tmp = directory / f".{STATE}.tmp"
+    tmp.write_text(json.dumps(state))
+    tmp.replace(directory / STATE)
+
+
+def continues(state: dict[str, Any], sequence: int, salt: list[int]) -> bool:
+    """
+    whether current WAL has no frames missing since the last shipped segment
+    """
+    if salt == state["salt"]:
+        return True
+    if state["salt"] is None:
+        # there was no WAL at the base backup
+        return True
+    # WAL restarts after a full checkpoint which happened after shipping
+    return state["checkpointed"] and sequence == state["sequence"] + 1
+
+
+def base(path: Path, directory: Path, progress: Progress) -> tuple:
+    """
+    take base backup for a new generation.
+    returns its state and connection holding the snapshot it was taken from
+    """
+    generation = str(time.time_ns())
+    source = connect(path)
+    source.execute("BEGIN")
+    source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+    header = wal_header(path.with_name(f"{path.name}-wal"))
+    copy(source, directory / generation / BASE, progress)
+    state = {
+        "generation": generation,
+        "sequence": header[1] if header else None,
+        "salt": list(header[2:]) if header else None,
+        "offset": 0,
+        "segment": 0,
+        "checkpointed": True,
+    }
+    return state, source
+
+
+def copy_frames(wal: Path, target: Path, start: int, end: int):
+    """
+    copy WAL bytes from start to end, BACKUP_COPY_BYTES at a time
+    """
+    with wal.open("rb") as source, target.open("wb") as f:
+        source.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = source.read(min(remaining, BACKUP_COPY_BYTES))
+            if not data:
+                raise ValueError(f"WAL ended before offset {end}")
+            f.write(data)
+            remaining -= len(data)
+
+
+def ship_frames(
+    path: Path,
+    directory: Path,
+    state: Optional[dict[str, Any]],
+    progress: Progress,
+) -> bool:
+    """
+    returns False if frames are missing and a new generation is needed
+    """
+    wal = path.with_name(f"{path.name}-wal")
+    writer = connect(path)
+    reader = connect(path)
+    checkpointer = connect(path)
+    snapshot = None
+    try:
+        if journal_mode(writer) != "wal":
+            raise ValueError("WAL shipping requires SQLITE_JOURNAL_MODE=wal")
+        if state is None:
+            state, snapshot = base(path, directory, progress)
+        for attempt in range(SHIP_PASSES):
+            # no new frames can be committed while finding frames to ship
+            writer.execute("BEGIN IMMEDIATE")
+            if snapshot is not None:
+                snapshot.close()
+                snapshot = None
+            # WAL does not restart while a read transaction uses its frames
+            # so they can be copied after the write lock is released
+            reader.execute("BEGIN")
+            reader.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            busy, frames, checkpointed = checkpointer.execute(
+                "PRAGMA wal_checkpoint(PASSIVE)"
+            ).fetchone()
+            header = wal_header(wal)
+            end = state["offset"]
+            if header is not None and frames > 0:
+                page_size, sequence, *salt = header
+                if not continues(state, sequence, salt):
+                    return False
+                if salt != state["salt"]:
+                    state.update(sequence=sequence, salt=salt, offset=0)
+                end = WAL_HEADER_SIZE + frames * (WAL_FRAME_HEADER_SIZE + page_size)
+            # copied while holding the write lock when only a few frames
+            # are left so that the WAL can restart once they are shipped
+            final = (
+                end - state["offset"] <= BACKUP_COPY_BYTES or attempt == SHIP_PASSES - 1
+            )
+            if not final:
+                writer.rollback()
+            if end > state["offset"]:
+                name = (
+                    f"{state['segment'] + 1:08d}-{sequence:08d}-"
+                    f"{salt[0]:08x}{salt[1]:08x}-{state['offset']:012d}{SUFFIX}"
+                )
+                segment = directory / state["generation"] / name
+                tmp = segment.with_name(f".{name}.tmp")
+                copy_frames(wal, tmp, state["offset"], end)
+                tmp.replace(segment)
+                progress.shipped_bytes += end - state["offset"]
+                state["segment"] += 1
+                state["offset"] = end
+            state["checkpointed"] = busy == 0 and checkpointed == frames
+            write_state(directory, state)
+            reader.rollback()
+            if final:
+                return True
+            # frames committed while copying are shipped by the next pass
+        return True
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+        # releases write lock if still held
+        writer.close()
+        reader.close()
+        checkpointer.close()
+
+
+def ship(directory: Path, progress: Optional[Progress] = None) -> Progress:
+    """
+    ship WAL frames committed since previous run
+    or take a new base backup if needed
+    """
+    progress = progress or Progress(target=str(directory))
+    path = database()
+    directory.mkdir(parents=True, exist_ok=True)
+    with (directory / ".lock").open("w") as lock:
+        # one shipper at a time across workers and processes
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read_state(directory)
+        if state is not None and not (directory / state["generation"] / BASE).exists():
+            state = None
+        for _ in range(BACKUP_MAX_RESTARTS + 1):
+            if ship_frames(path, directory, state, progress):
+                break
+            logger.warning("WAL was restarted before it was shipped. Taking new base")
+            state = None
+        else:
+            raise RuntimeError(
+                "WAL keeps restarting before it is shipped. "
+                "Set SQLITE_WAL_AUTOCHECKPOINT=0 so only WAL shipping checkpoints"
+            )
+    progress.finished_at = time.time()
+    return progress
+
+
+def restore(directory: Path, target: Path):
+    """
+    rebuild database from base backup and WAL segments of latest generation
+    """
+    state = read_state(directory)
+    if state is None:
+        raise ValueError(f"No WAL shipping generation in {directory}")
+    generation = directory / state["generation"]
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp_wal = tmp.with_name(f"{tmp.name}-wal")
+    for i in (tmp, tmp_wal, tmp.with_name(f"{tmp.name}-shm")):
+        i.unlink(missing_ok=True)
+    shutil.copyfile(generation / BASE, tmp)
+    conn = sqlite3.connect(tmp)
+    try:
+        # otherwise WAL files are ignored
+        conn.execute("PRAGMA journal_mode=wal")
+    finally:
+        conn.close()
+    # segments of the same WAL are applied together
+    wals: dict[str, list[Path]] = {}
+    for segment in sorted(generation.glob(f"*{SUFFIX}")):
+        _, sequence, salt, _ = segment.stem.split("-")
+        wals.setdefault(f"{sequence}-{salt}", []).append(segment)
+    for segments in wals.values():
+        with tmp_wal.open("wb") as f:
+            for segment in segments:
+                f.write(segment.read_bytes())
+        conn = sqlite3.connect(tmp)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("PRAGMA journal_mode=delete")
+    finally:
+        conn.close()
+    tmp.replace(target)
+
+
+class Job:
+    """
+    backup running in background thread of this worker
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.progress: Optional[Progress] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, wal: bool) -> Optional[Progress]:
+        """
+        returns None if a backup is already running
+        """
+        assert BACKUP_DIR
+        directory = Path(BACKUP_DIR).absolute()
+        with self.lock:
+            if self.running():
+                return None
+            if wal:
+                target = directory / "wal"
+            else:
+                target = directory / f"chalkdb-{time.strftime('%Y%m%d%H%M%S')}.sqlite"
+            progress = self.progress = Progress(target=str(target))
+            self.thread = threading.Thread(
+                target=self.run, args=(progress, wal), daemon=True
+            )
+            self.thread.start()
+            return progress
+
+    def run(self, progress: Progress, wal: bool):
+        try:
+            if wal:
+                ship(Path(progress.target), progress)
+            else:
+                backup(Path(progress.target), progress)
+        except Exception as e:
+            logger.exception("Backup failed")
+            progress.error = str(e)
+            progress.finished_at = time.time()
+
+
+job = Job()
@@ -0,0 +1,178 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Cache of chalkmark response bodies.
+
+Chalkmarks are immutable once stored so cached entries never need to
+be invalidated. Each worker keeps a bounded in-process LRU.
+When CHALK_CACHE_DIR is set (ideally on tmpfs such as /dev/shm),
+entries are also shared across workers as files in that directory.
+"""
+import collections
+import dataclasses
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+
+import os
+from fastapi import Request, Response, status
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+CHALK_CACHE_MAX_BYTES = int(os.environ.get("CHALK_CACHE_MAX_BYTES") or 64 * 2**20)
+CHALK_CACHE_DIR = os.environ.get("CHALK_CACHE_DIR")
+CHALK_CACHE_DIR_MAX_BYTES = int(
+    os.environ.get("CHALK_CACHE_DIR_MAX_BYTES") or 512 * 2**20
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class Entry:
+    etag: str
+    body: bytes
+
+
+def entry(body: bytes) -> Entry:
+    return Entry(
+        etag=f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"', body=body
+    )
+
+
+class LRU:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: collections.OrderedDict[str, Entry] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Entry):
+        if len(value.body) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self.entries[key] = value
+            self.size += len(value.body)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+
+
+class SharedDir:
+    """
+    entries are files named by hash of the key.
+    files are written atomically so readers never see partial entries
+    """
+
+    # how often to check total size of the directory
+    CHECK_EVERY = 1000
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.writes = 0
+
+    def file(self, key: str) -> Path:
+        return self.path / hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Entry]:
+        try:
+            return entry(self.file(key).read_bytes())
+        except OSError:
+            return None
+
+    def put(self, key: str, value: Entry):
+        path = self.file(key)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_bytes(value.body)
+            tmp.replace(path)
+        except OSError as e:
+            logger.warning("Could not write shared cache entry %s", e)
+            return
+        self.writes += 1
+        if self.writes % self.CHECK_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        files = []
+        for i in os.scandir(self.path):
+            try:
+                stat = i.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, i.path))
+        size = sum(i[1] for i in files)
+        for _, file_size, path in sorted(files):
+            if size <= self.max_bytes:
+                break
+            Path(path).unlink(missing_ok=True)
+            size -= file_size
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int, shared: Optional[SharedDir] = None):
+        self.lru = LRU(max_bytes) if max_bytes > 0 else None
+        self.shared = shared
+
+    def get(self, key: str) -> Optional[Entry]:
+        if self.lru is not None:
+            value = self.lru.get(key)
+            if value is not None:
+                metrics.cache_requests_total.labels("hit").inc()
+                return value
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                metrics.cache_requests_total.labels("shared_hit").inc()
+                if self.lru is not None:
+                    self.lru.put(key, value)
+                return value
+        metrics.cache_requests_total.labels("miss").inc()
+        return None
+
+    def put(self, key: str, body: bytes) -> Entry:
+        value = entry(body)
+        if self.lru is not None:
+            self.lru.put(key, value)
+        if self.shared is not None:
+            self.shared.put(key, value)
+        return value
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # If-None-Match uses weak comparison
+    tags = {i.strip().removeprefix("W/") for i in header.split(",")}
+    return "*" in tags or etag in tags
+
+
+def response(request: Request, value: Entry) -> Response:
+    headers = {"ETag": value.etag}
+    if not_modified(request, value.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(value.body, media_type="application/json", headers=headers)
+
+
+chalks = ResponseCache(
+    CHALK_CACHE_MAX_BYTES,
+    SharedDir(CHALK_CACHE_DIR, CHALK_CACHE_DIR_MAX_BYTES) if CHALK_CACHE_DIR else None,
+)
@@ -0,0 +1,125 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Change feed for incremental sync.
+
+Report ids are the change sequence. Chalkmarks are sequenced by the
+report which created them (Chalk.report_id) so each change is a report
+together with any chalkmarks it created. Consumers pass the last seen
+sequence as `since` and can long-poll with `wait` to tail new changes.
+
+Report ids are allocated in commit order with SQLite as it has a single
+writer. AUTOINCREMENT keeps them from being reused after deletes. That
+only applies to databases created with it, as SQLite cannot change it
+for an existing table.
+PostgreSQL allocates ids before commit so a report with a smaller id
+can become visible after a larger one was already returned. There
+reports are ordered by the transaction which stored them and only
+reports of transactions older than any transaction still in progress
+are returned, so everything after the cursor commits after it.
+
+Reports committed by this worker wake up waiting requests right away.
+Reports committed by other workers are picked up by re-polling the
+database every CHANGES_POLL_INTERVAL seconds.
+"""
+import asyncio
+import time
+from typing import Any
+
+import os
+from sqlalchemy import BigInteger, ColumnElement, Text, cast, func, tuple_
+from sqlalchemy.orm import Session
+
+from . import lookup
+from .db import models
+
+
+CHANGES_POLL_INTERVAL = float(os.environ.get("CHANGES_POLL_INTERVAL") or 1)
+
+_committed = asyncio.Event()
+
+
+def notify():
+    """
+    wake up requests waiting for changes. called after reports are committed
+    """
+    global _committed
+    _committed.set()
+    _committed = asyncio.Event()
+
+
+async def committed(timeout: float):
+    try:
+        await asyncio.wait_for(_committed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+def txid() -> ColumnElement:
+    """
+    id of the current PostgreSQL transaction
+    """
+    return cast(cast(func.pg_current_xact_id(), Text), BigInteger)
+
+
+def load(db: Session, since: int, limit: int) -> list[dict[str, Any]]:
+    report = models.Report
+    query = db.query(report.id, report.raw)
+    if db.get_bind().dialect.name == "postgresql":
+        # reports stored before txid was added count as the oldest
+        stored_by = func.coalesce(report.txid, 0)
+        after = 0
+        if since:
+            after = db.query(stored_by).filter(report.id == since).scalar()
+            if after is None:
+                # such as deleted. resumes after everything up to since
+                after = (
+                    db.query(func.max(stored_by)).filter(report.id <= since).scalar()
+                    or 0
+                )
+        # every transaction older than xmin of the snapshot has finished
+        xmin = cast(
+            cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), Text), BigInteger
+        )
+        query = query.filter(
+            tuple_(stored_by, report.id) > tuple_(after, since), stored_by < xmin
+        ).order_by(stored_by, report.id)
+    else:
+        query = query.filter(report.id > since).order_by(report.id)
+    reports = query.limit(limit).all()
+    if not reports:
+        return []
+    chalks: dict[int, list[dict[str, Any]]] = {}
+    for chunk in lookup.chunks([i for i, _ in reports]):
+        rows = (
+            db.query(models.Chalk.report_id, models.Chalk.raw)
+            .filter(models.Chalk.report_id.in_(chunk))
+            .order_by(models.Chalk.report_id, models.Chalk.metadata_id)
+        )
+        for report_id, raw in rows:
+            chalks.setdefault(report_id, []).append(raw)
+    return [
+        {"seq": i, "report": raw, "chalks": chalks.get(i, [])} for i, raw in reports
+    ]
+
+
+async def poll(db: Session, since: int, limit: int, wait: float) -> dict[str, Any]:
+    """
+    changes after since. when there are none,
+    wait up to wait seconds for new changes to be committed
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        changes = load(db, since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            break
+        # dont hold connection/transaction open while waiting
+        db.rollback()
+        await committed(min(remaining, CHANGES_POLL_INTERVAL))
+    return {
+        "changes": changes,
+        "next": changes[-1]["seq"] if changes else since,
+    }
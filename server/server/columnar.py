@@ -0,0 +1,127 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Flattening of stored reports and chalks into Arrow tables.
+
+Hot keys become typed columns and all other keys are kept as a JSON
+object in the extra column. Values which do not match the column type
+are kept in extra as well so nothing is lost.
+
+Requires pyarrow which is an optional dependency.
+"""
+import json
+from typing import Any, Optional
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+MISSING = "pyarrow is not installed. install chalk-server[export]"
+
+# table -> hot key -> type
+HOT_KEYS: dict[str, dict[str, str]] = {
+    "reports": {
+        "_OPERATION": "string",
+        "_TIMESTAMP": "int",
+        "_OP_PLATFORM": "string",
+        "_OP_HOSTNAME": "string",
+        "_OP_CHALKER_VERSION": "string",
+        "_OP_CHALKER_COMMIT_ID": "string",
+        "_OP_CHALK_COUNT": "int",
+        "_CHALK_RUN_TIME": "int",
+        "_ACTION_ID": "string",
+        "_EXEC_ID": "string",
+        "_OP_ERRORS": "list",
+    },
+    "chalks": {
+        "CHALK_ID": "string",
+        "METADATA_ID": "string",
+        "ARTIFACT_TYPE": "string",
+        "HASH": "string",
+        "PATH_WHEN_CHALKED": "string",
+        "ORIGIN_URI": "string",
+        "BRANCH": "string",
+        "COMMIT_ID": "string",
+        "CHALK_VERSION": "string",
+        "_OPERATION": "string",
+        "_TIMESTAMP": "int",
+        "_OP_PLATFORM": "string",
+    },
+}
+# table -> columns from the database row rather than the document
+ROW_COLUMNS = {
+    "reports": ["id", "received_at"],
+    "chalks": ["report_id"],
+}
+EXTRA = "extra"
+
+
+def available() -> bool:
+    return pyarrow is not None
+
+
+def arrow_type(name: str):
+    assert pyarrow is not None, MISSING
+    return {
+        "string": pyarrow.string(),
+        "int": pyarrow.int64(),
+        "list": pyarrow.list_(pyarrow.string()),
+    }[name]
+
+
+def schema(table: str):
+    assert pyarrow is not None, MISSING
+    return pyarrow.schema(
+        [(i, pyarrow.int64()) for i in ROW_COLUMNS[table]]
+        + [(k, arrow_type(v)) for k, v in HOT_KEYS[table].items()]
+        + [(EXTRA, pyarrow.string())]
+    )
+
+
+def matches(value: Any, type: str) -> bool:
+    if type == "string":
+        return isinstance(value, str)
+    if type == "int":
+        # bool is an int subclass
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, list) and all(isinstance(i, str) for i in value)
+
+
+def flatten(table: str, row: dict[str, Any], raw: dict[str, Any]) -> dict[str, Any]:
+    """
+    row has ROW_COLUMNS values and raw is the stored document
+    """
+    hot = HOT_KEYS[table]
+    flat: dict[str, Any] = {i: row.get(i) for i in ROW_COLUMNS[table]}
+    extra = {}
+    for k, v in raw.items():
+        if k in hot and matches(v, hot[k]):
+            flat[k] = v
+        else:
+            extra[k] = v
+    flat[EXTRA] = json.dumps(extra) if extra else None
+    return flat
+
+
+def record_batch(table: str, rows: list[dict[str, Any]]):
+    """
+    Arrow record batch of flattened rows
+    """
+    assert pyarrow is not None, MISSING
+    return pyarrow.RecordBatch.from_pylist(rows, schema=schema(table))
+
+
+def flatten_report(
+    report_id: Optional[int],
+    received_at: Optional[int],
+    raw: dict[str, Any],
+) -> dict[str, Any]:
+    return flatten("reports", {"id": report_id, "received_at": received_at}, raw)
+
+
+def flatten_chalk(report_id: Optional[int], raw: dict[str, Any]) -> dict[str, Any]:
+    return flatten("chalks", {"report_id": report_id}, raw)
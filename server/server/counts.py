@@ -0,0 +1,157 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Row counts and facet counts maintained incrementally.
+
+Counters of stored reports and chalks are upserted in the same
+transaction as the reports so they are exactly as durable as the rows
+they count. Counts are read from a handful of rows instead of scanning
+whole tables. reconcile() recounts the tables and sets any counter
+which drifted such as for data stored before counters were added.
+"""
+import collections
+import logging
+from typing import Any, Iterable
+
+import os
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import lookup
+from .db import models
+from .db.database import upsert_insert
+
+
+logger = logging.getLogger(__name__)
+
+COUNTS = (os.environ.get("COUNTS") or "true").lower() in {"1", "true", "yes"}
+DISABLED = "Counts are disabled. Set COUNTS=true and run reconcile"
+
+
+TABLES = {
+    "reports": models.Report,
+    "chalks": models.Chalk,
+}
+# table -> facet -> column
+FACETS = {
+    "reports": {
+        "operation": models.Report.operation,
+        "platform": models.Report.platform,
+    },
+    "chalks": {
+        "artifact_type": models.Chalk.artifact_type,
+        "platform": models.Chalk.platform,
+    },
+}
+
+Counts = collections.Counter[tuple[str, str]]
+
+
+def deltas(
+    reports: list[models.Report],
+    chalks: list[models.Chalk],
+) -> Counts:
+    counts: Counts = collections.Counter()
+    for table, rows in (("reports", reports), ("chalks", chalks)):
+        if not rows:
+            continue
+        counts[(table, "")] += len(rows)
+        for facet, column in FACETS[table].items():
+            for row in rows:
+                value = getattr(row, column.key)
+                if value is not None:
+                    counts[(f"{table}.{facet}", str(value))] += 1
+    return counts
+
+
+def add(db: Session, counts: Counts, absolute: bool = False):
+    """
+    add counts to counters or set counters to them when absolute
+    """
+    if not counts:
+        return
+    table = models.Counter.__table__
+    rows = [
+        {"name": name, "value": value, "count": count}
+        for (name, value), count in sorted(counts.items())
+    ]
+    insert = upsert_insert(db.get_bind().dialect.name)
+    for chunk in lookup.chunks(rows, lookup.CHUNK_SIZE // 3):
+        statement = insert(table).values(chunk)
+        count = statement.excluded.count
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.name, table.c.value],
+            set_={"count": count if absolute else table.c.count + count},
+        )
+        db.execute(statement)
+
+
+def stored(db: Session) -> Counts:
+    return collections.Counter(
+        {(c.name, c.value): c.count for c in db.query(models.Counter)}
+    )
+
+
+def merge(results: Iterable[Counts]) -> Counts:
+    """
+    sum of counts such as of each shard
+    """
+    merged: Counts = collections.Counter()
+    for counts in results:
+        merged.update(counts)
+    return merged
+
+
+def actual(db: Session) -> Counts:
+    counts: Counts = collections.Counter()
+    for table, model in TABLES.items():
+        counts[(table, "")] = db.query(func.count()).select_from(model).scalar()
+        for facet, column in FACETS[table].items():
+            rows = (
+                db.query(column, func.count())
+                .filter(column.is_not(None))
+                .group_by(column)
+            )
+            for value, count in rows:
+                counts[(f"{table}.{facet}", str(value))] = count
+    return counts
+
+
+def totals(counts: Counts) -> dict[str, int]:
+    return {table: counts[(table, "")] for table in TABLES}
+
+
+def facets(counts: Counts) -> dict[str, dict[str, dict[str, int]]]:
+    result: dict[str, dict[str, dict[str, int]]] = {
+        table: {facet: {} for facet in facets} for table, facets in FACETS.items()
+    }
+    for (name, value), count in sorted(counts.items()):
+        table, _, facet = name.partition(".")
+        if facet in result.get(table, {}) and count:
+            result[table][facet][value] = count
+    return result
+
+
+def reconcile(db: Session) -> dict[str, Any]:
+    """
+    recount tables and set counters which drifted to their actual counts.
+    returns counters which were fixed. counters and tables are read in the
+    transaction which updates them, which with SQLite fails rather than
+    overwrite counts of reports committed meanwhile
+    """
+    current = stored(db)
+    recounted = actual(db)
+    fixed = {}
+    drifted: Counts = collections.Counter()
+    for key in sorted(set(current) | set(recounted)):
+        if current[key] == recounted[key]:
+            continue
+        fixed[".".join(i for i in key if i)] = {
+            "stored": current[key],
+            "actual": recounted[key],
+        }
+        drifted[key] = recounted[key]
+    add(db, drifted, absolute=True)
+    return fixed
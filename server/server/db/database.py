@@ -2,15 +2,115 @@
 #
 # This file is part of Chalk
 # (see https://crashoverride.com/docs/chalk)
+from typing import Callable
+
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, create_engine, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from . import timing
 
 
 DATABASE_URL = os.environ.get("DATABASE_URL") or "sqlite:///chalkdb.sqlite"
+# such as wal so readers and backups do not block writers
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE")
+# pages in WAL after which it is checkpointed. 0 disables, such as when
+# only WAL shipping (backup --wal) should checkpoint
+SQLITE_WAL_AUTOCHECKPOINT = os.environ.get("SQLITE_WAL_AUTOCHECKPOINT")
+
+
+def connect(url: str) -> Engine:
+    """
+    engine for the database url. also used for shards, see shards.py
+    """
+    connect_args = {}
+    if url.startswith("sqlite"):
+        # sessions are used from threads such as by asyncio.to_thread
+        connect_args["check_same_thread"] = False
+    engine = create_engine(url, connect_args=connect_args)
+    timing.install(engine)
+    if engine.dialect.name == "sqlite":
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, _):
+            # only takes effect before any table is created so when the
+            # database is new. lets maintenance free pages incrementally
+            dbapi_connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            if SQLITE_JOURNAL_MODE:
+                dbapi_connection.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            if SQLITE_WAL_AUTOCHECKPOINT:
+                dbapi_connection.execute(
+                    f"PRAGMA wal_autocheckpoint={int(SQLITE_WAL_AUTOCHECKPOINT)}"
+                )
+
+    return engine
+
+
+def sessions(engine: Engine) -> sessionmaker:
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+engine = connect(DATABASE_URL)
+SessionLocal = sessions(engine)
 
 Base = declarative_base()
+
+
+def migrate(engine: Engine):
+    """
+    create missing tables as well as missing columns and indexes
+    in existing tables so that existing databases pick up new fields.
+    columns can only be added this way so they must be nullable.
+    columns denormalized from raw are filled by backfill()
+    """
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {i["name"] for i in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {quote(table.name)} "
+                        f"ADD COLUMN {quote(column.name)} "
+                        f"{column.type.compile(dialect=engine.dialect)}"
+                    )
+                )
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def backfill(db: Session):
+    """
+    fill empty columns denormalized from raw such as for rows stored
+    before the column was added. scans whole tables so run by reindex
+    rather than at startup
+    """
+    for table in Base.metadata.sorted_tables:
+        for column in table.columns:
+            if "raw" not in column.info:
+                continue
+            value = table.c.raw[column.info["raw"]]
+            if column.type.python_type is int:
+                value = value.as_integer()
+            else:
+                value = value.as_string()
+            db.execute(table.update().where(column.is_(None)).values({column: value}))
+
+
+def upsert_insert(dialect: str) -> Callable:
+    """
+    insert() which supports ON CONFLICT.
+    derived tables rely on upserts so only these dialects are supported
+    """
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"{dialect} is not supported. use SQLite or PostgreSQL")
@@ -2,26 +2,145 @@
 #
 # This file is part of Chalk
 # (see https://crashoverride.com/docs/chalk)
-from sqlalchemy import JSON, Column, Integer, String
+from typing import Any
+
+from sqlalchemy import JSON, BigInteger, Column, ForeignKey, Integer, String
+from sqlalchemy.orm import relationship
 
 from .database import Base
 
 
+def from_raw(key: str) -> dict[str, str]:
+    """
+    column info for columns denormalized from a top-level key in raw.
+    see denormalized() and migrate() which backfills existing rows
+    """
+    return {"raw": key}
+
+
+def denormalized(model, raw: dict[str, Any]) -> dict[str, Any]:
+    fields = {}
+    for column in model.__table__.columns:
+        if "raw" not in column.info:
+            continue
+        value = raw.get(column.info["raw"])
+        # bool is an int subclass
+        if isinstance(value, column.type.python_type) and not isinstance(value, bool):
+            fields[column.name] = value
+    return fields
+
+
 class Chalk(Base):
     __tablename__ = "chalks"
 
     metadata_id = Column(String, primary_key=True, index=True)
     metadata_hash = Column(String)
-    chalk_id = Column(String)
+    chalk_id = Column(String, index=True)
     raw = Column(JSON)
+    hash = Column(String, index=True, info=from_raw("HASH"))
+    artifact_type = Column(String, index=True, info=from_raw("ARTIFACT_TYPE"))
+    platform = Column(String, index=True, info=from_raw("_OP_PLATFORM"))
+    origin_uri = Column(String, index=True, info=from_raw("ORIGIN_URI"))
+    commit_id = Column(String, index=True, info=from_raw("COMMIT_ID"))
+    timestamp = Column(Integer, index=True, info=from_raw("_TIMESTAMP"))
+    # report which created the chalkmark. its id orders chalks in /changes
+    report_id = Column(Integer, ForeignKey("reports.id"), index=True)
+
+    report = relationship("Report")
+
+
+class ChalkHash(Base):
+    """
+    reverse lookup of chalkmarks by any of their hashes/digests
+    """
+
+    __tablename__ = "chalk_hashes"
+
+    digest = Column(String, primary_key=True)
+    metadata_id = Column(
+        String, ForeignKey("chalks.metadata_id"), primary_key=True, index=True
+    )
+    key = Column(String, primary_key=True)  # HASH, _IMAGE_ID, etc
+
+
+class ChalkShard(Base):
+    """
+    shard which stores each chalkmark with DATABASE_SHARDS
+    so that lookups by METADATA_ID go to one shard. see shards.py
+    """
+
+    __tablename__ = "chalk_shards"
+
+    metadata_id = Column(String, primary_key=True)
+    shard = Column(Integer, nullable=False)
 
 
 class Report(Base):
     __tablename__ = "reports"
+    # ids order /changes so they must not be reused after deletes
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    operation = Column(String)  # exec, heartbeat
+    operation = Column(String, index=True)  # exec, heartbeat
     raw = Column(JSON)
+    platform = Column(String, index=True, info=from_raw("_OP_PLATFORM"))
+    # all timestamps are in ms since epoch
+    timestamp = Column(Integer, index=True, info=from_raw("_TIMESTAMP"))
+    received_at = Column(Integer, index=True)
+    committed_at = Column(Integer, index=True)
+    # PostgreSQL transaction which stored the report. see changes.py
+    txid = Column(BigInteger, index=True)
+
+
+class Inventory(Base):
+    """
+    latest exec/heartbeat sighting of each chalk on each host.
+    upserted at ingest, see inventory.py
+    """
+
+    __tablename__ = "inventory"
+
+    chalk_id = Column(String, primary_key=True)
+    # _OP_HOSTNAME. empty when not reported as primary keys cannot be null
+    host = Column(String, primary_key=True, index=True)
+    metadata_id = Column(String, index=True)
+    operation = Column(String)
+    platform = Column(String)
+    exec_id = Column(String)
+    container_id = Column(String, index=True)
+    container_name = Column(String)
+    pid = Column(Integer)
+    # ms since epoch of _TIMESTAMP of first and latest sightings
+    first_seen = Column(Integer)
+    last_seen = Column(Integer, index=True)
+    received_at = Column(Integer)
+
+
+class Counter(Base):
+    """
+    row counts maintained at ingest. see counts.py
+    """
+
+    __tablename__ = "counters"
+
+    # table name or table.facet such as reports.operation
+    name = Column(String, primary_key=True)
+    # facet value. empty for table totals
+    value = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+class LineageEdge(Base):
+    """
+    links between identifiers seen together in reports
+    such as commit -> chalk -> mark -> exec. see lineage.py
+    """
+
+    __tablename__ = "lineage_edges"
+
+    # nodes are "kind:value", e.g. "commit:<sha>"
+    source = Column(String, primary_key=True)
+    target = Column(String, primary_key=True, index=True)
 
 
 class Stat(Base):
@@ -29,8 +148,57 @@ class Stat(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     operation = Column(String)
-    timestamp = Column(Integer)
+    timestamp = Column(Integer, index=True)
     op_chalk_count = Column(Integer)
     op_chalker_commit_id = Column(String)
     op_chalker_version = Column(String)
     op_platform = Column(String)
+
+
+class StatCount(Base):
+    """
+    /ping beacons aggregated per minute. see stats.py
+    """
+
+    __tablename__ = "stat_counts"
+
+    # ms since epoch of start of the minute
+    minute = Column(Integer, primary_key=True)
+    operation = Column(String, primary_key=True)
+    op_chalker_version = Column(String, primary_key=True)
+    op_chalker_commit_id = Column(String, primary_key=True)
+    op_platform = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+    # sum of _OP_CHALK_COUNT
+    chalks = Column(Integer, nullable=False)
+    # ms since epoch of last flush which updated the row
+    updated_at = Column(Integer, index=True)
+
+
+class Lease(Base):
+    """
+    lock held by one worker at a time which expires
+    unless renewed. see maintenance.py
+    """
+
+    __tablename__ = "leases"
+
+    name = Column(String, primary_key=True)
+    # hostname:pid:random of the worker holding the lease
+    holder = Column(String, nullable=False)
+    # ms since epoch
+    expires_at = Column(Integer, nullable=False)
+
+
+class MaintenanceRun(Base):
+    """
+    last run of each maintenance task. see maintenance.py
+    """
+
+    __tablename__ = "maintenance_runs"
+
+    task = Column(String, primary_key=True)
+    # ms since epoch
+    started_at = Column(Integer, nullable=False)
+    duration_ms = Column(Integer, nullable=False)
+    error = Column(String)
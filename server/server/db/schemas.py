@@ -2,6 +2,8 @@
 #
 # This file is part of Chalk
 # (see https://crashoverride.com/docs/chalk)
+from typing import Optional
+
 from pydantic import BaseModel, Field
 
 
@@ -15,3 +17,17 @@ class Stat(BaseModel):
 
     class Config:
         populate_by_name = True
+
+
+class HashLookup(BaseModel):
+    digests: list[str]
+
+
+class ChalkBatch(BaseModel):
+    metadata_ids: list[str] = []
+    chalk_ids: list[str] = []
+
+
+class AnalyticsQuery(BaseModel):
+    sql: str
+    max_rows: Optional[int] = Field(None, ge=1)
@@ -0,0 +1,181 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Per-statement timings aggregated by normalized SQL.
+
+Statements are normalized by replacing literals with placeholders so
+that the same query with different values is counted together.
+Timings are kept per worker process. Plans of slow statements are
+captured by a background thread on its own connection so that EXPLAIN
+neither delays nor shares the transaction of the request which ran them.
+"""
+import dataclasses
+import functools
+import logging
+import queue
+import re
+import threading
+import time
+from typing import Any, Optional
+
+import os
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS") or 100)
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_spaces = re.compile(r"\s+")
+_explainable = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+@dataclasses.dataclass()
+class StatementStats:
+    statement: str
+    count: int = 0
+    total_ms: float = 0
+    max_ms: float = 0
+    slow: int = 0
+    plan: Optional[list[str]] = None
+
+
+_stats: dict[str, StatementStats] = {}
+_lock = threading.Lock()
+# slow statements waiting to be explained
+_plans: queue.Queue[tuple[Engine, str, str, Any]] = queue.Queue(maxsize=100)
+_explaining: set[str] = set()
+_explainer: Optional[threading.Thread] = None
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(statement: str) -> str:
+    statement = _literals.sub("?", statement)
+    statement = _lists.sub("(?, ...)", statement)
+    return _spaces.sub(" ", statement).strip()
+
+
+def explain(engine: Engine, statement: str, parameters) -> list[str]:
+    if engine.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif engine.dialect.name == "postgresql":
+        prefix = "EXPLAIN "
+    else:
+        return []
+    if not statement.lstrip().upper().startswith(_explainable):
+        return []
+    # executemany passes list of parameters. plan is the same for all of them
+    if isinstance(parameters, list):
+        parameters = parameters[0] if parameters else ()
+    # raw connection does not emit cursor events
+    dbapi_connection = engine.raw_connection()
+    try:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return [" ".join(str(i) for i in row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+    finally:
+        dbapi_connection.rollback()
+        dbapi_connection.close()
+
+
+def explainable(engine: Engine) -> bool:
+    # these pools hand the same connection to every checkout of a thread
+    # or of all threads, such as for in-memory SQLite, so another
+    # connection would not see the same database
+    return not isinstance(engine.pool, (SingletonThreadPool, StaticPool))
+
+
+def explain_later(engine: Engine, key: str, statement: str, parameters):
+    global _explainer
+    with _lock:
+        if key in _explaining:
+            return
+        _explaining.add(key)
+        if _explainer is None or not _explainer.is_alive():
+            _explainer = threading.Thread(
+                target=explain_forever, name="chalkserver-explain", daemon=True
+            )
+            _explainer.start()
+    try:
+        _plans.put_nowait((engine, key, statement, parameters))
+    except queue.Full:
+        # explained if it is slow again
+        with _lock:
+            _explaining.discard(key)
+
+
+def explain_forever():
+    while True:
+        engine, key, statement, parameters = _plans.get()
+        try:
+            plan = explain(engine, statement, parameters)
+        except Exception as e:
+            plan = []
+            logger.warning("Could not explain query %s", e)
+        with _lock:
+            _explaining.discard(key)
+            stats = _stats.get(key)
+            if stats is not None:
+                stats.plan = plan
+        _plans.task_done()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = (time.perf_counter() - conn.info["query_start"].pop()) * 1000
+    key = normalize(statement)
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = StatementStats(statement=key)
+        stats.count += 1
+        stats.total_ms += elapsed
+        stats.max_ms = max(stats.max_ms, elapsed)
+        if elapsed >= SLOW_QUERY_MS:
+            stats.slow += 1
+    if elapsed < SLOW_QUERY_MS:
+        return
+    logger.warning("Slow query %.1fms %s", elapsed, key)
+    # plan is captured once per statement as its not cheap
+    if SLOW_QUERY_EXPLAIN and stats.plan is None and explainable(conn.engine):
+        explain_later(conn.engine, key, statement, parameters)
+
+
+def handle_error(context):
+    # failed statements never reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def install(engine: Engine):
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+def top(limit: int = 20, order_by: str = "total_ms") -> list[StatementStats]:
+    with _lock:
+        stats = list(_stats.values())
+    return sorted(stats, key=lambda i: getattr(i, order_by), reverse=True)[:limit]
+
+
+def reset():
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,154 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Bulk export of reports and chalks as Parquet or Arrow IPC stream.
+
+Rows are flattened by columnar.py and read and written in batches so
+memory is bounded by batch size regardless of table size. Exports are
+consistent as of when they start: reports and chalks are append-only
+so rows are limited to reports up to the latest report id at the start
+(and PostgreSQL additionally reads from a single REPEATABLE READ
+snapshot). That id is returned so the next export can continue
+from it with `after`. Chalks stored before chalks were linked to their
+reports have no report id and are only included in full exports.
+
+Requires pyarrow which is an optional dependency.
+"""
+from typing import Any, Iterator
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from . import columnar
+from .db import models
+
+try:
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pass
+
+
+BATCH_SIZE = 10000
+FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+SUFFIXES = {
+    "parquet": ".parquet",
+    "arrow": ".arrows",
+}
+
+
+class Sink:
+    """
+    write-only file which is drained as it is written so that
+    output can be streamed without buffering the whole file
+    """
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def snapshot(db: Session) -> int:
+    """
+    start reading from a consistent snapshot.
+    returns latest report id which bounds exported rows
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    return db.query(func.max(models.Report.id)).scalar() or 0
+
+
+def rows(
+    db: Session,
+    table: str,
+    after: int,
+    until: int,
+    batch_size: int,
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    batches of flattened rows of reports with ids in (after, until]
+    or of chalks of those reports. paginated by primary key
+    """
+    if table == "reports":
+        key = models.Report.id
+        query = db.query(
+            models.Report.id, models.Report.received_at, models.Report.raw
+        ).filter(models.Report.id > after, models.Report.id <= until)
+        flatten = columnar.flatten_report
+    else:
+        key = models.Chalk.metadata_id
+        query = db.query(
+            models.Chalk.metadata_id, models.Chalk.report_id, models.Chalk.raw
+        )
+        if after:
+            query = query.filter(
+                models.Chalk.report_id > after, models.Chalk.report_id <= until
+            )
+        else:
+            # including chalks stored before they were linked to their reports.
+            # new chalks always have a report so these are never exported
+            # incrementally and are only included in full exports
+            query = query.filter(
+                or_(models.Chalk.report_id <= until, models.Chalk.report_id.is_(None))
+            )
+        flatten = lambda _, *i: columnar.flatten_chalk(*i)  # noqa: E731
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            page = page.filter(key > last)
+        batch = page.order_by(key).limit(batch_size).all()
+        if not batch:
+            return
+        yield [flatten(*i) for i in batch]
+        last = batch[-1][0]
+
+
+def export(
+    db: Session,
+    table: str,
+    format: str,
+    after: int,
+    until: int,
+    batch_size: int = BATCH_SIZE,
+) -> Iterator[bytes]:
+    """
+    chunks of exported file. snapshot() must be called first
+    """
+    assert columnar.available(), columnar.MISSING
+    sink = Sink()
+    schema = columnar.schema(table)
+    if format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    with writer:
+        for batch in rows(db, table, after, until, batch_size):
+            writer.write_batch(columnar.record_batch(table, batch))
+            yield sink.drain()
+    yield sink.drain()
@@ -0,0 +1,248 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Listing filters which are compiled to SQL so that filtering is done
+by the database.
+
+Besides filters on indexed columns, any JSON path can be filtered with
+`where=PATH<op>VALUE` where:
+
+* PATH is dot-separated path into the document, e.g. `_OP_ERRORS.0`.
+  `*` matches any element of a list, e.g. `_CHALKS.*.HASH`
+* op is one of `=`, `!=`, `>`, `>=`, `<`, `<=` or `~` (contains)
+* VALUE is compared as a JSON number/boolean when it parses as one,
+  otherwise as a string. Quote the value to force string comparison
+"""
+import dataclasses
+import json
+import re
+from typing import Any, Optional, Union
+
+from fastapi import HTTPException, Query
+from sqlalchemy import JSON, ColumnElement, exists, func, type_coerce
+
+from .db import models
+
+
+_where = re.compile(r"^(?P<path>[^=!<>~]+)(?P<op>!=|>=|<=|=|>|<|~)(?P<value>.*)$")
+
+Path = tuple[Union[str, int], ...]
+
+
+@dataclasses.dataclass()
+class Where:
+    path: Path
+    # path within each element of list at path when path has *
+    element_path: Optional[Path]
+    op: str
+    value: Any
+
+    @classmethod
+    def parse(cls, where: str) -> "Where":
+        match = _where.match(where)
+        if not match:
+            raise HTTPException(status_code=400, detail=f"Invalid filter: {where}")
+        path, star, element_path = f"{match['path']}.".partition(".*.")
+        if "*" in path.split(".") or "*" in element_path.split("."):
+            raise HTTPException(
+                status_code=400, detail=f"Only single * is supported: {where}"
+            )
+        try:
+            value = json.loads(match["value"])
+        except ValueError:
+            value = match["value"]
+        if isinstance(value, (dict, list)) or value is None:
+            value = match["value"]
+        return cls(
+            path=parse_path(path.rstrip(".")),
+            element_path=parse_path(element_path.rstrip(".")) if star else None,
+            op=match["op"],
+            value=value,
+        )
+
+
+def parse_path(path: str) -> Path:
+    if not path:
+        return ()
+    return tuple(int(i) if i.isdigit() else i for i in path.split("."))
+
+
+def json_path(path: Path) -> str:
+    """
+    SQLite JSON path such as $."_CHALKS"[0]
+    """
+    return "$" + "".join(f"[{i}]" if isinstance(i, int) else f'."{i}"' for i in path)
+
+
+def compare(document, path: Path, op: str, value: Any) -> ColumnElement:
+    element = document[path] if path else document
+    if not path:
+        # scalar list element which is already extracted as text
+        value = str(value)
+    elif isinstance(value, bool):
+        element = element.as_boolean()
+    elif isinstance(value, int):
+        element = element.as_integer()
+    elif isinstance(value, float):
+        element = element.as_float()
+    else:
+        element = element.as_string()
+        value = str(value)
+    if op == "=":
+        return element == value
+    if op == "!=":
+        return element != value
+    if op == ">":
+        return element > value
+    if op == ">=":
+        return element >= value
+    if op == "<":
+        return element < value
+    if op == "<=":
+        return element <= value
+    return element.contains(str(value), autoescape=True)
+
+
+def elements(dialect: str, document, path: Path, scalar: bool):
+    """
+    table-valued function iterating over JSON list in the document
+    """
+    if dialect == "postgresql":
+        if scalar:
+            return func.json_array_elements_text(document[path]).table_valued("value")
+        return func.json_array_elements(document[path]).table_valued("value")
+    if dialect == "sqlite":
+        return func.json_each(document, json_path(path)).table_valued("value")
+    raise HTTPException(
+        status_code=400,
+        detail=f"Filtering list elements is not supported for {dialect}",
+    )
+
+
+def condition(dialect: str, document, where: Where) -> ColumnElement:
+    if where.element_path is None:
+        return compare(document, where.path, where.op, where.value)
+    scalar = not where.element_path
+    items = elements(dialect, document, where.path, scalar).alias()
+    value = items.c.value if scalar else type_coerce(items.c.value, JSON)
+    return exists().where(compare(value, where.element_path, where.op, where.value))
+
+
+class ChalkFilters:
+    def __init__(
+        self,
+        chalk_id: Optional[str] = None,
+        metadata_hash: Optional[str] = None,
+        hash: Optional[str] = None,
+        artifact_type: Optional[str] = None,
+        platform: Optional[str] = Query(None, description="_OP_PLATFORM"),
+        repo: Optional[str] = Query(None, description="ORIGIN_URI"),
+        commit: Optional[str] = Query(None, description="COMMIT_ID"),
+        since: Optional[int] = Query(None, description="_TIMESTAMP >= ms"),
+        until: Optional[int] = Query(None, description="_TIMESTAMP < ms"),
+        where: list[str] = Query([], description="PATH<op>VALUE JSON filters"),
+    ):
+        self.columns = {
+            models.Chalk.chalk_id: chalk_id,
+            models.Chalk.metadata_hash: metadata_hash,
+            models.Chalk.hash: hash,
+            models.Chalk.artifact_type: artifact_type,
+            models.Chalk.platform: platform,
+            models.Chalk.origin_uri: repo,
+            models.Chalk.commit_id: commit,
+        }
+        self.since = since
+        self.until = until
+        self.where = [Where.parse(i) for i in where]
+
+    def conditions(self, dialect: str) -> list[ColumnElement]:
+        conditions = [k == v for k, v in self.columns.items() if v is not None]
+        if self.since is not None:
+            conditions.append(models.Chalk.timestamp >= self.since)
+        if self.until is not None:
+            conditions.append(models.Chalk.timestamp < self.until)
+        for i in self.where:
+            conditions.append(condition(dialect, models.Chalk.raw, i))
+        return conditions
+
+
+class ReportFilters:
+    def __init__(
+        self,
+        operation: Optional[str] = None,
+        platform: Optional[str] = Query(None, description="_OP_PLATFORM"),
+        chalk_id: Optional[str] = Query(None, description="any of _CHALKS"),
+        metadata_id: Optional[str] = Query(None, description="any of _CHALKS"),
+        hash: Optional[str] = Query(None, description="any of _CHALKS"),
+        artifact_type: Optional[str] = Query(None, description="any of _CHALKS"),
+        repo: Optional[str] = Query(None, description="ORIGIN_URI of any _CHALKS"),
+        commit: Optional[str] = Query(None, description="COMMIT_ID of any _CHALKS"),
+        since: Optional[int] = Query(None, description="_TIMESTAMP >= ms"),
+        until: Optional[int] = Query(None, description="_TIMESTAMP < ms"),
+        where: list[str] = Query([], description="PATH<op>VALUE JSON filters"),
+    ):
+        self.operation = operation.lower() if operation else None
+        self.platform = platform
+        self.since = since
+        self.until = until
+        self.where = [Where.parse(i) for i in where]
+        chalk_keys = {
+            "CHALK_ID": chalk_id,
+            "METADATA_ID": metadata_id,
+            "HASH": hash,
+            "ARTIFACT_TYPE": artifact_type,
+            "ORIGIN_URI": repo,
+            "COMMIT_ID": commit,
+        }
+        for k, v in chalk_keys.items():
+            if v is not None:
+                # dont parse value as JSON as these are always strings
+                self.where.append(Where(("_CHALKS",), (k,), "=", v))
+
+    def conditions(self, dialect: str) -> list[ColumnElement]:
+        conditions = []
+        if self.operation is not None:
+            conditions.append(models.Report.operation == self.operation)
+        if self.platform is not None:
+            conditions.append(models.Report.platform == self.platform)
+        if self.since is not None:
+            conditions.append(models.Report.timestamp >= self.since)
+        if self.until is not None:
+            conditions.append(models.Report.timestamp < self.until)
+        for i in self.where:
+            conditions.append(condition(dialect, models.Report.raw, i))
+        return conditions
+
+
+class InventoryFilters:
+    def __init__(
+        self,
+        chalk_id: Optional[str] = None,
+        metadata_id: Optional[str] = None,
+        host: Optional[str] = Query(None, description="_OP_HOSTNAME"),
+        container_id: Optional[str] = Query(None, description="_INSTANCE_CONTAINER_ID"),
+        operation: Optional[str] = None,
+        platform: Optional[str] = Query(None, description="_OP_PLATFORM"),
+        since: Optional[int] = Query(None, description="last seen >= ms"),
+        until: Optional[int] = Query(None, description="last seen < ms"),
+    ):
+        self.columns = {
+            models.Inventory.chalk_id: chalk_id,
+            models.Inventory.metadata_id: metadata_id,
+            models.Inventory.host: host,
+            models.Inventory.container_id: container_id,
+            models.Inventory.operation: operation.lower() if operation else None,
+            models.Inventory.platform: platform,
+        }
+        self.since = since
+        self.until = until
+
+    def conditions(self) -> list[ColumnElement]:
+        conditions = [k == v for k, v in self.columns.items() if v is not None]
+        if self.since is not None:
+            conditions.append(models.Inventory.last_seen >= self.since)
+        if self.until is not None:
+            conditions.append(models.Inventory.last_seen < self.until)
+        return conditions
@@ -0,0 +1,261 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import dataclasses
+import logging
+from typing import Any, Optional
+
+from sqlalchemy.orm import Session
+
+from . import (
+    analytics,
+    changes,
+    counts,
+    inventory,
+    lag,
+    lineage,
+    lookup,
+    metrics,
+    search,
+    stats,
+)
+from .db import models
+from .db.database import backfill
+from .log import Payload
+
+
+logger = logging.getLogger(__name__)
+
+# operations which create new chalkmarks
+CHALKING_OPERATIONS = {"insert", "build"}
+
+
+def add_reports(
+    db: Session,
+    reports: list[dict[str, Any]],
+    received_at: int,
+) -> tuple[list[models.Report], list[models.Chalk]]:
+    """
+    add reports and their normalized chalkmarks to the session.
+    raises KeyError when chalkmark is missing required keys
+    """
+    # executed before adding any models so that nothing is flushed yet
+    if inventory.INVENTORY:
+        inventory.upsert(
+            db, [i for r in reports for i in inventory.sightings(r, received_at)]
+        )
+    if lineage.LINEAGE:
+        lineage.add_edges(db, {i for r in reports for i in lineage.edges(r)})
+    stored_reports = []
+    stored_chalks = []
+    # orders /changes on PostgreSQL
+    txid = changes.txid() if db.get_bind().dialect.name == "postgresql" else None
+    for report in reports:
+        operation = report.get("_OPERATION")
+        if not isinstance(operation, str):
+            logger.error("Skipping report %s", Payload(report))
+            continue
+        operation = operation.lower()
+        # save any sent reports
+        stored_reports.append(
+            models.Report(
+                operation=operation,
+                received_at=received_at,
+                raw=report,
+                txid=txid,
+                **models.denormalized(models.Report, report),
+            )
+        )
+        db.add(stored_reports[-1])
+        # if operation creates new chalkmark,
+        # save normalized chalkmark into db
+        if operation not in CHALKING_OPERATIONS:
+            continue
+        if "_CHALKS" not in report:
+            continue
+        for c in report["_CHALKS"]:
+            if "CHALK_ID" not in c:
+                logger.error("Skipping chalk %s", Payload(c))
+                continue
+            raw = {
+                **c,
+                **{k: v for k, v in report.items() if k != "_CHALKS"},
+            }
+            stored_chalks.append(
+                models.Chalk(
+                    chalk_id=c["CHALK_ID"],
+                    metadata_hash=c["METADATA_HASH"],
+                    metadata_id=c["METADATA_ID"],
+                    raw=raw,
+                    report=stored_reports[-1],
+                    **models.denormalized(models.Chalk, raw),
+                )
+            )
+            db.add(stored_chalks[-1])
+            if lookup.HASH_LOOKUP:
+                lookup.add_chalk_hashes(db, stored_chalks[-1])
+    return stored_reports, stored_chalks
+
+
+def index(
+    db: Session,
+    stored_reports: list[models.Report],
+    stored_chalks: list[models.Chalk],
+):
+    """
+    add data derived from stored reports which needs their ids.
+    flushes the session so duplicate chalks can fail here
+    """
+    db.flush()
+    if search.SEARCH_FIELDS and search.available(db):
+        search.add(
+            db,
+            [("report", str(r.id), r.raw) for r in stored_reports]
+            + [("chalk", c.metadata_id, c.raw) for c in stored_chalks],
+        )
+
+
+@dataclasses.dataclass()
+class Stored:
+    """
+    what is needed after commit of stored reports
+    """
+
+    lags: list[tuple[str, Optional[int]]]
+    received_at: int
+    captured: Optional[analytics.Captured]
+    # of stored chalkmarks
+    metadata_ids: list[str]
+    report_ids: list[int]
+    # set by stamp() once committed
+    committed_at: Optional[int] = None
+
+
+def store(db: Session, reports: list[dict[str, Any]], received_at: int) -> Stored:
+    """
+    add reports and everything derived from them to the session
+    without committing
+    """
+    stored, chalks = add_reports(db, reports, received_at)
+    metrics.chalks_per_request.observe(len(chalks))
+    # committed objects are expired so grab values before commit
+    lags = [(r.operation, r.timestamp) for r in stored]
+    index(db, stored, chalks)
+    if counts.COUNTS:
+        counts.add(db, counts.deltas(stored, chalks))
+    captured = analytics.capture(stored, chalks)
+    return Stored(
+        lags,
+        received_at,
+        captured,
+        [c.metadata_id for c in chalks],
+        [r.id for r in stored],
+    )
+
+
+def stamp(db: Session, stored: list[Stored]):
+    """
+    record committed_at of reports right after their commit succeeded
+    so ingest lag includes the commit. reports are stored regardless
+    so failing to stamp them only leaves them out of ingest lag
+    """
+    committed_at = lag.now_ms()
+    for i in stored:
+        i.committed_at = committed_at
+    try:
+        for chunk in lookup.chunks([r for i in stored for r in i.report_ids]):
+            db.query(models.Report).filter(models.Report.id.in_(chunk)).update(
+                {models.Report.committed_at: committed_at}, synchronize_session=False
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Could not record when reports were committed")
+
+
+def committed(stored: Stored):
+    """
+    called after stamp() to observe lags and append to analytics mirror
+    """
+    lag.observe(stored.lags, stored.received_at, stored.committed_at or lag.now_ms())
+    analytics.append(stored.captured)
+
+
+def reindex(db: Session, batch_size: int = 1000, append: bool = False):
+    """
+    rebuild enabled tables derived from stored chalks and reports
+    such as for data stored before those tables were added.
+    append adds to analytics mirror instead of rewriting it
+    such as for every shard but the first
+    """
+    backfill(db)
+    # chalks stored before they were linked to their reports
+    reports = (
+        db.query(models.Report.id, models.Report.raw)
+        .filter(models.Report.operation.in_(CHALKING_OPERATIONS))
+        .order_by(models.Report.id)
+        .yield_per(batch_size)
+    )
+    for report_id, raw in reports:
+        metadata_ids = [
+            c["METADATA_ID"]
+            for c in raw.get("_CHALKS") or []
+            if isinstance(c, dict) and "METADATA_ID" in c
+        ]
+        if metadata_ids:
+            db.query(models.Chalk).filter(
+                models.Chalk.metadata_id.in_(metadata_ids),
+                models.Chalk.report_id.is_(None),
+            ).update({models.Chalk.report_id: report_id}, synchronize_session=False)
+    if lookup.HASH_LOOKUP:
+        db.query(models.ChalkHash).delete()
+        for i, chalk in enumerate(db.query(models.Chalk).yield_per(batch_size)):
+            lookup.add_chalk_hashes(db, chalk)
+            if i % batch_size == 0:
+                db.flush()
+        db.flush()
+    if inventory.INVENTORY:
+        db.query(models.Inventory).delete()
+        reports = (
+            db.query(models.Report.raw, models.Report.received_at)
+            .filter(models.Report.operation.in_(inventory.INVENTORY_OPERATIONS))
+            .order_by(models.Report.id)
+            .yield_per(batch_size)
+        )
+        sightings = []
+        for raw, received_at in reports:
+            sightings.extend(inventory.sightings(raw, received_at or 0))
+            if len(sightings) >= batch_size:
+                inventory.upsert(db, sightings)
+                sightings = []
+        inventory.upsert(db, sightings)
+    if lineage.LINEAGE:
+        db.query(models.LineageEdge).delete()
+        edges: set[tuple[str, str]] = set()
+        for (raw,) in db.query(models.Report.raw).yield_per(batch_size):
+            edges.update(lineage.edges(raw))
+            if len(edges) >= batch_size:
+                lineage.add_edges(db, edges)
+                edges = set()
+        lineage.add_edges(db, edges)
+    stats.backfill(db, batch_size)
+    db.flush()
+    if counts.COUNTS:
+        counts.reconcile(db)
+    if search.SEARCH_FIELDS and search.available(db):
+        search.clear(db)
+        for model, kind, ref in (
+            (models.Report, "report", models.Report.id),
+            (models.Chalk, "chalk", models.Chalk.metadata_id),
+        ):
+            documents = []
+            for i, raw in db.query(ref, model.raw).yield_per(batch_size):
+                documents.append((kind, str(i), raw))
+                if len(documents) >= batch_size:
+                    search.add(db, documents)
+                    documents = []
+            search.add(db, documents)
+    if analytics.ANALYTICS_DIR:
+        analytics.rebuild(db, batch_size, append=append)
+    db.commit()
@@ -0,0 +1,129 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Inventory of where chalked artifacts are running.
+
+Each exec/heartbeat report upserts a row per (CHALK_ID, host) so that
+latest sightings are a simple indexed query instead of grouping over
+all stored reports. Not maintained when INVENTORY is disabled.
+"""
+from typing import Any, Iterable
+
+import os
+from sqlalchemy import Table
+from sqlalchemy.orm import Session
+
+from . import lookup
+from .db import models
+from .db.database import upsert_insert
+
+
+INVENTORY = (os.environ.get("INVENTORY") or "true").lower() in {"1", "true", "yes"}
+DISABLED = "Inventory is disabled. Set INVENTORY=true and run reindex"
+
+# operations which report running artifacts
+INVENTORY_OPERATIONS = {"exec", "heartbeat"}
+
+# column -> key in the report
+HOST_KEYS = {
+    "platform": "_OP_PLATFORM",
+    "exec_id": "_EXEC_ID",
+}
+# column -> key in each of report _CHALKS
+CHALK_KEYS = {
+    "metadata_id": "METADATA_ID",
+    "container_id": "_INSTANCE_CONTAINER_ID",
+    "container_name": "_INSTANCE_NAME",
+    "pid": "_PROCESS_PID",
+}
+
+
+def host(report: dict[str, Any]) -> str:
+    for key in ("_OP_HOSTNAME", "_OP_HOST_NODENAME"):
+        if isinstance(report.get(key), str):
+            return report[key]
+    return ""
+
+
+def column_value(column: str, value: Any) -> Any:
+    python_type = models.Inventory.__table__.c[column].type.python_type
+    # bool is an int subclass
+    if isinstance(value, python_type) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def latest(rows: Iterable[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    only keep latest sighting of each (CHALK_ID, host)
+    as a single upsert statement cannot update the same row twice
+    """
+    found: dict[tuple[str, str], dict[str, Any]] = {}
+    for row in rows:
+        key = (row["chalk_id"], row["host"])
+        if key in found:
+            first_seen = min(found[key]["first_seen"], row["first_seen"])
+            if found[key]["last_seen"] > row["last_seen"]:
+                row = found[key]
+            row = {**row, "first_seen": first_seen}
+        found[key] = row
+    return list(found.values())
+
+
+def sightings(report: dict[str, Any], received_at: int) -> list[dict[str, Any]]:
+    """
+    inventory rows for all chalks in exec/heartbeat report
+    """
+    operation = report.get("_OPERATION")
+    if not isinstance(operation, str):
+        return []
+    operation = operation.lower()
+    chalks = report.get("_CHALKS")
+    if operation not in INVENTORY_OPERATIONS or not isinstance(chalks, list):
+        return []
+    timestamp = column_value("last_seen", report.get("_TIMESTAMP"))
+    if timestamp is None:
+        timestamp = received_at
+    rows = []
+    for chalk in chalks:
+        if not isinstance(chalk, dict) or not isinstance(chalk.get("CHALK_ID"), str):
+            continue
+        rows.append(
+            {
+                "chalk_id": chalk["CHALK_ID"],
+                "host": host(report),
+                "operation": operation,
+                "first_seen": timestamp,
+                "last_seen": timestamp,
+                "received_at": received_at,
+                **{k: column_value(k, report.get(v)) for k, v in HOST_KEYS.items()},
+                **{k: column_value(k, chalk.get(v)) for k, v in CHALK_KEYS.items()},
+            }
+        )
+    return rows
+
+
+def upsert(db: Session, rows: list[dict[str, Any]]):
+    """
+    insert new sightings and update existing ones unless stored one is newer.
+    ON CONFLICT makes this safe across concurrent workers
+    """
+    rows = latest(rows)
+    if not rows:
+        return
+    table: Table = models.Inventory.__table__  # type: ignore
+    insert = upsert_insert(db.get_bind().dialect.name)
+    for chunk in lookup.chunks(rows, lookup.CHUNK_SIZE // len(table.columns)):
+        statement = insert(table).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.chalk_id, table.c.host],
+            set_={
+                c.name: statement.excluded[c.name]
+                for c in table.columns
+                if not c.primary_key and c.name != "first_seen"
+            },
+            where=table.c.last_seen <= statement.excluded.last_seen,
+        )
+        db.execute(statement)
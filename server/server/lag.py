@@ -0,0 +1,110 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Lag between chalk operation and report being stored:
+
+* delivery - from report _TIMESTAMP to server receiving it.
+  includes time report spent in chalk report cache
+* ingest - from server receiving report to committing it
+"""
+import time
+from typing import Any, Iterable, Optional
+
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+from . import metrics
+from .db import models
+
+
+BUCKETS_MS = [100, 1000, 10_000, 60_000, 300_000, 3_600_000, 86_400_000]
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def observe(
+    lags: list[tuple[str, Optional[int]]],
+    received_at: int,
+    committed_at: int,
+):
+    for operation, timestamp in lags:
+        operation = metrics.operation_label(operation)
+        if timestamp is not None:
+            metrics.report_lag.labels(operation, "delivery").observe(
+                (received_at - timestamp) / 1000
+            )
+        metrics.report_lag.labels(operation, "ingest").observe(
+            (committed_at - received_at) / 1000
+        )
+
+
+def histogram(
+    db: Session,
+    operation: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+) -> dict[str, Any]:
+    """
+    cumulative lag histograms per operation computed by the database.
+    each lag counts only reports it is known for, such as delivery lag
+    of reports with _TIMESTAMP and ingest lag of stamped reports
+    """
+    lags = {
+        "delivery": models.Report.received_at - models.Report.timestamp,
+        "ingest": models.Report.committed_at - models.Report.received_at,
+    }
+    columns = [models.Report.operation, func.count()]
+    for lag in lags.values():
+        # null lags are not counted by any of these
+        columns.extend([func.count(lag), func.max(lag)])
+        columns.extend(func.sum(case((lag <= b, 1), else_=0)) for b in BUCKETS_MS)
+    query = db.query(*columns).group_by(models.Report.operation)
+    if operation:
+        query = query.filter(models.Report.operation == operation.lower())
+    if since is not None:
+        query = query.filter(models.Report.received_at >= since)
+    if until is not None:
+        query = query.filter(models.Report.received_at < until)
+
+    operations = {}
+    for op, count, *values in query:
+        data: dict[str, Any] = {"count": count}
+        for name in lags:
+            lag_count, max_ms, *buckets = values[: len(BUCKETS_MS) + 2]
+            values = values[len(BUCKETS_MS) + 2 :]
+            data[name] = {
+                "count": lag_count,
+                "max_ms": max_ms,
+                "le_ms": dict(zip(BUCKETS_MS, buckets)),
+            }
+        operations[op] = data
+    return {"buckets_ms": BUCKETS_MS, "operations": operations}
+
+
+def merge(histograms: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """
+    combine histograms such as of each shard
+    """
+    operations: dict[str, Any] = {}
+    for histogram in histograms:
+        for op, data in histogram["operations"].items():
+            if op not in operations:
+                operations[op] = data
+                continue
+            merged = operations[op]
+            merged["count"] += data["count"]
+            for name in ("delivery", "ingest"):
+                max_ms = [
+                    i
+                    for i in (merged[name]["max_ms"], data[name]["max_ms"])
+                    if i is not None
+                ]
+                merged[name]["max_ms"] = max(max_ms) if max_ms else None
+                merged[name]["count"] += data[name]["count"]
+                for b in BUCKETS_MS:
+                    merged[name]["le_ms"][b] += data[name]["le_ms"][b]
+    return {"buckets_ms": BUCKETS_MS, "operations": operations}
@@ -0,0 +1,164 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Lineage graph between identifiers which appear together in reports.
+
+Edges are stored at ingest so that provenance such as
+commit -> chalk -> mark -> image -> container -> exec -> heartbeat
+is a breadth-first traversal over indexed edges instead of
+scanning stored JSON documents. Not stored when LINEAGE is disabled.
+"""
+from typing import Any, Callable, Optional
+
+import os
+from sqlalchemy import select, union
+from sqlalchemy.orm import Session
+
+from . import lookup
+from .db import models
+from .db.database import upsert_insert
+
+
+LINEAGE = (os.environ.get("LINEAGE") or "true").lower() in {"1", "true", "yes"}
+DISABLED = "Lineage is disabled. Set LINEAGE=true and run reindex"
+
+# key -> node kind
+NODE_KINDS = {
+    "COMMIT_ID": "commit",
+    "CHALK_ID": "chalk",
+    "METADATA_ID": "mark",
+    "_IMAGE_ID": "image",
+    "_INSTANCE_IMAGE_ID": "image",
+    "_INSTANCE_CONTAINER_ID": "container",
+    "_EXEC_ID": "exec",
+    "_ACTION_ID": "action",
+}
+# image ids are normalized the same as in hash lookup
+NORMALIZED_KINDS = {"image"}
+
+# (source key, target key) of edges added for each chalk in a report.
+# _EXEC_ID is per chalk run and _ACTION_ID is per report
+# so exec links a mark to all of its heartbeats
+EDGES = [
+    ("COMMIT_ID", "CHALK_ID"),
+    ("CHALK_ID", "METADATA_ID"),
+    ("METADATA_ID", "_IMAGE_ID"),
+    ("_INSTANCE_IMAGE_ID", "_INSTANCE_CONTAINER_ID"),
+    ("METADATA_ID", "_EXEC_ID"),
+    ("_INSTANCE_CONTAINER_ID", "_EXEC_ID"),
+    ("_EXEC_ID", "_ACTION_ID"),
+]
+
+
+def node(kind: str, value: str) -> str:
+    if kind in NORMALIZED_KINDS:
+        value = lookup.normalize(value)
+    return f"{kind}:{value}"
+
+
+def edges(report: dict[str, Any]) -> set[tuple[str, str]]:
+    found = set()
+    chalks = report.get("_CHALKS")
+    if not isinstance(chalks, list) or not chalks:
+        # report level keys such as _EXEC_ID -> _ACTION_ID
+        chalks = [{}]
+    for chalk in chalks:
+        if not isinstance(chalk, dict):
+            continue
+        values = {**chalk, **{k: v for k, v in report.items() if k != "_CHALKS"}}
+        for source, target in EDGES:
+            s, t = values.get(source), values.get(target)
+            if isinstance(s, str) and s and isinstance(t, str) and t:
+                found.add((node(NODE_KINDS[source], s), node(NODE_KINDS[target], t)))
+    return found
+
+
+def add_edges(db: Session, edges: set[tuple[str, str]]):
+    if not edges:
+        return
+    table = models.LineageEdge.__table__
+    rows = [{"source": s, "target": t} for s, t in sorted(edges)]
+    insert = upsert_insert(db.get_bind().dialect.name)
+    for chunk in lookup.chunks(rows, lookup.CHUNK_SIZE // 2):
+        db.execute(insert(table).values(chunk).on_conflict_do_nothing())
+
+
+def start_nodes(value: str, kind: Optional[str]) -> list[str]:
+    kinds = [kind] if kind else sorted(set(NODE_KINDS.values()))
+    return sorted({node(k, value) for k in kinds})
+
+
+def neighbours(db: Session, nodes: list[str]) -> set[tuple[str, str]]:
+    found = set()
+    edge = models.LineageEdge
+    for chunk in lookup.chunks(nodes, lookup.CHUNK_SIZE // 2):
+        query = union(
+            select(edge.source, edge.target).where(edge.source.in_(chunk)),
+            select(edge.source, edge.target).where(edge.target.in_(chunk)),
+        )
+        found.update((s, t) for s, t in db.execute(query))
+    return found
+
+
+def traverse(
+    neighbours: Callable[[list[str]], set[tuple[str, str]]],
+    start: list[str],
+    max_depth: int,
+    max_nodes: int,
+) -> Optional[dict[str, Any]]:
+    """
+    breadth-first traversal in both directions from any of start nodes
+    using neighbours to find edges of nodes, such as of each shard.
+    stops at max_depth hops or once max_nodes are found.
+    None when none of the start nodes exist
+    """
+    depths: dict[str, int] = {}
+    found_edges: set[tuple[str, str]] = set()
+    frontier = start
+    truncated = False
+    for depth in range(max_depth + 1):
+        if not frontier:
+            break
+        adjacent = neighbours(frontier)
+        if depth == 0:
+            # only keep start nodes which are in the graph
+            frontier = [i for i in frontier if any(i in edge for edge in adjacent)]
+        for i in frontier:
+            depths[i] = depth
+        if depth == max_depth:
+            # edges between nodes at max_depth are not followed but still
+            # belong to the graph of found nodes
+            found_edges.update(
+                edge for edge in adjacent if all(i in depths for i in edge)
+            )
+            truncated = any(i not in depths for edge in adjacent for i in edge)
+            break
+        following = set()
+        for edge in adjacent:
+            for i in edge:
+                if i in depths or i in following:
+                    continue
+                if len(depths) + len(following) >= max_nodes:
+                    truncated = True
+                    continue
+                following.add(i)
+            if all(i in depths or i in following for i in edge):
+                found_edges.add(edge)
+        frontier = sorted(following)
+    if not depths:
+        return None
+    return {
+        "nodes": [
+            {
+                "id": i,
+                "kind": i.partition(":")[0],
+                "value": i.partition(":")[2],
+                "depth": d,
+            }
+            for i, d in sorted(depths.items(), key=lambda i: (i[1], i[0]))
+        ],
+        "edges": [{"source": s, "target": t} for s, t in sorted(found_edges)],
+        "truncated": truncated,
+    }
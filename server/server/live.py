@@ -0,0 +1,182 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Live tail of newly committed reports over Server-Sent Events.
+
+Ingestion does not know about subscribers. Instead while anyone is
+subscribed, each worker tails the reports table (of each shard) by id
+and fans out new reports to its own subscribers so reports committed
+by any worker are delivered. Tailing is woken up right away by commits in the same worker
+and otherwise re-polls every LIVE_POLL_INTERVAL seconds.
+
+Each subscriber has a bounded buffer. When a subscriber does not keep
+up and its buffer is full, it is dropped rather than buffering more.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+from typing import Any, AsyncIterator, Optional
+
+import os
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from . import changes, metrics, passthrough, shards
+from .db import models
+from .db.database import SessionLocal
+
+
+logger = logging.getLogger(__name__)
+
+LIVE_BUFFER = int(os.environ.get("LIVE_BUFFER") or 100)
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL") or 1)
+LIVE_KEEPALIVE = float(os.environ.get("LIVE_KEEPALIVE") or 15)
+# max reports loaded per poll
+LIVE_BATCH = 1000
+
+
+class Event:
+    def __init__(self, id: int, operation: str, data: str):
+        self.id = id
+        self.operation = operation
+        self.data = data
+        self._raw: Optional[dict[str, Any]] = None
+
+    @property
+    def raw(self) -> dict[str, Any]:
+        # only decoded when a subscriber filters by chalk keys
+        if self._raw is None:
+            self._raw = json.loads(self.data)
+        return self._raw
+
+    def sse(self) -> bytes:
+        return f"id: {self.id}\nevent: report\ndata: {self.data}\n\n".encode()
+
+
+class Subscriber:
+    def __init__(self, operation: Optional[str], chalks: dict[str, str]):
+        self.operation = operation.lower() if operation else None
+        # key in any of _CHALKS -> value
+        self.chalks = chalks
+        self.queue: asyncio.Queue[Event] = asyncio.Queue(LIVE_BUFFER)
+        self.dropped = False
+
+    def matches(self, event: Event) -> bool:
+        if self.operation is not None and event.operation != self.operation:
+            return False
+        if not self.chalks:
+            return True
+        chalks = event.raw.get("_CHALKS")
+        if not isinstance(chalks, list):
+            return False
+        return any(
+            isinstance(c, dict) and all(c.get(k) == v for k, v in self.chalks.items())
+            for c in chalks
+        )
+
+
+class Broker:
+    def __init__(self):
+        self.subscribers: set[Subscriber] = set()
+        self.task: Optional[asyncio.Task] = None
+
+    def subscribe(self, subscriber: Subscriber):
+        self.subscribers.add(subscriber)
+        if self.task is None:
+            self.task = asyncio.create_task(self.tail())
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers:
+            self.stop()
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def publish(self, events: list[Event]):
+        for subscriber in list(self.subscribers):
+            for event in events:
+                if not subscriber.matches(event):
+                    continue
+                try:
+                    subscriber.queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    metrics.live_dropped_total.inc()
+                    subscriber.dropped = True
+                    self.unsubscribe(subscriber)
+                    break
+
+    def load(
+        self, source: sessionmaker, since: Optional[int]
+    ) -> tuple[int, list[Event]]:
+        with source() as db:
+            if since is None:
+                return db.query(func.max(models.Report.id)).scalar() or 0, []
+            rows = (
+                db.query(
+                    models.Report.id,
+                    models.Report.operation,
+                    passthrough.text(models.Report.raw),
+                )
+                .filter(models.Report.id > since)
+                .order_by(models.Report.id)
+                .limit(LIVE_BATCH)
+                .all()
+            )
+        events = [Event(*i) for i in rows]
+        return events[-1].id if events else since, events
+
+    async def tail(self):
+        # report ids are per shard so each is tailed separately
+        sources = shards.shards or [SessionLocal]
+        # only reports committed after first subscriber connected
+        # queries run in a thread so they do not block the event loop
+        last = [(await asyncio.to_thread(self.load, i, None))[0] for i in sources]
+        while True:
+            await changes.committed(LIVE_POLL_INTERVAL)
+            try:
+                for i, source in enumerate(sources):
+                    while True:
+                        last[i], events = await asyncio.to_thread(
+                            self.load, source, last[i]
+                        )
+                        self.publish(events)
+                        if len(events) < LIVE_BATCH:
+                            break
+            except Exception:
+                logger.exception("Could not load live reports")
+
+
+broker = Broker()
+
+
+async def stream(subscriber: Subscriber) -> AsyncIterator[bytes]:
+    broker.subscribe(subscriber)
+    try:
+        # flush headers so clients know they are subscribed
+        yield b": subscribed\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), LIVE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if subscriber.dropped:
+                yield b"event: dropped\ndata: {}\n\n"
+                return
+            yield event.sse()
+    finally:
+        broker.unsubscribe(subscriber)
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    try:
+        yield
+    finally:
+        broker.stop()
@@ -2,10 +2,173 @@
 #
 # This file is part of Chalk
 # (see https://crashoverride.com/docs/chalk)
+"""
+Logging is done via a bounded queue so that the event loop never blocks
+on writing logs. Records are formatted and written by a listener thread.
+When the queue is full or a message is logged too often,
+records are dropped rather than slowing down request handling.
+"""
+import atexit
+import datetime
+import json
 import logging.config
+import logging.handlers
+import queue
+import reprlib
+import threading
+import time
+from typing import Any, Optional
+
+import os
+
+from . import metrics
+
+
+LOG_FORMAT = os.environ.get("LOG_FORMAT") or "text"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE") or 10000)
+LOG_MAX_LENGTH = int(os.environ.get("LOG_MAX_LENGTH") or 4096)
+# max messages per second for each unique log message
+LOG_RATE_LIMIT = float(os.environ.get("LOG_RATE_LIMIT") or 10)
+# when rate limited, still let 1 out of N messages through
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY") or 100)
+
+_payload_repr = reprlib.Repr()
+_payload_repr.maxlevel = 3
+_payload_repr.maxdict = 20
+_payload_repr.maxlist = 10
+_payload_repr.maxstring = 100
+_payload_repr.maxother = 100
+
+# attributes every LogRecord has. anything else is passed via extra=
+_record_attrs = set(vars(logging.makeLogRecord({}))) | {
+    "color_message",
+    "message",
+    "suppressed",
+}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class Payload:
+    """
+    lazily render bounded repr of potentially large objects such as
+    reports so that logging them does not stringify the whole payload
+    """
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self):
+        return _payload_repr.repr(self.value)
+
+
+def truncate(message: str) -> str:
+    if len(message) <= LOG_MAX_LENGTH:
+        return message
+    return f"{message[:LOG_MAX_LENGTH]}... ({len(message)} chars)"
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "message": truncate(record.getMessage()),
+        }
+        for k, v in vars(record).items():
+            if k not in _record_attrs:
+                data[k] = v
+        if getattr(record, "suppressed", 0):
+            data["suppressed"] = record.suppressed  # type: ignore
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class TruncatingFormatter(logging.Formatter):
+    """
+    wraps another formatter to bound message size
+    """
+
+    def __init__(self, formatter: logging.Formatter):
+        super().__init__()
+        self.formatter = formatter
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = truncate(self.formatter.format(record))
+        if getattr(record, "suppressed", 0):
+            message += f" ({record.suppressed} similar messages suppressed)"  # type: ignore
+        return message
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    token bucket per unique (logger, message template)
+    """
+
+    def __init__(self, rate: float, sample_every: int):
+        super().__init__()
+        self.rate = rate
+        self.sample_every = max(sample_every, 1)
+        # key -> [tokens, last refill, suppressed]
+        self.buckets: dict[tuple[str, Any], list[float]] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # access logs all share the same template
+        if self.rate <= 0 or record.name == "uvicorn.access":
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                # formatted messages (f-strings) make each message unique
+                if len(self.buckets) > 10000:
+                    self.buckets.clear()
+                bucket = self.buckets[key] = [self.rate, now, 0]
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1 or bucket[2] + 1 >= self.sample_every:
+                bucket[0] = max(bucket[0] - 1, 0)
+                record.suppressed = int(bucket[2])
+                bucket[2] = 0
+                return True
+            bucket[2] += 1
+        metrics.dropped_logs_total.labels("rate_limit").inc()
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # queue is in process so record is passed as is, including args
+        # and exc_info, and is only formatted by the listener thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.dropped_logs_total.labels("queue_full").inc()
+
+
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop)
 
 
 def config():
+    global _listener
+
     config = {
         "version": 1,
         "disable_existing_loggers": False,
@@ -15,13 +178,25 @@ def config():
                 "fmt": "%(levelprefix)s %(name)-20s %(message)s",
                 "use_colors": None,
             },
+            "access": {
+                "()": "uvicorn.logging.AccessFormatter",
+                "fmt": '%(levelprefix)s %(client_addr)s - "%(request_line)s" %(status_code)s',
+            },
+            "json": {
+                "()": JSONFormatter,
+            },
         },
         "handlers": {
             "default": {
-                "formatter": "default",
+                "formatter": "json" if LOG_FORMAT == "json" else "default",
                 "class": "logging.StreamHandler",
                 "stream": "ext://sys.stderr",
             },
+            "access": {
+                "formatter": "json" if LOG_FORMAT == "json" else "access",
+                "class": "logging.StreamHandler",
+                "stream": "ext://sys.stdout",
+            },
         },
         "loggers": {
             __name__.split(".")[0]: {
@@ -34,9 +209,32 @@ def config():
                 "level": "INFO",
                 "propagate": False,
             },
+            "uvicorn.access": {
+                "handlers": ["access"],
+                "level": "INFO",
+                "propagate": False,
+            },
         },
     }
     logging.config.dictConfig(config)
-    # remove double logging from uvicorn
-    uvicorn_logger = logging.getLogger("uvicorn")
-    uvicorn_logger.propagate = False
+
+    # dictConfig in python 3.11 cannot configure queue handlers
+    # so move configured stream handlers behind a single queue.
+    # the listener passes every record to each of them
+    # so access logs are routed to their own stream by filters
+    default = logging.getLogger("uvicorn").handlers[0]
+    default.addFilter(lambda record: record.name != "uvicorn.access")
+    access = logging.getLogger("uvicorn.access").handlers[0]
+    access.addFilter(logging.Filter("uvicorn.access"))
+    streams = [default, access]
+    if LOG_FORMAT != "json":
+        for stream in streams:
+            stream.setFormatter(TruncatingFormatter(stream.formatter))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_SAMPLE_EVERY))
+    for name in config["loggers"]:
+        logging.getLogger(name).handlers = [queue_handler]
+
+    stop()
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *streams)
+    _listener.start()
@@ -0,0 +1,111 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Reverse lookup of chalkmarks by artifact hashes and image digests.
+
+Hashes are indexed at ingest unless HASH_LOOKUP is disabled.
+"""
+from typing import Any, Iterable, Iterator
+
+import os
+from sqlalchemy.orm import Session
+
+from .db import models
+
+
+HASH_LOOKUP = (os.environ.get("HASH_LOOKUP") or "true").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+DISABLED = "Hash lookup is disabled. Set HASH_LOOKUP=true and run reindex"
+
+# keys which have a single hash/digest
+HASH_KEYS = [
+    "HASH",
+    "PRE_CHALK_HASH",
+    "_CURRENT_HASH",
+    "_IMAGE_ID",
+    "_IMAGE_DIGEST",
+    "_IMAGE_LIST_DIGEST",
+    "_INSTANCE_IMAGE_ID",
+]
+# keys which map repo names to digests
+HASH_MAP_KEYS = [
+    "_REPO_DIGESTS",
+]
+
+# max bind parameters per IN query. older sqlite only allows 999
+CHUNK_SIZE = 500
+
+
+def normalize(digest: str) -> str:
+    digest = digest.strip().lower()
+    return digest.removeprefix("sha256:")
+
+
+def digests(raw: dict[str, Any]) -> Iterator[tuple[str, str]]:
+    """
+    all (key, normalized digest) pairs in the chalkmark
+    """
+    seen = set()
+    values = [(k, raw.get(k)) for k in HASH_KEYS]
+    for k in HASH_MAP_KEYS:
+        if isinstance(raw.get(k), dict):
+            values.extend((k, v) for v in raw[k].values())
+    for k, v in values:
+        if not isinstance(v, str) or not v:
+            continue
+        v = normalize(v)
+        if (k, v) not in seen:
+            seen.add((k, v))
+            yield k, v
+
+
+def add_chalk_hashes(db: Session, chalk: models.Chalk):
+    for key, digest in digests(chalk.raw):
+        db.add(models.ChalkHash(digest=digest, metadata_id=chalk.metadata_id, key=key))
+
+
+def chunks(values: list, size: int = CHUNK_SIZE) -> Iterable[list]:
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+def resolve(db: Session, key, value, keys: list[str]) -> dict[str, list[str]]:
+    """
+    values of all rows for each found key using chunked IN queries
+    """
+    found: dict[str, list[str]] = {}
+    for chunk in chunks(sorted(set(keys))):
+        for k, v in db.query(key, value).filter(key.in_(chunk)).distinct():
+            found.setdefault(k, []).append(v)
+    return found
+
+
+def merge(results: Iterable[dict[str, list[str]]]) -> dict[str, list[str]]:
+    """
+    combine found values of several lookups such as from each shard
+    """
+    merged: dict[str, list[str]] = {}
+    for found in results:
+        for k, values in found.items():
+            existing = merged.setdefault(k, [])
+            existing.extend(i for i in values if i not in existing)
+    return merged
+
+
+def find(db: Session, digests: list[str]) -> dict[str, list[str]]:
+    """
+    metadata ids of chalkmarks for each found normalized digest
+    """
+    return resolve(db, models.ChalkHash.digest, models.ChalkHash.metadata_id, digests)
+
+
+def find_chalk_ids(db: Session, chalk_ids: list[str]) -> dict[str, list[str]]:
+    """
+    metadata ids of chalkmarks for each found CHALK_ID
+    """
+    return resolve(db, models.Chalk.chalk_id, models.Chalk.metadata_id, chalk_ids)
@@ -0,0 +1,300 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Background database maintenance.
+
+Every MAINTENANCE_INTERVAL seconds each worker tries to take the
+maintenance lease so that only one worker across all processes runs
+maintenance at a time. The lease holder then runs tasks which are due
+such as ANALYZE, PRAGMA optimize, incremental vacuum, WAL checkpoint
+and recounting counters, recording when each ran and how long it took.
+With DATABASE_SHARDS, tasks run on every shard as well.
+
+Tasks only run while ingestion is quiet. When more than
+MAINTENANCE_MAX_REPORTS reports were received in the last minute or
+their ingest lag averaged above MAINTENANCE_MAX_LAG_MS, maintenance is
+postponed with exponential backoff up to MAINTENANCE_MAX_BACKOFF.
+"""
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import secrets
+import socket
+from typing import Any, Callable, Optional
+
+import os
+from sqlalchemy import func, or_, text
+from sqlalchemy.orm import Session
+
+from . import counts, lag, metrics, shards
+from .db import models
+from .db.database import SQLITE_WAL_AUTOCHECKPOINT, SessionLocal, upsert_insert
+
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE = (os.environ.get("MAINTENANCE") or "false").lower() in {
+    "1",
+    "true",
+    "yes",
+}
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL") or 60)
+# seconds after which lease of a worker which stopped renewing it expires
+MAINTENANCE_LEASE = float(os.environ.get("MAINTENANCE_LEASE") or 600)
+MAINTENANCE_MAX_BACKOFF = float(os.environ.get("MAINTENANCE_MAX_BACKOFF") or 3600)
+# reports received in the last minute
+MAINTENANCE_MAX_REPORTS = int(os.environ.get("MAINTENANCE_MAX_REPORTS") or 1000)
+MAINTENANCE_MAX_LAG_MS = int(os.environ.get("MAINTENANCE_MAX_LAG_MS") or 1000)
+# rows ANALYZE samples per index so it stays quick on large tables
+MAINTENANCE_ANALYSIS_LIMIT = int(os.environ.get("MAINTENANCE_ANALYSIS_LIMIT") or 1000)
+MAINTENANCE_VACUUM_PAGES = int(os.environ.get("MAINTENANCE_VACUUM_PAGES") or 1000)
+
+LEASE = "maintenance"
+MINUTE = 60 * 1000
+HOUR = 60 * MINUTE
+
+holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+
+def analyze(db: Session):
+    if dialect(db) == "sqlite":
+        db.execute(text(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}"))
+    db.execute(text("ANALYZE"))
+
+
+def optimize(db: Session):
+    db.execute(text(f"PRAGMA analysis_limit={MAINTENANCE_ANALYSIS_LIMIT}"))
+    db.execute(text("PRAGMA optimize"))
+
+
+def incremental_vacuum(db: Session):
+    # sqlite3 module steps the pragma once which frees a single page
+    for _ in range(min(pragma(db, "freelist_count"), MAINTENANCE_VACUUM_PAGES)):
+        db.execute(text("PRAGMA incremental_vacuum(1)"))
+
+
+def checkpoint(db: Session):
+    db.execute(text("PRAGMA wal_checkpoint(PASSIVE)")).all()
+
+
+def reconcile(db: Session):
+    fixed = counts.reconcile(db)
+    for name, i in fixed.items():
+        logger.warning("Fixed %s count %s -> %s", name, i["stored"], i["actual"])
+
+
+def dialect(db: Session) -> str:
+    return db.get_bind().dialect.name
+
+
+def pragma(db: Session, name: str) -> Any:
+    return db.execute(text(f"PRAGMA {name}")).scalar()
+
+
+@dataclasses.dataclass()
+class Task:
+    name: str
+    # ms between runs
+    interval: int
+    run: Callable[[Session], None]
+    applies: Callable[[Session], bool] = lambda db: True
+
+
+TASKS = [
+    Task(
+        "checkpoint",
+        5 * MINUTE,
+        checkpoint,
+        # 0 leaves checkpoints to WAL shipping, see backup.py
+        lambda db: dialect(db) == "sqlite"
+        and pragma(db, "journal_mode") == "wal"
+        and SQLITE_WAL_AUTOCHECKPOINT != "0",
+    ),
+    Task("optimize", HOUR, optimize, lambda db: dialect(db) == "sqlite"),
+    Task(
+        "incremental_vacuum",
+        HOUR,
+        incremental_vacuum,
+        # only has effect with auto_vacuum=incremental
+        lambda db: dialect(db) == "sqlite" and pragma(db, "auto_vacuum") == 2,
+    ),
+    Task(
+        "analyze",
+        24 * HOUR,
+        analyze,
+        lambda db: dialect(db) in {"sqlite", "postgresql"},
+    ),
+    Task("reconcile", 24 * HOUR, reconcile, lambda db: counts.COUNTS),
+]
+
+
+def acquire(db: Session, ttl: int) -> bool:
+    """
+    take or renew lease for ttl ms. returns whether this worker holds it
+    """
+    now = lag.now_ms()
+    table = models.Lease.__table__
+    insert = upsert_insert(dialect(db))
+    statement = insert(table).values(name=LEASE, holder=holder, expires_at=now + ttl)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={
+            "holder": statement.excluded.holder,
+            "expires_at": statement.excluded.expires_at,
+        },
+        where=or_(table.c.holder == holder, table.c.expires_at < now),
+    )
+    db.execute(statement)
+    db.commit()
+    current = db.query(models.Lease.holder).filter(models.Lease.name == LEASE).scalar()
+    return current == holder
+
+
+def release(db: Session):
+    db.query(models.Lease).filter(
+        models.Lease.name == LEASE, models.Lease.holder == holder
+    ).delete()
+    db.commit()
+
+
+def recent(db: Session) -> tuple[int, Optional[float]]:
+    """
+    reports received in the last minute and their average ingest lag
+    """
+    return tuple(  # type: ignore
+        db.query(
+            func.count(),
+            func.avg(models.Report.committed_at - models.Report.received_at),
+        )
+        .filter(models.Report.received_at >= lag.now_ms() - MINUTE)
+        .one()
+    )
+
+
+def busy(db: Session) -> Optional[str]:
+    """
+    reason why ingestion is too busy for maintenance
+    """
+    found = shards.each(db, recent)
+    reports = sum(count for count, _ in found)
+    lags = [(count, avg) for count, avg in found if avg is not None]
+    lag_ms = None
+    if lags:
+        lag_ms = sum(c * a for c, a in lags) / sum(c for c, _ in lags)
+    if reports > MAINTENANCE_MAX_REPORTS:
+        return f"{reports} reports in last minute"
+    if lag_ms is not None and lag_ms > MAINTENANCE_MAX_LAG_MS:
+        return f"{lag_ms:.0f}ms average ingest lag"
+    return None
+
+
+def due(db: Session) -> list[Task]:
+    now = lag.now_ms()
+    runs = {r.task: r.started_at for r in db.query(models.MaintenanceRun)}
+    return [
+        t for t in TASKS if now - runs.get(t.name, 0) >= t.interval and t.applies(db)
+    ]
+
+
+def record(db: Session, task: Task, started_at: int, error: Optional[str]) -> int:
+    duration_ms = lag.now_ms() - started_at
+    metrics.maintenance_duration.labels(task.name).observe(duration_ms / 1000)
+    run = db.get(models.MaintenanceRun, task.name)
+    if run is None:
+        run = models.MaintenanceRun(task=task.name)
+        db.add(run)
+    run.started_at = started_at
+    run.duration_ms = duration_ms
+    run.error = error
+    db.commit()
+    return duration_ms
+
+
+def commit(run: Callable[[Session], None], db: Session):
+    run(db)
+    db.commit()
+
+
+def run_due() -> bool:
+    """
+    run due tasks if this worker holds the lease.
+    returns False when postponed as ingestion is busy
+    """
+    ttl = int(MAINTENANCE_LEASE * 1000)
+    with SessionLocal() as db:
+        if not acquire(db, ttl):
+            return True
+        for task in due(db):
+            reason = busy(db)
+            if reason is not None:
+                logger.info("Postponing maintenance: %s", reason)
+                metrics.maintenance_backoffs_total.inc()
+                return False
+            started_at = lag.now_ms()
+            error = None
+            try:
+                task.run(db)
+                db.commit()
+                if shards.shards:
+                    shards.each(db, lambda db: commit(task.run, db))
+            except Exception as e:
+                db.rollback()
+                logger.exception("Maintenance task %s failed", task.name)
+                error = str(e)
+            duration_ms = record(db, task, started_at, error)
+            logger.info("Maintenance task %s took %sms", task.name, duration_ms)
+            acquire(db, ttl)
+    return True
+
+
+async def run_periodically():
+    delay = MAINTENANCE_INTERVAL
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            quiet = await asyncio.to_thread(run_due)
+        except Exception:
+            logger.exception("Could not run maintenance")
+            quiet = True
+        if quiet:
+            delay = MAINTENANCE_INTERVAL
+        else:
+            delay = min(delay * 2, MAINTENANCE_MAX_BACKOFF)
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    if not MAINTENANCE:
+        yield
+        return
+    task = asyncio.create_task(run_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            with SessionLocal() as db:
+                release(db)
+        except Exception:
+            logger.exception("Could not release maintenance lease")
+
+
+def status(db: Session) -> dict[str, Any]:
+    runs = {r.task: r for r in db.query(models.MaintenanceRun)}
+    lease = db.get(models.Lease, LEASE)
+    tasks = {}
+    for t in TASKS:
+        run = runs.get(t.name)
+        tasks[t.name] = {
+            "interval_ms": t.interval,
+            "started_at": run.started_at if run else None,
+            "duration_ms": run.duration_ms if run else None,
+            "error": run.error if run else None,
+        }
+    return {
+        "leader": lease.holder if lease and lease.expires_at >= lag.now_ms() else None,
+        "tasks": tasks,
+    }
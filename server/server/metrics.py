@@ -0,0 +1,239 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Prometheus metrics for the server.
+
+When the server runs with multiple workers, `chalkserver run` points
+PROMETHEUS_MULTIPROC_DIR at a shared directory before workers are
+spawned so that every worker writes its samples there and /metrics
+aggregates all of them regardless of which worker serves the scrape.
+"""
+import asyncio
+import contextlib
+import resource
+import time
+
+import os
+from fastapi import APIRouter, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+MULTIPROC_DIR = "PROMETHEUS_MULTIPROC_DIR"
+
+LOOP_LAG_INTERVAL = 1.0
+
+requests_total = Counter(
+    "chalk_server_requests_total",
+    "HTTP requests by route",
+    ["method", "route", "status"],
+)
+request_duration = Histogram(
+    "chalk_server_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route"],
+)
+received_bytes = Counter(
+    "chalk_server_received_bytes_total",
+    "HTTP request body bytes received by route",
+    ["method", "route"],
+)
+reports_per_request = Histogram(
+    "chalk_server_reports_per_request",
+    "Number of reports in a single /report request",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+chalks_per_request = Histogram(
+    "chalk_server_chalks_per_request",
+    "Number of chalk marks in a single /report request",
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+db_commit_duration = Histogram(
+    "chalk_server_db_commit_duration_seconds",
+    "Time spent committing ingestion transactions",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+duplicates_total = Counter(
+    "chalk_server_duplicate_reports_total",
+    "/report requests rejected because chalk marks already exist",
+)
+shard_reports_total = Counter(
+    "chalk_server_shard_reports_total",
+    "Reports stored in each shard when DATABASE_SHARDS is set",
+    ["shard"],
+)
+rollbacks_total = Counter(
+    "chalk_server_db_rollbacks_total",
+    "Ingestion transactions which were rolled back",
+    ["reason"],
+)
+dropped_logs_total = Counter(
+    "chalk_server_dropped_logs_total",
+    "Log records dropped to avoid slowing down requests",
+    ["reason"],
+)
+cache_requests_total = Counter(
+    "chalk_server_cache_requests_total",
+    "Chalkmark response cache lookups",
+    ["result"],
+)
+live_dropped_total = Counter(
+    "chalk_server_live_dropped_total",
+    "/reports/live subscribers dropped for not keeping up",
+)
+maintenance_duration = Histogram(
+    "chalk_server_maintenance_duration_seconds",
+    "Time spent running database maintenance tasks",
+    ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+maintenance_backoffs_total = Counter(
+    "chalk_server_maintenance_backoffs_total",
+    "Maintenance runs postponed because ingestion was busy",
+)
+report_lag = Histogram(
+    "chalk_server_report_lag_seconds",
+    "Time from chalk operation (_TIMESTAMP) to report being received/committed",
+    ["operation", "stage"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400),
+)
+loop_lag = Histogram(
+    "chalk_server_event_loop_lag_seconds",
+    "How late the event loop wakes up a sleeping task",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+worker_rss = Gauge(
+    "chalk_server_worker_resident_memory_bytes",
+    "Resident memory of the worker process",
+    multiprocess_mode="liveall",
+)
+
+
+# operations are sent by clients so only known ones are used as labels
+OPERATIONS = {
+    "build",
+    "delete",
+    "docker",
+    "dump",
+    "env",
+    "exec",
+    "extract",
+    "heartbeat",
+    "insert",
+    "load",
+    "push",
+    "setup",
+}
+
+
+def operation_label(operation: str) -> str:
+    return operation if operation in OPERATIONS else "other"
+
+
+def is_multiprocess() -> bool:
+    return MULTIPROC_DIR in os.environ
+
+
+def prepare_multiprocess(path: str):
+    """
+    must be called before workers are started as prometheus client
+    decides whether to use shared storage at import time
+    """
+    os.makedirs(path, exist_ok=True)
+    # stale samples from previous runs would be aggregated otherwise
+    for i in os.listdir(path):
+        if i.endswith(".db"):
+            os.remove(os.path.join(path, i))
+    os.environ[MULTIPROC_DIR] = path
+
+
+def rss() -> int:
+    try:
+        with open("/proc/self/statm") as fid:
+            return int(fid.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # not linux. best we can do is peak rss which is in KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def watch_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(loop.time() - start - LOOP_LAG_INTERVAL, 0))
+        worker_rss.set(rss())
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    task = asyncio.create_task(watch_loop())
+    try:
+        yield
+    finally:
+        task.cancel()
+        if is_multiprocess():
+            multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """
+    pure ASGI middleware as BaseHTTPMiddleware adds noticeable
+    overhead to every request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def counting_receive():
+            nonlocal size
+            message = await receive()
+            size += len(message.get("body", b""))
+            return message
+
+        async def status_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, status_send)
+        finally:
+            method = scope["method"]
+            # use route template to keep label cardinality bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            requests_total.labels(method, route, status).inc()
+            request_duration.labels(method, route).observe(time.perf_counter() - start)
+            if size:
+                received_bytes.labels(method, route).inc(size)
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+def get_metrics():
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,36 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Documents are already stored as serialized JSON so full documents are
+selected as text and spliced into response body as is without
+decoding and re-encoding them.
+"""
+from typing import Iterable
+
+from fastapi import Request, Response
+from sqlalchemy import Text, cast
+
+NDJSON = "application/x-ndjson"
+
+
+def text(column):
+    """
+    select JSON column as its stored text which skips JSON result processing
+    """
+    return cast(column, Text)
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get("accept", "")
+
+
+def response(request: Request, documents: Iterable[str]) -> Response:
+    """
+    JSON list of documents or NDJSON when requested via Accept header
+    """
+    if wants_ndjson(request):
+        content = "".join(f"{i}\n" for i in documents)
+        return Response(content.encode(), media_type=NDJSON)
+    return Response(f"[{','.join(documents)}]".encode(), media_type="application/json")
@@ -0,0 +1,150 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Opt-in sampling profiler for individual requests.
+
+Enabled by PROFILE_DIR. Requests are profiled when they send
+X-Chalk-Profile header or are randomly picked by PROFILE_SAMPLE_RATE.
+Profiles are saved in collapsed-stack format which can be opened by
+speedscope or flamegraph.pl.
+
+When PROFILE_DIR is not set, middleware is not installed at all.
+"""
+import asyncio
+import collections
+import random
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import os
+
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS") or 5)
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP") or 100)
+
+HEADER = b"x-chalk-profile"
+SUFFIX = ".collapsed"
+
+_unsafe = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+class Sampler(threading.Thread):
+    """
+    periodically samples stack of another thread and counts unique stacks
+    """
+
+    def __init__(self, target: int, interval: float):
+        super().__init__(daemon=True)
+        self.target = target
+        self.interval = interval
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                # ; separates frames in collapsed format
+                name = f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+                stack.append(name.replace(";", ":"))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.join()
+        return "".join(f"{k} {v}\n" for k, v in self.stacks.items())
+
+
+def directory() -> Path:
+    assert PROFILE_DIR
+    return Path(PROFILE_DIR).absolute()
+
+
+def save(name: str, collapsed: str):
+    path = directory()
+    path.mkdir(parents=True, exist_ok=True)
+    (path / name).write_text(collapsed)
+    profiles = sorted(path.glob(f"*{SUFFIX}"), key=lambda i: i.stat().st_mtime)
+    for i in profiles[:-PROFILE_KEEP]:
+        i.unlink(missing_ok=True)
+
+
+def list_profiles() -> list[dict]:
+    path = directory()
+    if not path.is_dir():
+        return []
+    profiles = []
+    for i in sorted(path.glob(f"*{SUFFIX}"), reverse=True):
+        stat = i.stat()
+        profiles.append({"name": i.name, "size": stat.st_size, "mtime": stat.st_mtime})
+    return profiles
+
+
+def get_profile(name: str) -> Optional[Path]:
+    path = directory() / name
+    # dont allow escaping profile directory
+    if path.name != name or not name.endswith(SUFFIX) or not path.is_file():
+        return None
+    return path
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.active = False
+
+    def should_profile(self, scope) -> bool:
+        if self.active or scope["type"] != "http":
+            return False
+        if any(k == HEADER for k, _ in scope["headers"]):
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if not self.should_profile(scope):
+            return await self.app(scope, receive, send)
+
+        # concurrent requests on the same loop would show up in the same
+        # samples anyway so only profile one request at a time
+        self.active = True
+        path = _unsafe.sub("_", scope["path"].strip("/"))[:64] or "root"
+        name = "-".join(
+            [
+                time.strftime("%Y%m%dT%H%M%S"),
+                f"{time.time_ns() % 1_000_000_000:09d}",
+                str(os.getpid()),
+                scope["method"],
+                path,
+            ]
+        )
+        name += SUFFIX
+        sampler = Sampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+
+        async def header_send(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-chalk-profile-id", name.encode()),
+                ]
+            await send(message)
+
+        sampler.start()
+        try:
+            await self.app(scope, receive, header_send)
+        finally:
+            # joining waits up to an interval so it is not done on the loop
+            collapsed = await asyncio.to_thread(sampler.stop)
+            self.active = False
+            await asyncio.to_thread(save, name, collapsed)
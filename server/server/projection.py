@@ -0,0 +1,55 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Field projection which extracts only requested keys in SQL
+so that full documents are not loaded for a few keys.
+"""
+from typing import Any
+
+from fastapi import HTTPException, Query
+from sqlalchemy import func
+
+from .filters import json_path, parse_path
+
+
+class Fields:
+    def __init__(
+        self,
+        fields: list[str] = Query(
+            [],
+            description=(
+                "comma-separated dot-separated paths of keys to return. "
+                "when not provided full documents are returned"
+            ),
+        ),
+    ):
+        self.fields = [f for i in fields for f in i.split(",") if f]
+        self.paths = [parse_path(f) for f in self.fields]
+        if any("*" in p for p in self.paths):
+            raise HTTPException(status_code=400, detail="* is not supported in fields")
+
+    def __bool__(self):
+        return bool(self.fields)
+
+    def columns(self, dialect: str, document) -> list:
+        """
+        value and JSON type of each path. both JSON null and missing keys
+        are extracted as None but only missing keys have no type
+        """
+        columns = []
+        for p in self.paths:
+            if dialect == "sqlite":
+                json_type = func.json_type(document, json_path(p))
+            else:
+                json_type = func.json_typeof(document[p])
+            columns.extend([document[p], json_type])
+        return columns
+
+    def row(self, values) -> dict[str, Any]:
+        return {
+            f: values[2 * i]
+            for i, f in enumerate(self.fields)
+            if values[2 * i + 1] is not None
+        }
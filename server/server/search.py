@@ -0,0 +1,202 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Full-text search over reports and chalkmarks.
+
+At ingest, values of SEARCH_FIELDS are concatenated into a document per
+report and per chalkmark which is indexed by SQLite FTS5 or PostgreSQL
+tsvector, the only databases the server supports. Setting SEARCH_FIELDS
+to empty disables search.
+"""
+from typing import Any, Iterable, Optional
+
+import os
+from fastapi import HTTPException
+from sqlalchemy import (
+    Column,
+    Engine,
+    MetaData,
+    String,
+    Table,
+    Text,
+    exc,
+    inspect,
+    text,
+)
+from sqlalchemy.orm import Session
+
+
+DEFAULT_SEARCH_FIELDS = [
+    "CHALK_ID",
+    "METADATA_ID",
+    "ARTIFACT_TYPE",
+    "PATH_WHEN_CHALKED",
+    "_OP_ARTIFACT_PATH",
+    "ORIGIN_URI",
+    "BRANCH",
+    "TAG",
+    "COMMIT_ID",
+    "COMMIT_MESSAGE",
+    "AUTHOR",
+    "DOCKER_TAGS",
+    "_REPO_TAGS",
+    "_OP_HOSTNAME",
+    "_OP_ERRORS",
+]
+# set to empty to disable search
+SEARCH_FIELDS = [
+    i.strip()
+    for i in os.environ.get("SEARCH_FIELDS", ",".join(DEFAULT_SEARCH_FIELDS)).split(",")
+    if i.strip()
+]
+DISABLED = "Search is disabled. Set SEARCH_FIELDS and run reindex"
+
+# not part of Base metadata as it is created per dialect by create().
+# only used to insert and delete rows
+search_index = Table(
+    "search_index",
+    MetaData(),
+    Column("kind", String),  # report or chalk
+    Column("ref", String),  # report id or metadata id
+    Column("content", Text),
+)
+
+# databases which have search_index
+_available: set[Engine] = set()
+
+
+def create(engine: Engine):
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.execute(
+                text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index "
+                    "USING fts5(kind UNINDEXED, ref UNINDEXED, content)"
+                )
+            )
+        else:
+            conn.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS search_index ("
+                    "kind VARCHAR, ref VARCHAR, content TEXT, "
+                    "document TSVECTOR GENERATED ALWAYS AS "
+                    "(to_tsvector('simple', content)) STORED)"
+                )
+            )
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_search_index_document "
+                    "ON search_index USING GIN (document)"
+                )
+            )
+    _available.add(engine)
+
+
+def available(db: Session) -> bool:
+    """
+    whether search_index exists in the database of the session.
+    reports are stored without indexing them when it could not be created
+    """
+    bind = db.get_bind()
+    if bind not in _available and inspect(db.connection()).has_table(search_index.name):
+        _available.add(bind)
+    return bind in _available
+
+
+def values(value: Any) -> Iterable[str]:
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield str(value)
+    elif isinstance(value, list):
+        for i in value:
+            yield from values(i)
+
+
+def content(raw: dict[str, Any]) -> str:
+    """
+    searchable text of the document including any of its _CHALKS
+    """
+    found: dict[str, None] = {}
+    documents = [raw]
+    if isinstance(raw.get("_CHALKS"), list):
+        documents.extend(i for i in raw["_CHALKS"] if isinstance(i, dict))
+    for document in documents:
+        for field in SEARCH_FIELDS:
+            for value in values(document.get(field)):
+                found[value] = None
+    return "\n".join(found)
+
+
+def add(db: Session, documents: list[tuple[str, str, dict[str, Any]]]):
+    """
+    index (kind, ref, raw) documents
+    """
+    rows = []
+    for kind, ref, raw in documents:
+        body = content(raw)
+        if body:
+            rows.append({"kind": kind, "ref": ref, "content": body})
+    if rows:
+        db.execute(search_index.insert(), rows)
+
+
+def clear(db: Session):
+    db.execute(search_index.delete())
+
+
+def fts5_query(q: str) -> str:
+    """
+    quote each term so that user input is not parsed as FTS5 syntax.
+    trailing * is kept for prefix search
+    """
+    terms = []
+    for term in q.split():
+        prefix = term.endswith("*") and len(term) > 1
+        term = term.rstrip("*")
+        if not term:
+            continue
+        quoted = '"' + term.replace('"', '""') + '"'
+        terms.append(quoted + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def find(
+    db: Session,
+    q: str,
+    kind: Optional[str],
+    limit: int,
+    offset: int,
+) -> list[tuple[str, str, float]]:
+    """
+    (kind, ref, rank) of matching documents, best matches first
+    """
+    params: dict[str, Any] = {"kind": kind, "limit": limit, "offset": offset}
+    kind_filter = "AND kind = :kind" if kind else ""
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        params["q"] = fts5_query(q)
+        if not params["q"]:
+            raise HTTPException(status_code=400, detail="Empty search query")
+        # bm25 is lower for better matches
+        sql = (
+            "SELECT kind, ref, -bm25(search_index) AS rank FROM search_index "
+            f"WHERE search_index MATCH :q {kind_filter} "
+            "ORDER BY bm25(search_index) LIMIT :limit OFFSET :offset"
+        )
+    else:
+        params["q"] = q
+        sql = (
+            "SELECT kind, ref, ts_rank(document, query) AS rank "
+            "FROM search_index, websearch_to_tsquery('simple', :q) query "
+            f"WHERE document @@ query {kind_filter} "
+            "ORDER BY rank DESC LIMIT :limit OFFSET :offset"
+        )
+    try:
+        return [tuple(i) for i in db.execute(text(sql), params)]  # type: ignore
+    except exc.DBAPIError as e:
+        # such as invalid FTS5 query
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
@@ -0,0 +1,368 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Optional sharding of reports and chalks across several databases.
+
+When DATABASE_SHARDS is set to comma-separated database URLs, each
+report is stored in one shard picked by a hash of the CHALK_ID of its
+first chalkmark, or of its _ACTION_ID when it has none, together with
+its chalkmarks and everything derived from them at ingest (hash lookup,
+counters, inventory, lineage and search). Exec and heartbeat reports of
+a chalkmark therefore land in the same shard as the report which
+created it. Each shard is a separate SQLite write lock so requests do
+not queue behind each other's commits. Pings, usage stats and maintenance
+state stay in DATABASE_URL.
+
+Reports of one /report request are stored in a transaction per shard,
+all shards in parallel. Shards only commit once every shard stored its
+reports so a request which fails validation stores nothing. Lookups by
+CHALK_ID go to its shard first and only query other shards for CHALK_IDs
+which were not found there, such as ones which were not first in their
+report. The shard of each stored chalkmark is recorded in DATABASE_URL
+once its shard commits so lookups by METADATA_ID go to that shard only.
+Chalkmarks whose shard is not recorded, such as when recording failed,
+are looked up in all shards. Everything else queries all shards in
+parallel and merges results.
+
+Report ids are per shard so /changes and /export are not supported.
+The number and order of shards cannot change once reports are stored.
+"""
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import logging
+from typing import Any, Callable, Optional, TypeVar
+
+import os
+from sqlalchemy.orm import Query, Session
+
+from . import counts, ingest, lookup, metrics
+from .db import models
+from .db.database import SessionLocal, connect, sessions, upsert_insert
+
+
+logger = logging.getLogger(__name__)
+
+DATABASE_SHARDS = [
+    i.strip() for i in (os.environ.get("DATABASE_SHARDS") or "").split(",") if i.strip()
+]
+
+engines = [connect(i) for i in DATABASE_SHARDS]
+shards = [sessions(i) for i in engines]
+# concurrent requests share the pool, each fanning out to every shard
+pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4 * len(shards) or 1, thread_name_prefix="chalkserver-shard"
+)
+
+UNSUPPORTED = "Not supported with DATABASE_SHARDS"
+
+T = TypeVar("T")
+
+
+def index(key: str) -> int:
+    """
+    shard of the key. stable across processes unlike hash()
+    """
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % len(shards)
+
+
+def routing_key(report: dict[str, Any]) -> str:
+    chalks = report.get("_CHALKS")
+    if isinstance(chalks, list):
+        for chalk in chalks:
+            if isinstance(chalk, dict) and isinstance(chalk.get("CHALK_ID"), str):
+                return chalk["CHALK_ID"]
+            break
+    action_id = report.get("_ACTION_ID")
+    return action_id if isinstance(action_id, str) else ""
+
+
+def split(reports: list[dict[str, Any]]) -> dict[int, list[dict[str, Any]]]:
+    groups: dict[int, list[dict[str, Any]]] = {}
+    for report in reports:
+        groups.setdefault(index(routing_key(report)), []).append(report)
+    return groups
+
+
+def run(shard: int, fn: Callable[[Session], T]) -> T:
+    with shards[shard]() as db:
+        return fn(db)
+
+
+def fan_out(calls: dict[int, Callable[[Session], T]]) -> dict[int, T]:
+    """
+    call each function with a session of its shard in parallel.
+    raises first error after all calls finished
+    """
+    futures = {i: pool.submit(run, i, fn) for i, fn in calls.items()}
+    concurrent.futures.wait(futures.values())
+    return {i: f.result() for i, f in futures.items()}
+
+
+def each(db: Session, fn: Callable[[Session], T]) -> list[T]:
+    """
+    results of fn for every shard or just for db when not sharded
+    """
+    if not shards:
+        return [fn(db)]
+    return list(fan_out({i: fn for i in range(len(shards))}).values())
+
+
+class PartiallyStored(Exception):
+    """
+    commit of some shards failed after other shards committed
+    """
+
+    def __init__(self, stored: list[ingest.Stored], reports: list[int], error: str):
+        super().__init__(error)
+        self.stored = stored
+        # positions of reports in the request which were stored
+        self.reports = reports
+
+
+def store(reports: list[dict[str, Any]], received_at: int) -> list[ingest.Stored]:
+    """
+    store and commit reports in their shards. reports of every shard are
+    stored and flushed before any shard commits so invalid reports or
+    duplicate chalks raise and store nothing, the same as without shards.
+    raises PartiallyStored when only some of the commits fail
+    """
+    groups = split(reports)
+    if len(groups) == 1:
+        # such as a single report. no need to hand it over to the pool
+        [(shard, group)] = groups.items()
+        stored = run(shard, lambda db: commit(db, ingest.store(db, group, received_at)))
+        metrics.shard_reports_total.labels(str(shard)).inc(len(group))
+        locate({shard: stored.metadata_ids})
+        return [stored]
+    sessions = {i: shards[i]() for i in groups}
+    try:
+        staged = {
+            i: pool.submit(ingest.store, sessions[i], group, received_at)
+            for i, group in groups.items()
+        }
+        concurrent.futures.wait(staged.values())
+        # raises first error. sessions of all shards are rolled back on close
+        stored = {i: f.result() for i, f in staged.items()}
+        committed = {i: pool.submit(commit, sessions[i], stored[i]) for i in groups}
+        concurrent.futures.wait(committed.values())
+    finally:
+        for db in sessions.values():
+            db.close()
+    errors = {i: f.exception() for i, f in committed.items() if f.exception()}
+    for i in groups:
+        if i not in errors:
+            metrics.shard_reports_total.labels(str(i)).inc(len(groups[i]))
+    locate({i: stored[i].metadata_ids for i in groups if i not in errors})
+    if errors:
+        raise PartiallyStored(
+            [stored[i] for i in groups if i not in errors],
+            [n for n, r in enumerate(reports) if index(routing_key(r)) not in errors],
+            "; ".join(f"shard {i}: {e}" for i, e in sorted(errors.items())),
+        )
+    return list(stored.values())
+
+
+def commit(db: Session, stored: ingest.Stored) -> ingest.Stored:
+    with metrics.db_commit_duration.time():
+        db.commit()
+    ingest.stamp(db, [stored])
+    return stored
+
+
+def locate(metadata_ids: dict[int, list[str]]):
+    """
+    record shard of committed chalkmarks. chalkmarks which are not
+    recorded when this fails are still found by looking in every shard
+    """
+    rows = [
+        {"metadata_id": i, "shard": shard}
+        for shard, ids in metadata_ids.items()
+        for i in ids
+    ]
+    if not rows:
+        return
+    table = models.ChalkShard.__table__
+    try:
+        with SessionLocal() as db:
+            insert = upsert_insert(db.get_bind().dialect.name)
+            for chunk in lookup.chunks(rows, lookup.CHUNK_SIZE // 2):
+                db.execute(insert(table).values(chunk).on_conflict_do_nothing())
+            db.commit()
+    except Exception:
+        logger.exception("Could not record shards of chalkmarks")
+
+
+def locate_all(shard: int, batch_size: int = 1000):
+    """
+    record shard of every chalkmark stored in the shard,
+    such as ones stored before shards were recorded
+    """
+    with shards[shard]() as db:
+        batch = []
+        for (i,) in db.query(models.Chalk.metadata_id).yield_per(batch_size):
+            batch.append(i)
+            if len(batch) >= batch_size:
+                locate({shard: batch})
+                batch = []
+        locate({shard: batch})
+
+
+def homes(db: Session, metadata_ids: list[str]) -> dict[int, list[str]]:
+    """
+    metadata ids to look up in each shard. in their recorded shard
+    or in every shard when it is not recorded
+    """
+    recorded: dict[str, int] = {}
+    for chunk in lookup.chunks(sorted(set(metadata_ids))):
+        recorded.update(
+            db.query(models.ChalkShard.metadata_id, models.ChalkShard.shard).filter(
+                models.ChalkShard.metadata_id.in_(chunk)
+            )
+        )
+    found: dict[int, list[str]] = {}
+    for i in metadata_ids:
+        shard = recorded.get(i)
+        for home in [shard] if shard in range(len(shards)) else range(len(shards)):
+            found.setdefault(home, []).append(i)
+    return found
+
+
+def by_metadata_id(
+    db: Session,
+    metadata_ids: list[str],
+    fn: Callable[[Session, list[str]], T],
+) -> list[T]:
+    """
+    results of fn for metadata ids of each shard which can store them
+    or for all of them in db when not sharded
+    """
+    if not shards:
+        return [fn(db, metadata_ids)]
+    return list(
+        fan_out(
+            {
+                shard: lambda db, ids=ids: fn(db, ids)
+                for shard, ids in homes(db, metadata_ids).items()
+            }
+        ).values()
+    )
+
+
+def rows(
+    db: Session,
+    query: Callable[[Session], Query],
+    order_by: list,
+    key: Callable[[Any], Any],
+    limit: Optional[int],
+    offset: Optional[int],
+    ordered: bool = False,
+) -> list:
+    """
+    rows of the query ordered by order_by when paginated by limit or offset
+    or when ordered. when sharded, each shard returns up to offset + limit
+    rows in order which are merged by key which must sort the same as order_by
+    """
+    ordered = ordered or limit is not None or offset is not None
+    if not shards:
+        q = query(db)
+        if ordered:
+            q = q.order_by(*order_by).limit(limit).offset(offset)
+        return q.all()
+
+    def page(db: Session) -> list:
+        q = query(db)
+        if ordered:
+            q = q.order_by(*order_by)
+        if limit is not None:
+            q = q.limit(limit + (offset or 0))
+        return q.all()
+
+    results = each(db, page)
+    if not ordered:
+        return [i for result in results for i in result]
+    merged = heapq.merge(*results, key=key)
+    start = offset or 0
+    return list(
+        itertools.islice(merged, start, None if limit is None else start + limit)
+    )
+
+
+def first(db: Session, fn: Callable[[Session], Optional[T]]) -> Optional[T]:
+    """
+    first result which is not None, such as of a lookup which can be in
+    any shard
+    """
+    return next((i for i in each(db, fn) if i is not None), None)
+
+
+def point(
+    db: Session, metadata_id: str, fn: Callable[[Session], Optional[T]]
+) -> Optional[T]:
+    """
+    result of fn in the shard of the chalkmark when it is recorded
+    or first result which is not None of any shard
+    """
+    return next(
+        (
+            i
+            for i in by_metadata_id(db, [metadata_id], lambda db, _: fn(db))
+            if i is not None
+        ),
+        None,
+    )
+
+
+def find_chalk_ids(db: Session, chalk_ids: list[str]) -> dict[str, list[str]]:
+    """
+    metadata ids of chalkmarks for each found CHALK_ID.
+    looked up in the shard of each CHALK_ID before any other shard
+    """
+    if not shards:
+        return lookup.find_chalk_ids(db, chalk_ids)
+    homes: dict[int, list[str]] = {}
+    for i in chalk_ids:
+        homes.setdefault(index(i), []).append(i)
+    found = lookup.merge(
+        fan_out(
+            {
+                shard: lambda db, ids=ids: lookup.find_chalk_ids(db, ids)
+                for shard, ids in homes.items()
+            }
+        ).values()
+    )
+    missing = [i for i in chalk_ids if i not in found]
+    if not missing:
+        return found
+    elsewhere = fan_out(
+        {
+            shard: lambda db, ids=ids: lookup.find_chalk_ids(db, ids)
+            for shard in range(len(shards))
+            if (ids := [i for i in missing if index(i) != shard])
+        }
+    )
+    return lookup.merge([found, *elsewhere.values()])
+
+
+def reconcile(db: Session) -> dict[str, Any]:
+    """
+    reconcile and commit counters of every shard or of db when not sharded.
+    returns counters which were fixed summed over shards
+    """
+
+    def commit(db: Session) -> dict[str, Any]:
+        fixed = counts.reconcile(db)
+        db.commit()
+        return fixed
+
+    fixed: dict[str, Any] = {}
+    for shard in each(db, commit):
+        for name, i in shard.items():
+            total = fixed.setdefault(name, {"stored": 0, "actual": 0})
+            total["stored"] += i["stored"]
+            total["actual"] += i["actual"]
+    return fixed
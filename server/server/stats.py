@@ -0,0 +1,244 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Usage stats from /ping beacons.
+
+Pings are counted in memory per minute and (operation, version, commit,
+platform) and are periodically flushed to stat_counts as upserts which
+add to existing counts, so pinging is a dict increment rather than a
+database insert. Storing each ping in stats as well is opt-in (STATS_RAW).
+
+Summaries are aggregated from stat_counts by the database and cached
+per worker. Cache entries are keyed by the latest flush time so a flush
+from any worker invalidates them.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import threading
+from typing import Any, Optional
+
+import os
+from fastapi import HTTPException, Query
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import lag, lookup
+from .db import models, schemas
+from .db.database import SessionLocal, upsert_insert
+
+
+logger = logging.getLogger(__name__)
+
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL") or 10)
+# store every ping in stats table as well
+STATS_RAW = (os.environ.get("STATS_RAW") or "false").lower() in {"1", "true", "yes"}
+
+MINUTE = 60 * 1000
+GROUP_BY = {
+    c.name: c
+    for c in [
+        models.StatCount.operation,
+        models.StatCount.op_chalker_version,
+        models.StatCount.op_chalker_commit_id,
+        models.StatCount.op_platform,
+    ]
+}
+BUCKETS = {
+    "minute": MINUTE,
+    "hour": 60 * MINUTE,
+    "day": 24 * 60 * MINUTE,
+}
+CACHE_SIZE = 256
+
+_cache: collections.OrderedDict[tuple, list[dict[str, Any]]] = collections.OrderedDict()
+_lock = threading.Lock()
+
+Key = tuple[int, str, str, str, str]
+
+
+class Counters:
+    def __init__(self):
+        # key -> [count, chalks]
+        self.counts: dict[Key, list[int]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, stats: list[schemas.Stat]):
+        with self.lock:
+            for s in stats:
+                key = (
+                    s.timestamp // MINUTE * MINUTE,
+                    s.operation,
+                    s.op_chalker_version,
+                    s.op_chalker_commit_id,
+                    s.op_platform,
+                )
+                counts = self.counts.setdefault(key, [0, 0])
+                counts[0] += 1
+                counts[1] += s.op_chalk_count
+
+    def take(self) -> dict[Key, list[int]]:
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def restore(self, counts: dict[Key, list[int]]):
+        with self.lock:
+            for key, (count, chalks) in counts.items():
+                existing = self.counts.setdefault(key, [0, 0])
+                existing[0] += count
+                existing[1] += chalks
+
+    def flush(self):
+        counts = self.take()
+        if not counts:
+            return
+        try:
+            with SessionLocal() as db:
+                add_counts(db, counts)
+                db.commit()
+        except Exception:
+            # keep counts to retry on next flush
+            self.restore(counts)
+            raise
+
+
+counters = Counters()
+
+
+def add_counts(db: Session, counts: dict[Key, list[int]]):
+    table = models.StatCount.__table__
+    updated_at = lag.now_ms()
+    rows = [
+        {
+            "minute": minute,
+            "operation": operation,
+            "op_chalker_version": version,
+            "op_chalker_commit_id": commit,
+            "op_platform": platform,
+            "count": count,
+            "chalks": chalks,
+            "updated_at": updated_at,
+        }
+        for (minute, operation, version, commit, platform), (count, chalks) in sorted(
+            counts.items()
+        )
+    ]
+    insert = upsert_insert(db.get_bind().dialect.name)
+    for chunk in lookup.chunks(rows, lookup.CHUNK_SIZE // len(table.columns)):
+        statement = insert(table).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(table.primary_key),
+            set_={
+                "count": table.c.count + statement.excluded.count,
+                "chalks": table.c.chalks + statement.excluded.chalks,
+                "updated_at": statement.excluded.updated_at,
+            },
+        )
+        db.execute(statement)
+
+
+def backfill(db: Session, batch_size: int = 1000):
+    """
+    count stats stored before stat_counts was added
+    """
+    if db.query(models.StatCount).first() is not None:
+        return
+    backfilled = Counters()
+    for row in db.query(models.Stat).yield_per(batch_size):
+        backfilled.add([schemas.Stat.model_validate(vars(row))])
+    add_counts(db, backfilled.take())
+
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(counters.flush)
+        except Exception:
+            logger.exception("Could not flush ping counters")
+
+
+@contextlib.asynccontextmanager
+async def lifespan():
+    task = asyncio.create_task(flush_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            counters.flush()
+        except Exception:
+            logger.exception("Could not flush ping counters")
+
+
+class Summary:
+    def __init__(
+        self,
+        group_by: list[str] = Query(
+            [], description=f"comma-separated any of {', '.join(GROUP_BY)}"
+        ),
+        bucket: Optional[str] = Query(
+            None, description=f"_TIMESTAMP bucket, one of {', '.join(BUCKETS)}"
+        ),
+        since: Optional[int] = Query(None, description="_TIMESTAMP >= ms"),
+        until: Optional[int] = Query(None, description="_TIMESTAMP < ms"),
+    ):
+        self.group_by = [g for i in group_by for g in i.split(",") if g]
+        unknown = [i for i in self.group_by if i not in GROUP_BY]
+        if unknown:
+            raise HTTPException(
+                status_code=400, detail=f"Cannot group by: {', '.join(unknown)}"
+            )
+        if bucket is not None and bucket not in BUCKETS:
+            raise HTTPException(status_code=400, detail=f"Invalid bucket: {bucket}")
+        self.bucket = bucket
+        self.since = since
+        self.until = until
+
+    def key(self) -> tuple:
+        return (tuple(self.group_by), self.bucket, self.since, self.until)
+
+
+def version(db: Session) -> Any:
+    """
+    changes whenever counts are flushed
+    """
+    return db.query(func.max(models.StatCount.updated_at)).scalar()
+
+
+def query(db: Session, summary: Summary) -> list[dict[str, Any]]:
+    columns = [GROUP_BY[i].label(i) for i in summary.group_by]
+    if summary.bucket is not None:
+        size = BUCKETS[summary.bucket]
+        columns.append(((models.StatCount.minute // size) * size).label("bucket"))
+    rows = db.query(
+        *columns,
+        func.coalesce(func.sum(models.StatCount.count), 0).label("count"),
+        func.coalesce(func.sum(models.StatCount.chalks), 0).label("chalks"),
+    )
+    # counts are per minute so time range is rounded to minutes
+    if summary.since is not None:
+        rows = rows.filter(models.StatCount.minute >= summary.since)
+    if summary.until is not None:
+        rows = rows.filter(models.StatCount.minute < summary.until)
+    if columns:
+        rows = rows.group_by(*columns).order_by(*columns)
+    return [row._asdict() for row in rows]
+
+
+def summarize(db: Session, summary: Summary) -> list[dict[str, Any]]:
+    key = (version(db), *summary.key())
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = query(db, summary)
+    with _lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
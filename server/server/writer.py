@@ -0,0 +1,190 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Optional single writer process for multi-worker deployments.
+
+With `run --single-writer`, request workers do not write reports to the
+database themselves. They forward validated reports over a Unix socket
+(WRITER_SOCKET) to one writer process which owns the only writing
+connection. The writer stores requests which arrive together in one
+transaction (group commit) of up to WRITER_BATCH requests, optionally
+waiting WRITER_LINGER_MS for more to arrive. If any request in a group
+fails, such as with duplicate chalks, the group is rolled back and its
+requests are retried in a transaction each so every request gets the
+same response it would get otherwise.
+
+Workers keep reading directly from the database. Only /report goes
+through the writer.
+
+Messages are 4-byte big-endian length followed by JSON.
+"""
+import asyncio
+import json
+import logging
+import signal
+import struct
+from pathlib import Path
+from typing import Any, Optional
+
+import os
+import sqlalchemy
+from fastapi import HTTPException
+
+from . import analytics, ingest, metrics
+from .db.database import SessionLocal
+from .log import config
+
+
+logger = logging.getLogger(__name__)
+
+WRITER_SOCKET = os.environ.get("WRITER_SOCKET")
+WRITER_BATCH = int(os.environ.get("WRITER_BATCH") or 64)
+WRITER_LINGER_MS = float(os.environ.get("WRITER_LINGER_MS") or 0)
+
+LENGTH = struct.Struct(">I")
+
+Request = tuple[list[dict[str, Any]], int]
+Response = tuple[int, Optional[str]]
+
+
+async def send(stream: asyncio.StreamWriter, message: Any):
+    data = json.dumps(message).encode()
+    stream.write(LENGTH.pack(len(data)) + data)
+    await stream.drain()
+
+
+async def receive(stream: asyncio.StreamReader) -> Any:
+    (length,) = LENGTH.unpack(await stream.readexactly(LENGTH.size))
+    return json.loads(await stream.readexactly(length))
+
+
+async def submit(reports: list[dict[str, Any]], received_at: int) -> Response:
+    """
+    store reports via writer process. returns (status code, detail)
+    """
+    assert WRITER_SOCKET
+    try:
+        reader, writer = await asyncio.open_unix_connection(WRITER_SOCKET)
+        try:
+            await send(writer, {"reports": reports, "received_at": received_at})
+            response = await receive(reader)
+        finally:
+            writer.close()
+    except (OSError, asyncio.IncompleteReadError) as e:
+        logger.error("Could not submit reports to writer: %r", e)
+        return 503, "Writer is unavailable"
+    return response["status"], response["detail"]
+
+
+def outcome(error: Exception) -> Response:
+    """
+    response for failed request, same as /report without the writer
+    """
+    if isinstance(
+        error, (sqlalchemy.exc.IntegrityError, sqlalchemy.exc.PendingRollbackError)
+    ):
+        metrics.duplicates_total.inc()
+        metrics.rollbacks_total.labels(type(error).__name__).inc()
+        logger.warning("Duplicate chalks %s", error)
+        return 202, None
+    if isinstance(error, KeyError):
+        return 400, f"Chalk missing: {error}"
+    if isinstance(error, HTTPException):
+        return error.status_code, error.detail
+    metrics.rollbacks_total.labels(type(error).__name__).inc()
+    logger.error("report", exc_info=error)
+    return 500, "Unhandled data"
+
+
+def commit(requests: list[Request]) -> list[tuple[Response, Optional[ingest.Stored]]]:
+    """
+    store requests in one transaction
+    or each in its own transaction if any of them fails
+    """
+    with SessionLocal() as db:
+        try:
+            stored = [ingest.store(db, *r) for r in requests]
+            with metrics.db_commit_duration.time():
+                db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(requests) == 1:
+                return [(outcome(e), None)]
+        else:
+            ingest.stamp(db, stored)
+            return [((200, None), i) for i in stored]
+    return [commit([r])[0] for r in requests]
+
+
+class Writer:
+    def __init__(self):
+        self.queue: asyncio.Queue[tuple[Request, asyncio.Future]] = asyncio.Queue()
+        self.committing = False
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await receive(reader)
+                except asyncio.IncompleteReadError:
+                    return
+                future = asyncio.get_running_loop().create_future()
+                await self.queue.put(
+                    ((request["reports"], request["received_at"]), future)
+                )
+                status, detail = await future
+                await send(writer, {"status": status, "detail": detail})
+        finally:
+            writer.close()
+
+    async def group(self) -> list[tuple[Request, asyncio.Future]]:
+        batch = [await self.queue.get()]
+        if WRITER_LINGER_MS:
+            await asyncio.sleep(WRITER_LINGER_MS / 1000)
+        while len(batch) < WRITER_BATCH and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def commit_forever(self):
+        while True:
+            batch = await self.group()
+            self.committing = True
+            try:
+                results = await asyncio.to_thread(commit, [r for r, _ in batch])
+            except Exception as e:
+                results = [(outcome(e), None)] * len(batch)
+            for (_, future), (response, stored) in zip(batch, results):
+                if stored is not None:
+                    ingest.committed(stored)
+                future.set_result(response)
+            self.committing = False
+
+    async def serve(self, path: Path):
+        path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self.handle, path=str(path))
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for i in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(i, stopped.set)
+        logger.info("Writer listening on %s", path)
+        async with analytics.lifespan():
+            task = asyncio.create_task(self.commit_forever())
+            try:
+                await stopped.wait()
+                server.close()
+                # finish requests which were already received
+                while self.committing or not self.queue.empty():
+                    await asyncio.sleep(0.01)
+            finally:
+                task.cancel()
+                path.unlink(missing_ok=True)
+
+
+def serve(path: Path):
+    """
+    entrypoint of writer process
+    """
+    config()
+    asyncio.run(Writer().serve(path))
@@ -0,0 +1,51 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import os
+import pytest
+
+
+# server reads its configuration when its modules are imported
+# so it is set before any test imports them
+DATA = Path(tempfile.mkdtemp(prefix="chalkserver-tests-"))
+for i in (
+    "DATABASE_SHARDS",
+    "WRITER_SOCKET",
+    "CHALK_CACHE_DIR",
+    "STATS_RAW",
+):
+    os.environ.pop(i, None)
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{DATA / 'chalkdb.sqlite'}",
+    ANALYTICS_DIR=str(DATA / "analytics"),
+    MAINTENANCE="false",
+    HASH_LOOKUP="true",
+    COUNTS="true",
+    INVENTORY="true",
+    LINEAGE="true",
+    SEARCH_FIELDS="CHALK_ID,METADATA_ID,ARTIFACT_TYPE,PATH_WHEN_CHALKED,_OP_ERRORS",
+)
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+
+    from server.api import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture()
+def db(client) -> Iterator:
+    # tables are created when the app is imported
+    from server.db.database import SessionLocal
+
+    with SessionLocal() as db:
+        yield db
@@ -0,0 +1,31 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+"""
+Reports as sent by chalk for posting to the server in tests.
+"""
+import secrets
+from typing import Any
+
+
+def chalk(**keys: Any) -> dict[str, Any]:
+    return {
+        "CHALK_ID": secrets.token_hex(8),
+        "METADATA_ID": secrets.token_hex(8),
+        "METADATA_HASH": secrets.token_hex(32),
+        "HASH": secrets.token_hex(32),
+        **keys,
+    }
+
+
+def report(chalks: list[dict[str, Any]], operation: str = "build", **keys: Any):
+    return {
+        "_OPERATION": operation,
+        "_TIMESTAMP": 1700000000000,
+        "_DATETIME": "2023-11-14T22:13:20+00:00",
+        "_ACTION_ID": secrets.token_hex(8),
+        "_OP_HOSTNAME": "host",
+        "_CHALKS": chalks,
+        **keys,
+    }
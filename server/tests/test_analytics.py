@@ -0,0 +1,77 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import secrets
+
+import duckdb
+import pytest
+
+from server import analytics
+
+from .conftest import DATA
+from .reports import chalk, report
+
+
+def query(client, sql: str):
+    return client.post("/analytics/query", json={"sql": sql})
+
+
+def test_query_mirror(client):
+    marks = [chalk(ARTIFACT_TYPE="ELF"), chalk(ARTIFACT_TYPE="ELF")]
+    sent = report(marks, _OP_PLATFORM=secrets.token_hex(8))
+    assert client.post("/report", json=[sent]).status_code == 200
+    analytics.flush()
+
+    response = query(
+        client,
+        "SELECT r._OP_PLATFORM, count(*) AS chalks "
+        "FROM chalks c JOIN reports r ON c.report_id = r.id "
+        f"WHERE r._ACTION_ID = '{sent['_ACTION_ID']}' GROUP BY 1",
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "columns": ["_OP_PLATFORM", "chalks"],
+        "rows": [[sent["_OP_PLATFORM"], 2]],
+        "truncated": False,
+    }
+
+    response = client.post(
+        "/analytics/query", json={"sql": "SELECT * FROM range(5)", "max_rows": 2}
+    )
+    assert response.json()["rows"] == [[0], [1]]
+    assert response.json()["truncated"]
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM read_csv('/etc/passwd')",
+        f"SELECT * FROM read_parquet('{DATA}/../*/*.parquet')",
+        "COPY (SELECT 1) TO '/tmp/chalk-analytics.csv'",
+        f"ATTACH '{DATA / 'chalkdb.sqlite'}' AS chalkdb",
+        "INSTALL sqlite",
+        "LOAD sqlite",
+        "SET enable_external_access=true",
+        "SELECT 1; SELECT 2",
+    ],
+)
+def test_query_rejected(client, sql):
+    response = query(client, sql)
+    assert response.status_code == 400
+
+
+def test_connection_is_sandboxed(client):
+    conn = analytics.connect()
+    try:
+        for sql in [
+            "SELECT * FROM read_csv('/etc/passwd')",
+            "COPY (SELECT 1) TO '/tmp/chalk-analytics.csv'",
+            f"ATTACH '{DATA / 'chalkdb.sqlite'}' AS chalkdb",
+            "INSTALL sqlite",
+            "SET enable_external_access=true",
+        ]:
+            with pytest.raises(duckdb.Error):
+                conn.execute(sql)
+    finally:
+        conn.close()
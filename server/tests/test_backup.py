@@ -0,0 +1,134 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import sqlite3
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from server import backup
+
+
+@pytest.fixture()
+def database(tmp_path: Path, monkeypatch) -> Iterator[Path]:
+    path = tmp_path / "chalkdb.sqlite"
+    # held open like connections of the server pool as otherwise
+    # the last connection to close checkpoints and removes the WAL
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=wal")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    conn.execute("CREATE TABLE t (x INTEGER PRIMARY KEY, data TEXT)")
+    monkeypatch.setattr(backup, "database", lambda: path)
+    yield path
+    conn.close()
+
+
+def insert(path: Path, rows: range):
+    conn = sqlite3.connect(path, isolation_level=None)
+    # only WAL shipping checkpoints
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    conn.executemany(
+        "INSERT INTO t VALUES (?, ?)", [(i, f"{i:04d}" * 256) for i in rows]
+    )
+    conn.close()
+
+
+def rows(path: Path) -> list[int]:
+    conn = sqlite3.connect(path)
+    try:
+        return [i for (i,) in conn.execute("SELECT x FROM t ORDER BY x")]
+    finally:
+        conn.close()
+
+
+def restored(directory: Path, tmp_path: Path) -> list[int]:
+    target = tmp_path / "restored.sqlite"
+    backup.restore(directory, target)
+    conn = sqlite3.connect(target)
+    try:
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    finally:
+        conn.close()
+    return rows(target)
+
+
+def test_wal_header(database: Path):
+    wal = database.with_name(f"{database.name}-wal")
+    insert(database, range(1))
+    page_size, sequence, *salt = backup.wal_header(wal)
+    assert page_size == 4096
+    assert len(salt) == 2
+    assert backup.wal_header(database.with_name("missing")) is None
+    wal.write_bytes(wal.read_bytes()[:10])
+    assert backup.wal_header(wal) is None
+
+
+@pytest.mark.parametrize(
+    "state, sequence, salt, expected",
+    [
+        ({"salt": [1, 2], "sequence": 3, "checkpointed": False}, 3, [1, 2], True),
+        ({"salt": None, "sequence": None, "checkpointed": True}, 0, [1, 2], True),
+        ({"salt": [1, 2], "sequence": 3, "checkpointed": True}, 4, [5, 6], True),
+        ({"salt": [1, 2], "sequence": 3, "checkpointed": False}, 4, [5, 6], False),
+        ({"salt": [1, 2], "sequence": 3, "checkpointed": True}, 5, [5, 6], False),
+    ],
+)
+def test_continues(state, sequence, salt, expected):
+    assert backup.continues(state, sequence, salt) == expected
+
+
+def test_ship_and_restore(database: Path, tmp_path: Path, monkeypatch):
+    directory = tmp_path / "wal"
+    insert(database, range(10))
+    backup.ship(directory)
+    state = backup.read_state(directory)
+    generation = directory / state["generation"]
+    assert (generation / backup.BASE).exists()
+    assert restored(directory, tmp_path) == list(range(10))
+
+    # several passes over frames larger than BACKUP_COPY_BYTES
+    monkeypatch.setattr(backup, "BACKUP_COPY_BYTES", 4096)
+    insert(database, range(10, 50))
+    progress = backup.ship(directory)
+    assert progress.shipped_bytes > 4096
+    assert backup.read_state(directory)["generation"] == state["generation"]
+    assert restored(directory, tmp_path) == list(range(50))
+
+    # WAL restarts after all of its frames were shipped and checkpointed
+    assert backup.read_state(directory)["checkpointed"]
+    insert(database, range(50, 60))
+    backup.ship(directory)
+    state = backup.read_state(directory)
+    segments = sorted(generation.glob(f"*{backup.SUFFIX}"))
+    assert len({i.stem.split("-")[2] for i in segments}) > 1
+    assert restored(directory, tmp_path) == list(range(60))
+
+    # nothing new to ship
+    assert backup.ship(directory).shipped_bytes == 0
+    assert sorted(generation.glob(f"*{backup.SUFFIX}")) == segments
+
+
+def test_restarted_wal_takes_new_base(database: Path, tmp_path: Path):
+    directory = tmp_path / "wal"
+    insert(database, range(10))
+    backup.ship(directory)
+    generation = backup.read_state(directory)["generation"]
+
+    insert(database, range(10, 20))
+    # frames are checkpointed and WAL restarts before they are shipped
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    insert(database, range(20, 30))
+
+    backup.ship(directory)
+    assert backup.read_state(directory)["generation"] != generation
+    assert restored(directory, tmp_path) == list(range(30))
+
+
+def test_restore_without_generation(tmp_path: Path):
+    with pytest.raises(ValueError):
+        backup.restore(tmp_path, tmp_path / "restored.sqlite")
@@ -0,0 +1,92 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import re
+import secrets
+
+from sqlalchemy import event
+
+from server import lookup
+
+from .reports import chalk, report
+
+
+def test_batch(client):
+    # same CHALK_ID can have several chalkmarks such as per platform
+    chalk_id = secrets.token_hex(8)
+    marks = [chalk(CHALK_ID=chalk_id), chalk(CHALK_ID=chalk_id), chalk()]
+    sent = report(marks)
+    assert client.post("/report", json=[sent]).status_code == 200
+    missing_metadata_id = secrets.token_hex(8)
+    missing_chalk_id = secrets.token_hex(8)
+
+    response = client.post(
+        "/chalks/batch",
+        json={
+            "metadata_ids": [marks[2]["METADATA_ID"], missing_metadata_id],
+            "chalk_ids": [chalk_id, missing_chalk_id],
+        },
+    )
+    assert response.status_code == 200
+    found = response.json()
+    found["chalk_ids"][chalk_id].sort()
+    assert found == {
+        # stored chalkmarks include keys of their report
+        "chalks": {
+            i["METADATA_ID"]: {**i, **{k: v for k, v in sent.items() if k != "_CHALKS"}}
+            for i in marks
+        },
+        "chalk_ids": {chalk_id: sorted(i["METADATA_ID"] for i in marks[:2])},
+        "missing": {
+            "metadata_ids": [missing_metadata_id],
+            "chalk_ids": [missing_chalk_id],
+        },
+    }
+
+
+def test_batch_empty(client):
+    response = client.post("/chalks/batch", json={})
+    assert response.status_code == 200
+    assert response.json() == {
+        "chalks": {},
+        "chalk_ids": {},
+        "missing": {"metadata_ids": [], "chalk_ids": []},
+    }
+    assert client.post("/chalks/batch", json={"metadata_ids": "x"}).status_code == 422
+
+
+def test_batch_chunked(client, db):
+    marks = [chalk() for _ in range(3)]
+    assert client.post("/report", json=[report(marks)]).status_code == 200
+    missing = [secrets.token_hex(8) for _ in range(2 * lookup.CHUNK_SIZE)]
+    metadata_ids = [marks[0]["METADATA_ID"], *missing, marks[1]["METADATA_ID"]]
+    chalk_ids = [*missing, marks[2]["CHALK_ID"]]
+
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.get_bind(), "before_cursor_execute", listener)
+    try:
+        response = client.post(
+            "/chalks/batch",
+            params={"fields": "CHALK_ID"},
+            json={"metadata_ids": metadata_ids, "chalk_ids": chalk_ids},
+        )
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", listener)
+
+    assert response.status_code == 200
+    found = response.json()
+    assert found["chalks"] == {
+        i["METADATA_ID"]: {"CHALK_ID": i["CHALK_ID"]} for i in marks
+    }
+    assert found["missing"] == {"metadata_ids": missing, "chalk_ids": missing}
+    # ids are resolved with IN queries of at most CHUNK_SIZE ids each:
+    # 3 for chalk ids and 3 for all metadata ids
+    lookups = [i for i in statements if " IN (" in i]
+    assert len(lookups) == 6
+    sizes = [re.search(r" IN \(([^)]*)\)", i)[1].count("?") for i in lookups]
+    assert sorted(sizes) == [1, 3, 500, 500, 500, 500]
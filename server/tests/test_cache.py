@@ -0,0 +1,103 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import os
+
+from starlette.requests import Request
+
+from server import cache
+
+from .reports import chalk, report
+
+
+def request(**headers: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "headers": [
+                (k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()
+            ],
+        }
+    )
+
+
+def test_lru_evicts_least_recently_used():
+    lru = cache.LRU(max_bytes=10)
+    lru.put("a", cache.entry(b"aaaa"))
+    lru.put("b", cache.entry(b"bbbb"))
+    assert lru.get("a") is not None
+    lru.put("c", cache.entry(b"cccc"))
+    assert lru.get("b") is None
+    assert lru.get("a").body == b"aaaa"
+    assert lru.get("c").body == b"cccc"
+    assert lru.size == 8
+
+    lru.put("a", cache.entry(b"a"))
+    assert lru.size == 5
+    lru.put("big", cache.entry(b"x" * 11))
+    assert lru.get("big") is None
+    assert lru.size == 5
+
+
+def test_shared_dir(tmp_path):
+    shared = cache.SharedDir(str(tmp_path), max_bytes=10)
+    shared.put("a", cache.entry(b"aaaa"))
+    assert shared.get("a") == cache.entry(b"aaaa")
+    assert shared.get("b") is None
+
+    shared.put("b", cache.entry(b"bbbb"))
+    shared.put("c", cache.entry(b"cccc"))
+    os.utime(shared.file("a"), (0, 0))
+    shared.evict()
+    assert shared.get("a") is None
+    assert shared.get("b") is not None
+    assert shared.get("c") is not None
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_response_cache_fills_lru_from_shared(tmp_path):
+    shared = cache.SharedDir(str(tmp_path), max_bytes=100)
+    cache.ResponseCache(100, shared).put("a", b"{}")
+    other = cache.ResponseCache(100, shared)
+    assert other.lru.get("a") is None
+    assert other.get("a") == cache.entry(b"{}")
+    assert other.lru.get("a") == cache.entry(b"{}")
+    assert cache.ResponseCache(0).get("a") is None
+
+
+def test_not_modified():
+    etag = cache.entry(b"{}").etag
+    assert not cache.not_modified(request(), etag)
+    assert cache.not_modified(request(if_none_match=etag), etag)
+    assert cache.not_modified(request(if_none_match=f'"x", W/{etag}'), etag)
+    assert cache.not_modified(request(if_none_match="*"), etag)
+    assert not cache.not_modified(request(if_none_match='"x"'), etag)
+
+
+def test_chalk_etag(client, monkeypatch):
+    monkeypatch.setattr(cache, "chalks", cache.ResponseCache(2**20))
+    mark = chalk()
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+    url = f"/chalks/{mark['METADATA_ID']}"
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.json()["CHALK_ID"] == mark["CHALK_ID"]
+    etag = response.headers["etag"]
+    assert cache.chalks.lru.get(mark["METADATA_ID"]).etag == etag
+
+    cached = client.get(url)
+    assert cached.content == response.content
+    assert cached.headers["etag"] == etag
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert not response.content
+
+    response = client.get(url, headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+
+    assert client.get("/chalks/missing").status_code == 404
+    assert cache.chalks.lru.get("missing") is None
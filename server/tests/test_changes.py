@@ -0,0 +1,110 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import asyncio
+import time
+
+from sqlalchemy import func
+
+from server import changes, ingest
+from server.db import models
+from server.db.database import SessionLocal
+
+from .reports import chalk, report
+
+
+def last_seq(db) -> int:
+    return db.query(func.max(models.Report.id)).scalar() or 0
+
+
+def test_changes(client, db):
+    since = last_seq(db)
+    marks = [chalk(), chalk()]
+    created = report(marks)
+    heartbeat = report([marks[0]], operation="heartbeat")
+    empty = report([], operation="env")
+    for i in (created, heartbeat, empty):
+        assert client.post("/report", json=[i]).status_code == 200
+
+    response = client.get("/changes", params={"since": since})
+    assert response.status_code == 200
+    feed = response.json()
+    seqs = [i["seq"] for i in feed["changes"]]
+    assert seqs == sorted(seqs)
+    assert seqs[0] > since
+    assert feed["next"] == seqs[-1]
+    assert [i["report"]["_ACTION_ID"] for i in feed["changes"]] == [
+        created["_ACTION_ID"],
+        heartbeat["_ACTION_ID"],
+        empty["_ACTION_ID"],
+    ]
+    # chalkmarks belong to the report which created them
+    assert sorted(i["METADATA_ID"] for i in feed["changes"][0]["chalks"]) == sorted(
+        i["METADATA_ID"] for i in marks
+    )
+    assert feed["changes"][1]["chalks"] == []
+    assert feed["changes"][2]["chalks"] == []
+
+    pages = []
+    cursor = since
+    while True:
+        page = client.get("/changes", params={"since": cursor, "limit": 2}).json()
+        if not page["changes"]:
+            assert page["next"] == cursor
+            break
+        pages.append([i["seq"] for i in page["changes"]])
+        cursor = page["next"]
+    assert pages == [seqs[:2], seqs[2:]]
+
+
+def test_poll_waits_for_commit(db, monkeypatch):
+    # a commit wakes the request up long before the next poll
+    monkeypatch.setattr(changes, "CHANGES_POLL_INTERVAL", 30)
+    since = last_seq(db)
+    new = report([chalk()])
+
+    async def commit():
+        await asyncio.sleep(0.1)
+        with SessionLocal() as other:
+            stored = ingest.store(other, [new], 0)
+            other.commit()
+        ingest.committed(stored)
+        changes.notify()
+
+    async def main():
+        monkeypatch.setattr(changes, "_committed", asyncio.Event())
+        started = time.monotonic()
+        result, _ = await asyncio.gather(
+            changes.poll(db, since=since, limit=10, wait=10), commit()
+        )
+        return result, time.monotonic() - started
+
+    result, elapsed = asyncio.run(main())
+    assert elapsed < 5
+    assert [i["report"]["_ACTION_ID"] for i in result["changes"]] == [new["_ACTION_ID"]]
+    assert result["next"] == result["changes"][0]["seq"]
+
+
+def test_poll_timeout(db):
+    since = last_seq(db)
+    result = asyncio.run(changes.poll(db, since=since, limit=10, wait=0.05))
+    assert result == {"changes": [], "next": since}
+
+
+def test_ids_are_not_reused(client, db):
+    first = report([chalk()])
+    assert client.post("/report", json=[first]).status_code == 200
+    deleted = last_seq(db)
+    db.query(models.Chalk).filter(models.Chalk.report_id == deleted).delete()
+    db.query(models.Report).filter(models.Report.id == deleted).delete()
+    db.commit()
+
+    # a consumer which saw the deleted report must still get new ones
+    second = report([chalk()])
+    assert client.post("/report", json=[second]).status_code == 200
+    feed = client.get("/changes", params={"since": deleted}).json()
+    assert [i["report"]["_ACTION_ID"] for i in feed["changes"]] == [
+        second["_ACTION_ID"]
+    ]
+    assert feed["next"] > deleted
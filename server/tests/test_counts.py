@@ -0,0 +1,78 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+from sqlalchemy.orm import Session
+
+from server import counts
+from server.db import models
+
+from .reports import chalk, report
+
+
+def reconciled(db: Session) -> dict:
+    fixed = counts.reconcile(db)
+    db.commit()
+    return fixed
+
+
+def assert_exact(db: Session):
+    db.rollback()
+    assert +counts.stored(db) == +counts.actual(db)
+
+
+def test_counts(client, db):
+    reconciled(db)
+    before = client.get("/counts").json()
+    facets = client.get("/facets").json()
+
+    marks = [chalk(ARTIFACT_TYPE="ELF"), chalk(ARTIFACT_TYPE="ELF"), chalk()]
+    reports = [report(marks[:2]), report(marks[2:], operation="insert")]
+    assert client.post("/report", json=reports).status_code == 200
+    # duplicate chalks are rolled back and not counted
+    assert client.post("/report", json=[report(marks[:1])]).status_code == 202
+
+    assert client.get("/counts").json() == {
+        "reports": before["reports"] + 2,
+        "chalks": before["chalks"] + 3,
+    }
+    after = client.get("/facets").json()
+    operations = after["reports"]["operation"]
+    assert operations["build"] == facets["reports"]["operation"].get("build", 0) + 1
+    assert operations["insert"] == facets["reports"]["operation"].get("insert", 0) + 1
+    elf = facets["chalks"]["artifact_type"].get("ELF", 0)
+    assert after["chalks"]["artifact_type"]["ELF"] == elf + 2
+    assert_exact(db)
+
+    # counters are already exact so reconcile changes nothing
+    assert reconciled(db) == {}
+    assert client.get("/counts").json()["reports"] == before["reports"] + 2
+
+
+def test_reconcile_sets_actual_counts(client, db):
+    reconciled(db)
+    counter = db.get(models.Counter, ("reports", ""))
+    actual = counter.count
+    counter.count = 0
+    db.add(models.Counter(name="reports.operation", value="gone", count=5))
+    db.commit()
+
+    assert reconciled(db) == {
+        "reports": {"stored": 0, "actual": actual},
+        "reports.operation.gone": {"stored": 5, "actual": 0},
+    }
+    assert_exact(db)
+    assert "gone" not in client.get("/facets").json()["reports"]["operation"]
+    assert reconciled(db) == {}
+
+    # reports stored after reconcile are counted once
+    assert client.post("/report", json=[report([chalk()])]).status_code == 200
+    assert client.get("/counts").json()["reports"] == actual + 1
+    assert_exact(db)
+    assert reconciled(db) == {}
+
+
+def test_reconcile_endpoint(client):
+    response = client.post("/admin/counts/reconcile")
+    assert response.status_code == 200
+    assert response.json() == {"fixed": {}}
@@ -0,0 +1,108 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import io
+import json
+
+import pyarrow.ipc
+import pyarrow.parquet
+
+from server import columnar, export
+from server.db import models
+
+from .reports import chalk, report
+
+
+def read(response, format: str) -> pyarrow.Table:
+    assert response.status_code == 200
+    assert response.headers["content-type"] == export.FORMATS[format]
+    if format == "parquet":
+        return pyarrow.parquet.read_table(io.BytesIO(response.content))
+    return pyarrow.ipc.open_stream(response.content).read_all()
+
+
+def test_round_trip(client):
+    mark = chalk(ARTIFACT_TYPE="ELF", CUSTOM={"nested": [1, 2]})
+    sent = report([mark], _OP_ERRORS=["failed"])
+    assert client.post("/report", json=[sent]).status_code == 200
+
+    for format in export.FORMATS:
+        chalks = read(
+            client.get("/export/chalks", params={"format": format}), format
+        ).to_pylist()
+        (row,) = [i for i in chalks if i["METADATA_ID"] == mark["METADATA_ID"]]
+        assert row["HASH"] == mark["HASH"]
+        assert row["ARTIFACT_TYPE"] == "ELF"
+        assert json.loads(row[columnar.EXTRA])["CUSTOM"] == {"nested": [1, 2]}
+
+        reports = read(client.get("/export/reports", params={"format": format}), format)
+        assert reports.schema.equals(columnar.schema("reports"))
+        (row,) = [
+            i for i in reports.to_pylist() if i["_ACTION_ID"] == sent["_ACTION_ID"]
+        ]
+        assert row["_OP_ERRORS"] == ["failed"]
+        assert row["_OPERATION"] == "build"
+
+
+def test_incremental(client):
+    assert client.post("/report", json=[report([chalk()])]).status_code == 200
+    response = client.get("/export/reports", params={"format": "arrow"})
+    until = int(response.headers["X-Chalk-Export-Until"])
+    exported = read(response, "arrow")
+    assert max(exported.column("id").to_pylist()) == until
+
+    marks = [chalk(), chalk(), chalk()]
+    sent = [report(marks[:2]), report(marks[2:])]
+    assert client.post("/report", json=sent).status_code == 200
+
+    # small batches paginate by primary key without gaps or duplicates
+    params = {"format": "arrow", "after": until, "batch_size": 1}
+    response = client.get("/export/reports", params=params)
+    assert int(response.headers["X-Chalk-Export-Until"]) == until + 2
+    reports = read(response, "arrow")
+    assert reports.column("id").to_pylist() == [until + 1, until + 2]
+    assert reports.column("_ACTION_ID").to_pylist() == [i["_ACTION_ID"] for i in sent]
+
+    chalks = read(client.get("/export/chalks", params=params), "arrow")
+    assert sorted(chalks.column("METADATA_ID").to_pylist()) == sorted(
+        i["METADATA_ID"] for i in marks
+    )
+
+    params["after"] = until + 2
+    assert read(client.get("/export/chalks", params=params), "arrow").num_rows == 0
+
+
+def test_until(client, db):
+    sent = [report([chalk()]), report([chalk()])]
+    assert client.post("/report", json=sent).status_code == 200
+    last = export.snapshot(db)
+
+    # rows of reports stored after the export started are not exported
+    batches = list(export.rows(db, "reports", last - 2, last - 1, batch_size=1))
+    assert [[r["id"] for r in b] for b in batches] == [[last - 1]]
+    batches = list(export.rows(db, "chalks", last - 2, last - 1, batch_size=1))
+    assert [r["METADATA_ID"] for b in batches for r in b] == [
+        sent[0]["_CHALKS"][0]["METADATA_ID"]
+    ]
+
+
+def test_unlinked_chalks(client, db):
+    mark = chalk()
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+    db.query(models.Chalk).filter(
+        models.Chalk.metadata_id == mark["METADATA_ID"]
+    ).update({models.Chalk.report_id: None})
+    db.commit()
+    last = export.snapshot(db)
+
+    def exported(after: int) -> list[str]:
+        return [
+            r["METADATA_ID"]
+            for b in export.rows(db, "chalks", after, last, batch_size=100)
+            for r in b
+        ]
+
+    # chalks without a report are only in full exports
+    assert mark["METADATA_ID"] in exported(0)
+    assert mark["METADATA_ID"] not in exported(last - 1)
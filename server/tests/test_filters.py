@@ -0,0 +1,77 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import pytest
+from fastapi import HTTPException
+from sqlalchemy.dialects import sqlite
+
+from server.db import models
+from server.filters import Where, condition
+
+from .reports import chalk, report
+
+
+@pytest.mark.parametrize(
+    "where, expected",
+    [
+        ("_OP_ERRORS.0=boom", Where(("_OP_ERRORS", 0), None, "=", "boom")),
+        ("_TIMESTAMP>=5", Where(("_TIMESTAMP",), None, ">=", 5)),
+        ("SIZE<1.5", Where(("SIZE",), None, "<", 1.5)),
+        ("SIGNED!=true", Where(("SIGNED",), None, "!=", True)),
+        ('TAG="5"', Where(("TAG",), None, "=", "5")),
+        ("NAME~a=b", Where(("NAME",), None, "~", "a=b")),
+        ("EMPTY=null", Where(("EMPTY",), None, "=", "null")),
+        ("_CHALKS.*.HASH=abc", Where(("_CHALKS",), ("HASH",), "=", "abc")),
+        ("DOCKER_TAGS.*=v1", Where(("DOCKER_TAGS",), (), "=", "v1")),
+    ],
+)
+def test_parse(where: str, expected: Where):
+    assert Where.parse(where) == expected
+
+
+@pytest.mark.parametrize(
+    "where",
+    ["no operator", "=value", "_CHALKS.*.TAGS.*=v1"],
+)
+def test_parse_invalid(where: str):
+    with pytest.raises(HTTPException) as e:
+        Where.parse(where)
+    assert e.value.status_code == 400
+
+
+def test_star_sqlite():
+    where = Where.parse("_CHALKS.*.HASH=abc")
+    sql = str(
+        condition("sqlite", models.Report.raw, where).compile(
+            dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}
+        )
+    )
+    assert "EXISTS" in sql
+    assert "json_each(reports.raw, '$.\"_CHALKS\"')" in sql
+    assert "'$.\"HASH\"'" in sql
+
+
+def test_star_unsupported_dialect():
+    with pytest.raises(HTTPException) as e:
+        condition("mysql", models.Report.raw, Where.parse("_CHALKS.*.HASH=abc"))
+    assert e.value.status_code == 400
+
+
+def test_reports_where(client):
+    tagged = chalk(DOCKER_TAGS=["chalk:where"], ERRORS=1)
+    other = chalk(DOCKER_TAGS=["chalk:other"], ERRORS=2)
+    response = client.post("/report", json=[report([tagged]), report([other])])
+    assert response.status_code == 200
+
+    def ids(*where: str) -> list[str]:
+        response = client.get("/reports", params={"where": list(where)})
+        assert response.status_code == 200
+        return [c["CHALK_ID"] for r in response.json() for c in r["_CHALKS"]]
+
+    assert ids(f"_CHALKS.*.HASH={tagged['HASH']}") == [tagged["CHALK_ID"]]
+    assert ids("_CHALKS.*.DOCKER_TAGS.0=chalk:other") == [other["CHALK_ID"]]
+    assert ids(f"_CHALKS.*.CHALK_ID={tagged['CHALK_ID']}", "_CHALKS.*.ERRORS>1") == []
+    assert ids(f"_CHALKS.*.CHALK_ID={other['CHALK_ID']}", "_CHALKS.*.ERRORS>1") == [
+        other["CHALK_ID"]
+    ]
@@ -0,0 +1,97 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import secrets
+
+from server import inventory
+
+from .reports import chalk, report
+
+
+def test_latest():
+    rows = [
+        {"chalk_id": "a", "host": "h", "first_seen": 2, "last_seen": 2, "pid": 1},
+        {"chalk_id": "a", "host": "h", "first_seen": 3, "last_seen": 3, "pid": 2},
+        {"chalk_id": "a", "host": "h", "first_seen": 1, "last_seen": 1, "pid": 3},
+        {"chalk_id": "a", "host": "g", "first_seen": 1, "last_seen": 1, "pid": 4},
+    ]
+    assert inventory.latest(rows) == [
+        {"chalk_id": "a", "host": "h", "first_seen": 1, "last_seen": 3, "pid": 2},
+        {"chalk_id": "a", "host": "g", "first_seen": 1, "last_seen": 1, "pid": 4},
+    ]
+
+
+def test_sightings():
+    mark = chalk(_PROCESS_PID=True, _INSTANCE_CONTAINER_ID="c1")
+    sent = report(
+        [mark, "invalid", {"METADATA_ID": "no chalk id"}],
+        operation="EXEC",
+        _OP_HOSTNAME=None,
+        _OP_HOST_NODENAME="node",
+        _TIMESTAMP="invalid",
+    )
+    assert inventory.sightings(sent, received_at=5) == [
+        {
+            "chalk_id": mark["CHALK_ID"],
+            "host": "node",
+            "operation": "exec",
+            "first_seen": 5,
+            "last_seen": 5,
+            "received_at": 5,
+            "platform": None,
+            "exec_id": None,
+            "metadata_id": mark["METADATA_ID"],
+            "container_id": "c1",
+            "container_name": None,
+            # not an int
+            "pid": None,
+        }
+    ]
+    assert inventory.sightings(report([chalk()]), received_at=5) == []
+
+
+def test_inventory(client):
+    mark = chalk()
+    host = secrets.token_hex(8)
+
+    def sighting(operation: str, timestamp: int, pid: int):
+        sent = report(
+            [{**mark, "_PROCESS_PID": pid}],
+            operation=operation,
+            _OP_HOSTNAME=host,
+            _TIMESTAMP=timestamp,
+        )
+        assert client.post("/report", json=[sent]).status_code == 200
+
+    def listed(**params):
+        response = client.get("/inventory", params={"host": host, **params})
+        assert response.status_code == 200
+        return response.json()
+
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+    assert listed() == []
+
+    sighting("exec", 2000, pid=1)
+    sighting("heartbeat", 3000, pid=1)
+    # late report of an older sighting does not overwrite the latest one
+    sighting("exec", 1000, pid=2)
+
+    (row,) = listed()
+    assert row["chalk_id"] == mark["CHALK_ID"]
+    assert row["metadata_id"] == mark["METADATA_ID"]
+    assert row["operation"] == "heartbeat"
+    assert row["pid"] == 1
+    assert (row["first_seen"], row["last_seen"]) == (2000, 3000)
+
+    other = chalk()
+    sent = report([other], operation="exec", _OP_HOSTNAME=host, _TIMESTAMP=4000)
+    assert client.post("/report", json=[sent]).status_code == 200
+
+    # most recently seen first
+    assert [i["chalk_id"] for i in listed()] == [other["CHALK_ID"], mark["CHALK_ID"]]
+    assert [i["chalk_id"] for i in listed(limit=1, offset=1)] == [mark["CHALK_ID"]]
+    assert [i["chalk_id"] for i in listed(since=3500)] == [other["CHALK_ID"]]
+    assert [i["chalk_id"] for i in listed(until=3500)] == [mark["CHALK_ID"]]
+    assert [i["chalk_id"] for i in listed(operation="HEARTBEAT")] == [mark["CHALK_ID"]]
+    assert listed(chalk_id=mark["CHALK_ID"], metadata_id="missing") == []
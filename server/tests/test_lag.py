@@ -0,0 +1,87 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import itertools
+import secrets
+
+from sqlalchemy import event
+
+from server import lag
+from server.db import models
+from server.db.database import SessionLocal
+
+from .reports import chalk, report
+
+
+def test_committed_at_is_after_commit(client, db, monkeypatch):
+    clock = itertools.count(1700000000000)
+    monkeypatch.setattr(lag, "now_ms", lambda: next(clock))
+    commits = []
+
+    def after_commit(session):
+        commits.append(lag.now_ms())
+
+    event.listen(SessionLocal, "after_commit", after_commit)
+    try:
+        assert client.post("/report", json=[report([chalk()])]).status_code == 200
+    finally:
+        event.remove(SessionLocal, "after_commit", after_commit)
+
+    received_at, committed_at = (
+        db.query(models.Report.received_at, models.Report.committed_at)
+        .order_by(models.Report.id.desc())
+        .first()
+    )
+    # reports are committed first and then stamped in their own commit
+    assert received_at < commits[0] < committed_at < commits[1]
+
+
+def test_histogram_without_timestamp(client):
+    operation = f"lag-{secrets.token_hex(4)}"
+    timed = report([], operation=operation)
+    untimed = report([], operation=operation)
+    del untimed["_TIMESTAMP"]
+    assert client.post("/report", json=[timed, untimed]).status_code == 200
+
+    response = client.get("/reports/lag", params={"operation": operation})
+    assert response.status_code == 200
+    data = response.json()["operations"][operation]
+    assert data["count"] == 2
+    # ingest lag is known for both but delivery lag only for one
+    assert data["ingest"]["count"] == 2
+    assert data["ingest"]["le_ms"]["86400000"] == 2
+    assert data["delivery"]["count"] == 1
+    assert data["delivery"]["max_ms"] > 0
+
+
+def test_merge():
+    def histogram(count, max_ms):
+        return {
+            "operations": {
+                "build": {
+                    "count": count,
+                    "delivery": {
+                        "count": count,
+                        "max_ms": max_ms,
+                        "le_ms": {b: count for b in lag.BUCKETS_MS},
+                    },
+                    "ingest": {
+                        "count": 0,
+                        "max_ms": None,
+                        "le_ms": {b: 0 for b in lag.BUCKETS_MS},
+                    },
+                }
+            }
+        }
+
+    merged = lag.merge([histogram(1, 10), histogram(2, 5)])["operations"]["build"]
+    assert merged["count"] == 3
+    assert merged["delivery"]["count"] == 3
+    assert merged["delivery"]["max_ms"] == 10
+    assert merged["delivery"]["le_ms"][100] == 3
+    assert merged["ingest"] == {
+        "count": 0,
+        "max_ms": None,
+        "le_ms": {b: 0 for b in lag.BUCKETS_MS},
+    }
@@ -0,0 +1,119 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+from typing import Any, Optional
+
+from server import lineage
+
+from .reports import chalk, report
+
+
+# a - b - c - d with b, c and e in a triangle
+GRAPH = {("a", "b"), ("b", "c"), ("c", "d"), ("b", "e"), ("c", "e")}
+
+
+def traverse(
+    start: list[str], max_depth: int = 5, max_nodes: int = 100
+) -> Optional[dict[str, Any]]:
+    calls = []
+
+    def neighbours(nodes: list[str]) -> set[tuple[str, str]]:
+        calls.append(nodes)
+        return {edge for edge in GRAPH if set(edge) & set(nodes)}
+
+    graph = lineage.traverse(neighbours, start, max_depth, max_nodes)
+    # each node is only expanded once
+    expanded = [i for nodes in calls for i in nodes]
+    assert len(expanded) == len(set(expanded))
+    return graph
+
+
+def depths(graph: dict[str, Any]) -> dict[str, int]:
+    return {i["id"]: i["depth"] for i in graph["nodes"]}
+
+
+def edges(graph: dict[str, Any]) -> set[tuple[str, str]]:
+    return {(i["source"], i["target"]) for i in graph["edges"]}
+
+
+def test_traverse():
+    graph = traverse(["a"])
+    assert depths(graph) == {"a": 0, "b": 1, "c": 2, "e": 2, "d": 3}
+    assert edges(graph) == GRAPH
+    assert not graph["truncated"]
+
+
+def test_traverse_max_depth():
+    graph = traverse(["a"], max_depth=1)
+    assert depths(graph) == {"a": 0, "b": 1}
+    assert edges(graph) == {("a", "b")}
+    assert graph["truncated"]
+
+    # edge between two nodes at max depth is part of the graph
+    graph = traverse(["a"], max_depth=2)
+    assert depths(graph) == {"a": 0, "b": 1, "c": 2, "e": 2}
+    assert edges(graph) == {("a", "b"), ("b", "c"), ("b", "e"), ("c", "e")}
+    assert graph["truncated"]
+
+    graph = traverse(["a"], max_depth=3)
+    assert not graph["truncated"]
+
+    graph = traverse(["a"], max_depth=0)
+    assert depths(graph) == {"a": 0}
+    assert edges(graph) == set()
+    assert graph["truncated"]
+
+
+def test_traverse_max_nodes():
+    graph = traverse(["a"], max_nodes=2)
+    assert depths(graph) == {"a": 0, "b": 1}
+    assert edges(graph) == {("a", "b")}
+    assert graph["truncated"]
+
+
+def test_traverse_start():
+    graph = traverse(["missing", "d"], max_depth=1)
+    assert depths(graph) == {"d": 0, "c": 1}
+    assert traverse(["missing"]) is None
+
+
+def test_nodes():
+    assert lineage.node("image", "SHA256:ABC") == "image:abc"
+    assert lineage.node("chalk", "ABC") == "chalk:ABC"
+    assert lineage.start_nodes("x", "commit") == ["commit:x"]
+    assert "mark:x" in lineage.start_nodes("x", None)
+
+
+def test_lineage(client):
+    mark = chalk(COMMIT_ID="c0ffee", _IMAGE_ID="sha256:1234")
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+    heartbeat = report(
+        [{"CHALK_ID": mark["CHALK_ID"], "METADATA_ID": mark["METADATA_ID"]}],
+        operation="heartbeat",
+        _EXEC_ID="exec1",
+    )
+    assert client.post("/report", json=[heartbeat]).status_code == 200
+
+    response = client.get("/lineage/c0ffee", params={"kind": "commit"})
+    assert response.status_code == 200
+    graph = response.json()
+    assert depths(graph) == {
+        "commit:c0ffee": 0,
+        f"chalk:{mark['CHALK_ID']}": 1,
+        f"mark:{mark['METADATA_ID']}": 2,
+        "image:1234": 3,
+        "exec:exec1": 3,
+        f"action:{heartbeat['_ACTION_ID']}": 4,
+    }
+    assert not graph["truncated"]
+
+    response = client.get("/lineage/1234", params={"depth": 1})
+    assert depths(response.json()) == {
+        "image:1234": 0,
+        f"mark:{mark['METADATA_ID']}": 1,
+    }
+    assert response.json()["truncated"]
+
+    assert client.get("/lineage/c0ffee", params={"kind": "nope"}).status_code == 400
+    assert client.get("/lineage/missing").status_code == 404
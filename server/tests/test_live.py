@@ -0,0 +1,115 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import asyncio
+import json
+
+import pytest
+
+from server import ingest, lag, live, metrics
+from server.db.database import SessionLocal
+
+from .reports import chalk, report
+
+
+@pytest.fixture()
+def polling(client, monkeypatch):
+    """
+    event set whenever the broker waits for new reports
+    """
+    waiting = asyncio.Event()
+
+    async def committed(timeout: float):
+        waiting.set()
+        await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(live.changes, "committed", committed)
+    return waiting
+
+
+async def store(*reports):
+    def commit():
+        with SessionLocal() as db:
+            stored = ingest.store(db, list(reports), lag.now_ms())
+            db.commit()
+            ingest.stamp(db, [stored])
+
+    await asyncio.to_thread(commit)
+
+
+async def subscribe(waiting: asyncio.Event, subscriber: live.Subscriber):
+    stream = live.stream(subscriber)
+    assert await anext(stream) == b": subscribed\n\n"
+    # only reports committed after broker started tailing are streamed
+    waiting.clear()
+    await asyncio.wait_for(waiting.wait(), 5)
+    return stream
+
+
+async def receive(stream) -> tuple[str, dict]:
+    message = (await asyncio.wait_for(anext(stream), 5)).decode()
+    fields = dict(i.split(": ", 1) for i in message.strip().splitlines())
+    return fields["event"], json.loads(fields["data"])
+
+
+def test_matches():
+    mark = chalk(ARTIFACT_TYPE="ELF")
+    event = live.Event(1, "exec", json.dumps(report([mark], operation="exec")))
+    assert live.Subscriber(None, {}).matches(event)
+    assert live.Subscriber("EXEC", {"ARTIFACT_TYPE": "ELF"}).matches(event)
+    assert not live.Subscriber("build", {}).matches(event)
+    assert not live.Subscriber(None, {"CHALK_ID": "other"}).matches(event)
+    assert not live.Subscriber(None, {"CHALK_ID": mark["CHALK_ID"]}).matches(
+        live.Event(2, "build", json.dumps(report([])))
+    )
+
+
+def test_fan_out(polling):
+    mark = chalk()
+
+    async def main():
+        everything = await subscribe(polling, live.Subscriber(None, {}))
+        execs = await subscribe(
+            polling, live.Subscriber("exec", {"CHALK_ID": mark["CHALK_ID"]})
+        )
+        assert len(live.broker.subscribers) == 2
+
+        built = report([mark])
+        executed = report([mark], operation="exec")
+        await store(built, executed)
+
+        assert await receive(everything) == ("report", built)
+        assert await receive(everything) == ("report", executed)
+        assert await receive(execs) == ("report", executed)
+
+        await everything.aclose()
+        await execs.aclose()
+        assert not live.broker.subscribers
+        assert live.broker.task is None
+
+    asyncio.run(main())
+
+
+def test_slow_subscriber_dropped(polling, monkeypatch):
+    monkeypatch.setattr(live, "LIVE_BUFFER", 1)
+    dropped = metrics.live_dropped_total._value.get()
+
+    async def main():
+        slow = live.Subscriber(None, {})
+        stream = await subscribe(polling, slow)
+        await store(report([]), report([]), report([]))
+        # waits until reports are published
+        for _ in range(500):
+            if slow.dropped:
+                break
+            await asyncio.sleep(0.01)
+
+        assert slow.dropped
+        assert not live.broker.subscribers
+        assert await anext(stream) == b"event: dropped\ndata: {}\n\n"
+        with pytest.raises(StopAsyncIteration):
+            await anext(stream)
+
+    asyncio.run(main())
+    assert metrics.live_dropped_total._value.get() - dropped == 1
@@ -0,0 +1,75 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import logging
+import queue
+import threading
+
+from server import log, metrics
+
+
+def dropped(reason: str) -> float:
+    return metrics.dropped_logs_total.labels(reason)._value.get()
+
+
+def queued(name: str) -> list[logging.Handler]:
+    return [
+        i
+        for i in logging.getLogger(name).handlers
+        if isinstance(i, log.NonBlockingQueueHandler)
+    ]
+
+
+def test_full_queue_drops_records():
+    handler = log.NonBlockingQueueHandler(queue.Queue(2))
+    logger = logging.getLogger("server.tests.full")
+    logger.handlers = [handler]
+    logger.propagate = False
+    before = dropped("queue_full")
+
+    # nothing consumes the queue so a blocking put would never return
+    thread = threading.Thread(
+        target=lambda: [logger.warning("message %d", i) for i in range(5)]
+    )
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert handler.queue.qsize() == 2
+    assert dropped("queue_full") - before == 3
+
+
+def test_records_are_formatted_by_listener():
+    class Rendered:
+        calls = 0
+
+        def __str__(self):
+            Rendered.calls += 1
+            return "rendered"
+
+    handler = log.NonBlockingQueueHandler(queue.Queue())
+    logger = logging.getLogger("server.tests.lazy")
+    logger.setLevel(logging.INFO)
+    logger.handlers = [handler]
+    logger.propagate = False
+
+    logger.info("value %s", Rendered())
+    record = handler.queue.get_nowait()
+    assert Rendered.calls == 0
+    assert record.getMessage() == "value rendered"
+
+
+def test_access_logs_are_queued(client):
+    # server configures logging when the app is imported
+    # pytest adds its own capturing handlers
+    (handler,) = queued("uvicorn.access")
+    assert queued("uvicorn") == [handler]
+
+    # access logs all share the same template but are never rate limited
+    limit = log.RateLimitFilter(rate=1, sample_every=1000)
+    for i in range(10):
+        record = logging.makeLogRecord(
+            {"name": "uvicorn.access", "msg": "%s", "args": (i,)}
+        )
+        assert limit.filter(record)
@@ -0,0 +1,93 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import secrets
+
+from sqlalchemy import event
+
+from server import lookup
+
+from .reports import chalk, report
+
+
+def test_normalize():
+    assert lookup.normalize(" SHA256:ABC ") == "abc"
+
+
+def test_digests():
+    raw = {
+        "HASH": "abc",
+        "_CURRENT_HASH": "ABC",
+        "_IMAGE_ID": "sha256:def",
+        "_REPO_DIGESTS": {"ghcr.io/chalk": "sha256:123", "docker.io/chalk": ""},
+        "PRE_CHALK_HASH": None,
+    }
+    assert list(lookup.digests(raw)) == [
+        ("HASH", "abc"),
+        ("_CURRENT_HASH", "abc"),
+        ("_IMAGE_ID", "def"),
+        ("_REPO_DIGESTS", "123"),
+    ]
+
+
+def test_chunks():
+    assert [len(i) for i in lookup.chunks(list(range(1201)))] == [500, 500, 201]
+    assert list(lookup.chunks([])) == []
+
+
+def test_merge():
+    assert lookup.merge([{"a": ["1"]}, {"a": ["1", "2"], "b": ["3"]}]) == {
+        "a": ["1", "2"],
+        "b": ["3"],
+    }
+
+
+def test_find_chunked(client, db):
+    marks = [chalk(), chalk(_IMAGE_ID=f"sha256:{secrets.token_hex(32)}")]
+    assert client.post("/report", json=[report(marks)]).status_code == 200
+
+    image_id = lookup.normalize(marks[1]["_IMAGE_ID"])
+    missing = [secrets.token_hex(32) for _ in range(1200)]
+    digests = [marks[0]["HASH"], *missing, image_id]
+
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.get_bind(), "before_cursor_execute", listener)
+    try:
+        found = lookup.find(db, digests)
+    finally:
+        event.remove(db.get_bind(), "before_cursor_execute", listener)
+
+    assert found == {
+        marks[0]["HASH"]: [marks[0]["METADATA_ID"]],
+        image_id: [marks[1]["METADATA_ID"]],
+    }
+    assert len(statements) == 3
+
+
+def test_lookup_hash(client):
+    mark = chalk(_REPO_DIGESTS={"ghcr.io/chalk": f"sha256:{secrets.token_hex(32)}"})
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+    digest = mark["_REPO_DIGESTS"]["ghcr.io/chalk"].upper()
+
+    response = client.get(f"/lookup/hash/{digest}", params={"fields": "CHALK_ID"})
+    assert response.status_code == 200
+    assert response.json() == [{"CHALK_ID": mark["CHALK_ID"]}]
+    assert client.get(f"/lookup/hash/{secrets.token_hex(32)}").status_code == 404
+
+    missing = [secrets.token_hex(32) for _ in range(600)]
+    response = client.post(
+        "/lookup/hash",
+        params={"fields": "CHALK_ID"},
+        json={"digests": [digest, *missing]},
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "digests": {digest: [mark["METADATA_ID"]]},
+        "chalks": {mark["METADATA_ID"]: {"CHALK_ID": mark["CHALK_ID"]}},
+        "missing": missing,
+    }
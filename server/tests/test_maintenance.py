@@ -0,0 +1,95 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+from typing import Iterator
+
+import pytest
+from sqlalchemy.orm import Session
+
+from server import lag, maintenance
+from server.db import models
+
+
+@pytest.fixture()
+def lease(db: Session) -> Iterator[Session]:
+    db.query(models.Lease).delete()
+    db.commit()
+    yield db
+    db.query(models.Lease).delete()
+    db.commit()
+
+
+def other(monkeypatch, name: str = "other"):
+    monkeypatch.setattr(maintenance, "holder", name)
+
+
+def test_acquire_and_renew(lease: Session, monkeypatch):
+    assert maintenance.acquire(lease, 1000)
+    expires_at = lease.get(models.Lease, maintenance.LEASE).expires_at
+    monkeypatch.setattr(lag, "now_ms", lambda: expires_at)
+    assert maintenance.acquire(lease, 1000)
+    lease.expire_all()
+    assert lease.get(models.Lease, maintenance.LEASE).expires_at == expires_at + 1000
+
+
+def test_held_by_other(lease: Session, monkeypatch):
+    holder = maintenance.holder
+    assert maintenance.acquire(lease, 60_000)
+    other(monkeypatch)
+    assert not maintenance.acquire(lease, 60_000)
+    lease.expire_all()
+    assert lease.get(models.Lease, maintenance.LEASE).holder == holder
+    assert maintenance.status(lease)["leader"] == holder
+
+    # only the holder releases the lease
+    maintenance.release(lease)
+    assert lease.get(models.Lease, maintenance.LEASE) is not None
+    other(monkeypatch, holder)
+    maintenance.release(lease)
+    assert lease.get(models.Lease, maintenance.LEASE) is None
+    assert maintenance.status(lease)["leader"] is None
+
+
+def test_expired_lease_is_taken_over(lease: Session, monkeypatch):
+    assert maintenance.acquire(lease, 1000)
+    expires_at = lease.get(models.Lease, maintenance.LEASE).expires_at
+    other(monkeypatch)
+    monkeypatch.setattr(lag, "now_ms", lambda: expires_at)
+    assert not maintenance.acquire(lease, 1000)
+    monkeypatch.setattr(lag, "now_ms", lambda: expires_at + 1)
+    assert maintenance.status(lease)["leader"] is None
+    assert maintenance.acquire(lease, 1000)
+    lease.expire_all()
+    assert lease.get(models.Lease, maintenance.LEASE).holder == "other"
+
+
+def test_run_due_without_lease(lease: Session, monkeypatch):
+    other(monkeypatch)
+    assert maintenance.acquire(lease, 60_000)
+    other(monkeypatch, "worker")
+    runs = lease.query(models.MaintenanceRun).count()
+    assert maintenance.run_due()
+    assert lease.query(models.MaintenanceRun).count() == runs
+
+
+def test_run_due(lease: Session, monkeypatch):
+    lease.query(models.MaintenanceRun).delete()
+    lease.commit()
+    monkeypatch.setattr(maintenance, "busy", lambda db: None)
+    assert maintenance.run_due()
+    lease.expire_all()
+    runs = {r.task: r for r in lease.query(models.MaintenanceRun)}
+    assert set(runs) == {t.name for t in maintenance.TASKS if t.applies(lease)}
+    assert all(r.error is None for r in runs.values())
+    assert maintenance.status(lease)["leader"] == maintenance.holder
+    # not due again until their interval passes
+    assert maintenance.due(lease) == []
+
+
+def test_run_due_busy(lease: Session, monkeypatch):
+    lease.query(models.MaintenanceRun).delete()
+    lease.commit()
+    monkeypatch.setattr(maintenance, "busy", lambda db: "busy")
+    assert not maintenance.run_due()
+    assert lease.query(models.MaintenanceRun).count() == 0
@@ -0,0 +1,76 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import secrets
+import subprocess
+import sys
+
+from server import metrics
+
+from .reports import chalk, report
+
+
+def sample(text: str, name: str, **labels: str) -> float:
+    prefix = name
+    if labels:
+        prefix += "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+    for line in text.splitlines():
+        if line.startswith(prefix + " "):
+            return float(line.split()[-1])
+    return 0
+
+
+def test_operation_label():
+    assert metrics.operation_label("build") == "build"
+    assert metrics.operation_label(secrets.token_hex(8)) == "other"
+
+
+def test_request_metrics(client):
+    before = client.get("/metrics").text
+    mark = chalk()
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+    assert client.get(f"/chalks/{mark['METADATA_ID']}").status_code == 200
+    assert client.get(f"/chalks/{secrets.token_hex(8)}").status_code == 404
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    after = response.text
+
+    def delta(name, **labels):
+        return sample(after, name, **labels) - sample(before, name, **labels)
+
+    # routes are labeled by their template rather than the requested path
+    route = {"method": "GET", "route": "/chalks/{metadata_id}"}
+    assert delta("chalk_server_requests_total", **route, status="200") == 1
+    assert delta("chalk_server_requests_total", **route, status="404") == 1
+    assert delta("chalk_server_request_duration_seconds_count", **route) == 2
+    assert delta("chalk_server_received_bytes_total", method="POST", route="/report")
+    assert delta("chalk_server_reports_per_request_count") == 1
+    assert delta("chalk_server_chalks_per_request_sum") == 1
+    assert delta("chalk_server_db_commit_duration_seconds_count") >= 1
+
+
+def test_prepare_multiprocess(tmp_path, monkeypatch):
+    monkeypatch.delenv(metrics.MULTIPROC_DIR, raising=False)
+    (tmp_path / "counter_1.db").write_bytes(b"stale")
+    (tmp_path / "other.txt").write_text("kept")
+
+    metrics.prepare_multiprocess(str(tmp_path))
+
+    assert metrics.is_multiprocess()
+    assert [i.name for i in tmp_path.iterdir()] == ["other.txt"]
+
+
+def test_multiprocess_registry(client, tmp_path, monkeypatch):
+    monkeypatch.delenv(metrics.MULTIPROC_DIR, raising=False)
+    metrics.prepare_multiprocess(str(tmp_path))
+    # every worker increments the same counter in its own process
+    script = "from server import metrics; metrics.duplicates_total.inc(2)"
+    for _ in range(3):
+        subprocess.run([sys.executable, "-c", script], check=True)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert sample(response.text, "chalk_server_duplicate_reports_total") == 6
@@ -0,0 +1,72 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import json
+
+from server import passthrough
+from server.db import models
+
+from .reports import chalk, report
+
+
+def test_text(client, db):
+    assert client.post("/report", json=[report([chalk()])]).status_code == 200
+    (text,) = (
+        db.query(passthrough.text(models.Report.raw))
+        .order_by(models.Report.id.desc())
+        .first()
+    )
+    # stored JSON is selected as is without decoding it
+    assert isinstance(text, str)
+    assert json.loads(text)["_OPERATION"] == "build"
+
+
+def test_listings(client, db):
+    marks = [chalk(PATH_WHEN_CHALKED="/bin/ünïcode"), chalk()]
+    sent = report(marks)
+    assert client.post("/report", json=[sent]).status_code == 200
+    (stored,) = (
+        db.query(passthrough.text(models.Chalk.raw))
+        .filter(models.Chalk.metadata_id == marks[0]["METADATA_ID"])
+        .one()
+    )
+
+    params = {"chalk_id": marks[0]["CHALK_ID"]}
+    response = client.get("/chalks", params=params)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    # response is the stored text verbatim
+    assert response.content == f"[{stored}]".encode()
+
+    response = client.get("/reports", params=params)
+    assert response.status_code == 200
+    assert [i["_ACTION_ID"] for i in response.json()] == [sent["_ACTION_ID"]]
+    assert response.json()[0]["_CHALKS"] == marks
+
+    response = client.get("/chalks", params={"chalk_id": "missing"})
+    assert response.content == b"[]"
+
+
+def test_ndjson(client):
+    marks = [chalk(), chalk()]
+    sent = report(marks)
+    assert client.post("/report", json=[sent]).status_code == 200
+
+    headers = {"Accept": passthrough.NDJSON}
+    response = client.get(
+        "/chalks", params={"where": f"_ACTION_ID={sent['_ACTION_ID']}"}, headers=headers
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == passthrough.NDJSON
+    lines = response.text.splitlines(keepends=True)
+    assert all(i.endswith("\n") for i in lines)
+    assert sorted(json.loads(i)["METADATA_ID"] for i in lines) == sorted(
+        i["METADATA_ID"] for i in marks
+    )
+
+    response = client.get(
+        "/reports", params={"chalk_id": marks[1]["CHALK_ID"]}, headers=headers
+    )
+    (line,) = response.text.splitlines()
+    assert json.loads(line)["_ACTION_ID"] == sent["_ACTION_ID"]
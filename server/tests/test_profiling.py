@@ -0,0 +1,73 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from server import profiling
+
+
+@pytest.fixture()
+def profiled(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiling, "PROFILE_INTERVAL_MS", 1)
+    app = FastAPI()
+
+    @app.get("/busy/{n}")
+    async def busy_handler(n: int):
+        # busy on the event loop thread which is what is sampled
+        deadline = time.monotonic() + n / 1000
+        while time.monotonic() < deadline:
+            pass
+        return {}
+
+    app.add_middleware(profiling.ProfilingMiddleware)
+    with TestClient(app) as client:
+        yield client
+
+
+def test_not_profiled(profiled):
+    response = profiled.get("/busy/1")
+    assert response.status_code == 200
+    assert "x-chalk-profile-id" not in response.headers
+    assert profiling.list_profiles() == []
+
+
+def test_profiled(profiled):
+    response = profiled.get("/busy/100", headers={"X-Chalk-Profile": "1"})
+    assert response.status_code == 200
+    name = response.headers["x-chalk-profile-id"]
+    assert name.endswith("-GET-busy_100" + profiling.SUFFIX)
+
+    assert [i["name"] for i in profiling.list_profiles()] == [name]
+    path = profiling.get_profile(name)
+    assert path is not None
+    stacks = [line.rsplit(" ", 1) for line in path.read_text().splitlines()]
+    assert stacks
+    assert all(int(count) > 0 for _, count in stacks)
+    assert any("busy_handler" in stack for stack, _ in stacks)
+
+
+def test_sample_rate(profiled, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1)
+    response = profiled.get("/busy/1")
+    assert "x-chalk-profile-id" in response.headers
+
+
+def test_keep_latest(profiled, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_KEEP", 2)
+    for i in range(3):
+        profiling.save(f"{i}{profiling.SUFFIX}", "main 1\n")
+        time.sleep(0.01)
+    names = [i["name"] for i in profiling.list_profiles()]
+    assert names == [f"2{profiling.SUFFIX}", f"1{profiling.SUFFIX}"]
+
+
+def test_get_profile_stays_in_directory(profiled, tmp_path):
+    (tmp_path.parent / f"outside{profiling.SUFFIX}").write_text("main 1\n")
+    assert profiling.get_profile(f"../outside{profiling.SUFFIX}") is None
+    assert profiling.get_profile("missing" + profiling.SUFFIX) is None
@@ -0,0 +1,89 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import pytest
+from fastapi import HTTPException
+
+from server.projection import Fields
+
+from .reports import chalk, report
+
+
+def test_fields():
+    fields = Fields(fields=["CHALK_ID,HASH", "_CHALKS.0.HASH", ""])
+    assert fields
+    assert fields.fields == ["CHALK_ID", "HASH", "_CHALKS.0.HASH"]
+    assert fields.paths == [("CHALK_ID",), ("HASH",), ("_CHALKS", 0, "HASH")]
+    assert not Fields(fields=[])
+
+
+def test_fields_star():
+    with pytest.raises(HTTPException) as e:
+        Fields(fields=["_CHALKS.*.HASH"])
+    assert e.value.status_code == 400
+
+
+def test_row_drops_missing():
+    fields = Fields(fields=["CHALK_ID,MISSING,ERRORS,NULL"])
+    row = ["abc", "string", None, None, 0, "integer", None, "null"]
+    assert fields.row(row) == {"CHALK_ID": "abc", "ERRORS": 0, "NULL": None}
+
+
+def test_chalks_fields(client):
+    mark = chalk(ARTIFACT_TYPE="Docker Image", DOCKER_TAGS=["chalk:fields"])
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+
+    response = client.get(
+        "/chalks",
+        params={"chalk_id": mark["CHALK_ID"], "fields": "HASH,DOCKER_TAGS.0,MISSING"},
+    )
+    assert response.status_code == 200
+    assert response.json() == [{"HASH": mark["HASH"], "DOCKER_TAGS.0": "chalk:fields"}]
+
+    response = client.get(
+        f"/chalks/{mark['METADATA_ID']}", params={"fields": "ARTIFACT_TYPE"}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"ARTIFACT_TYPE": "Docker Image"}
+
+    response = client.post(
+        "/chalks/batch",
+        params={"fields": "CHALK_ID"},
+        json={"metadata_ids": [mark["METADATA_ID"]], "chalk_ids": []},
+    )
+    assert response.status_code == 200
+    assert response.json()["chalks"] == {
+        mark["METADATA_ID"]: {"CHALK_ID": mark["CHALK_ID"]}
+    }
+
+    response = client.get("/chalks", params={"fields": "_CHALKS.*.HASH"})
+    assert response.status_code == 400
+
+
+def test_fields_null(client):
+    mark = chalk(COMMIT_ID=None, _OP_ERRORS=[None, "failed"])
+    sent = report([mark], _OP_HOSTNAME=None)
+    assert client.post("/report", json=[sent]).status_code == 200
+    fields = {"fields": "COMMIT_ID,_OP_ERRORS.0,_OP_ERRORS.1,_OP_ERRORS.2,MISSING"}
+    expected = {"COMMIT_ID": None, "_OP_ERRORS.0": None, "_OP_ERRORS.1": "failed"}
+
+    response = client.get(f"/chalks/{mark['METADATA_ID']}", params=fields)
+    assert response.json() == expected
+
+    response = client.get("/chalks", params={"chalk_id": mark["CHALK_ID"], **fields})
+    assert response.json() == [expected]
+
+    response = client.post(
+        "/chalks/batch", params=fields, json={"metadata_ids": [mark["METADATA_ID"]]}
+    )
+    assert response.json()["chalks"] == {mark["METADATA_ID"]: expected}
+
+    response = client.get(
+        "/reports",
+        params={
+            "chalk_id": mark["CHALK_ID"],
+            "fields": "_OP_HOSTNAME,_CHALKS.0.COMMIT_ID,_CHALKS.1",
+        },
+    )
+    assert response.json() == [{"_OP_HOSTNAME": None, "_CHALKS.0.COMMIT_ID": None}]
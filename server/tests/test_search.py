@@ -0,0 +1,108 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import contextlib
+import secrets
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from server import search
+
+from .reports import chalk, report
+
+
+class Recorder:
+    """
+    stands in for a postgresql engine and session recording executed sql
+    """
+
+    dialect = SimpleNamespace(name="postgresql")
+
+    def __init__(self):
+        self.statements: list[tuple[str, dict]] = []
+
+    @contextlib.contextmanager
+    def begin(self):
+        yield self
+
+    def get_bind(self):
+        return self
+
+    def execute(self, statement, params=None):
+        self.statements.append((str(statement), params or {}))
+        return []
+
+
+def test_fts5_query():
+    assert search.fts5_query('chalk* "x" OR * a') == '"chalk"* """x""" "OR" "a"'
+    assert search.fts5_query(" * ") == ""
+
+
+def test_content():
+    raw = {
+        "_OP_ERRORS": ["failed", "failed", "timeout"],
+        "_OP_HOSTNAME": "host",
+        "_CHALKS": [{"PATH_WHEN_CHALKED": "/bin/app", "ARTIFACT_TYPE": None}],
+    }
+    assert search.content(raw) == "failed\ntimeout\n/bin/app"
+
+
+def test_fts5_index(client, db):
+    path = f"/opt/{secrets.token_hex(8)}/app"
+    mark = chalk(PATH_WHEN_CHALKED=path)
+    assert client.post("/report", json=[report([mark])]).status_code == 200
+
+    # reports are searchable by values of their chalks too
+    found = db.execute(
+        text("SELECT kind, ref FROM search_index WHERE search_index MATCH :q"),
+        {"q": search.fts5_query(path)},
+    ).all()
+    assert sorted(kind for kind, _ in found) == ["chalk", "report"]
+    assert ("chalk", mark["METADATA_ID"]) in found
+
+
+def test_tsvector_index():
+    engine = Recorder()
+    search.create(engine)  # type: ignore
+    search._available.discard(engine)  # type: ignore
+
+    create, index = (sql for sql, _ in engine.statements)
+    assert "document TSVECTOR GENERATED ALWAYS AS" in create
+    assert "to_tsvector('simple', content)" in create
+    assert "USING GIN (document)" in index
+
+    db = Recorder()
+    assert search.find(db, "chalk -docker", kind="chalk", limit=5, offset=0) == []  # type: ignore
+    ((sql, params),) = db.statements
+    assert "websearch_to_tsquery('simple', :q)" in sql
+    assert "ORDER BY rank DESC" in sql
+    assert params == {"q": "chalk -docker", "kind": "chalk", "limit": 5, "offset": 0}
+
+
+def test_search_ranking(client):
+    term = secrets.token_hex(8)
+    # more occurrences of the term in a shorter document rank higher
+    best = chalk(_OP_ERRORS=[f"{term} failed", f"{term} retried"])
+    worse = chalk(
+        _OP_ERRORS=[f"{term} failed"] + [secrets.token_hex(8) for _ in range(20)]
+    )
+    assert (
+        client.post("/report", json=[report([worse]), report([best])]).status_code
+        == 200
+    )
+
+    response = client.get("/search", params={"q": term, "kind": "chalk"})
+    assert response.status_code == 200
+    found = response.json()
+    assert [i["id"] for i in found] == [best["METADATA_ID"], worse["METADATA_ID"]]
+    assert found[0]["rank"] > found[1]["rank"]
+    assert found[0]["document"]["_OP_ERRORS"] == best["_OP_ERRORS"]
+
+    prefix = client.get("/search", params={"q": f"{term[:6]}* failed", "kind": "chalk"})
+    assert {i["id"] for i in prefix.json()} == {
+        best["METADATA_ID"],
+        worse["METADATA_ID"],
+    }
+    assert client.get("/search", params={"q": " * "}).status_code == 400
@@ -0,0 +1,262 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import asyncio
+import concurrent.futures
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session
+
+from server import search, shards
+from server.db import models
+from server.db.database import connect, migrate, sessions
+
+from .reports import chalk, report
+
+
+@pytest.fixture()
+def sharded(client, tmp_path: Path, monkeypatch) -> Iterator[list]:
+    urls = [f"sqlite:///{tmp_path / f'shard{i}.sqlite'}" for i in range(3)]
+    engines = [connect(i) for i in urls]
+    for engine in engines:
+        migrate(engine)
+        search.create(engine)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=4 * len(engines))
+    monkeypatch.setattr(shards, "DATABASE_SHARDS", urls)
+    monkeypatch.setattr(shards, "engines", engines)
+    monkeypatch.setattr(shards, "shards", [sessions(i) for i in engines])
+    monkeypatch.setattr(shards, "pool", pool)
+    yield engines
+    pool.shutdown()
+    for engine in engines:
+        engine.dispose()
+
+
+def metadata_ids(shard: int) -> list[str]:
+    with shards.shards[shard]() as db:
+        return [i for (i,) in db.query(models.Chalk.metadata_id)]
+
+
+def fail_commits(monkeypatch, engine: Engine):
+    commit = shards.commit
+
+    def fail(db: Session, stored):
+        if db.get_bind() is engine:
+            raise RuntimeError("disk full")
+        return commit(db, stored)
+
+    monkeypatch.setattr(shards, "commit", fail)
+
+
+def test_index(sharded):
+    keys = [f"key{i}" for i in range(100)]
+    indexes = [shards.index(i) for i in keys]
+    assert indexes == [shards.index(i) for i in keys]
+    assert set(indexes) == {0, 1, 2}
+
+
+def test_routing_key():
+    assert shards.routing_key(report([chalk(CHALK_ID="a"), chalk()])) == "a"
+    assert shards.routing_key(report([], _ACTION_ID="b")) == "b"
+    assert shards.routing_key(report([{}, chalk()], _ACTION_ID="b")) == "b"
+    assert shards.routing_key({"_CHALKS": "a", "_ACTION_ID": 1}) == ""
+
+
+def test_split(sharded):
+    reports = [report([chalk()]) for _ in range(20)]
+    groups = shards.split(reports)
+    assert sorted(r["_ACTION_ID"] for g in groups.values() for r in g) == sorted(
+        r["_ACTION_ID"] for r in reports
+    )
+    for shard, group in groups.items():
+        assert all(shards.index(shards.routing_key(r)) == shard for r in group)
+        # keeps order of the request
+        assert group == [r for r in reports if r in group]
+
+
+def test_store(sharded):
+    marks = [chalk() for _ in range(12)]
+    heartbeat = report([marks[0]], operation="heartbeat")
+    stored = shards.store([report([i]) for i in marks] + [heartbeat], 0)
+    assert len(stored) == len(shards.split([report([i]) for i in marks]))
+    for shard in range(len(sharded)):
+        assert sorted(metadata_ids(shard)) == sorted(
+            i["METADATA_ID"] for i in marks if shards.index(i["CHALK_ID"]) == shard
+        )
+    # heartbeat lands next to the report which created the chalkmark
+    action_id = models.Report.raw["_ACTION_ID"].as_string()
+    with shards.shards[shards.index(marks[0]["CHALK_ID"])]() as db:
+        assert (
+            db.query(models.Report).filter(action_id == heartbeat["_ACTION_ID"]).count()
+        )
+
+
+def test_store_invalid_stores_nothing(sharded):
+    reports = [report([chalk()]) for _ in range(12)]
+    reports.append(report([{"CHALK_ID": reports[0]["_CHALKS"][0]["CHALK_ID"]}]))
+    with pytest.raises(KeyError):
+        shards.store(reports, 0)
+    assert all(metadata_ids(i) == [] for i in range(len(sharded)))
+
+
+def test_store_partially(sharded, db, monkeypatch):
+    reports = [report([chalk()]) for _ in range(12)]
+    failing = shards.index(shards.routing_key(reports[0]))
+    fail_commits(monkeypatch, sharded[failing])
+    with pytest.raises(shards.PartiallyStored) as e:
+        shards.store(reports, 0)
+    assert str(e.value) == f"shard {failing}: disk full"
+    assert e.value.reports == [
+        n
+        for n, r in enumerate(reports)
+        if shards.index(shards.routing_key(r)) != failing
+    ]
+    assert len(e.value.stored) == len(shards.split(reports)) - 1
+    assert metadata_ids(failing) == []
+    assert sorted(i for s in range(len(sharded)) for i in metadata_ids(s)) == sorted(
+        reports[n]["_CHALKS"][0]["METADATA_ID"] for n in e.value.reports
+    )
+    # only chalkmarks of committed shards are recorded
+    recorded = [
+        db.get(models.ChalkShard, r["_CHALKS"][0]["METADATA_ID"]) is not None
+        for r in reports
+    ]
+    assert [n for n, i in enumerate(recorded) if i] == e.value.reports
+
+
+def test_rows(sharded, db):
+    marks = [chalk() for _ in range(12)]
+    shards.store([report([i]) for i in marks], 0)
+    ordered = sorted(i["METADATA_ID"] for i in marks)
+
+    def page(limit=None, offset=None, ordered=False) -> list[str]:
+        return [
+            i
+            for (i,) in shards.rows(
+                db,
+                lambda db: db.query(models.Chalk.metadata_id),
+                order_by=[models.Chalk.metadata_id],
+                key=lambda i: i[0],
+                limit=limit,
+                offset=offset,
+                ordered=ordered,
+            )
+        ]
+
+    assert sorted(page()) == ordered
+    assert page(ordered=True) == ordered
+    assert page(limit=5) == ordered[:5]
+    assert page(limit=5, offset=4) == ordered[4:9]
+    assert page(offset=10) == ordered[10:]
+    assert page(limit=5, offset=20) == []
+
+
+def test_api(sharded, client):
+    marks = [chalk() for _ in range(6)]
+    response = client.post("/report", json=[report([i]) for i in marks])
+    assert response.status_code == 200
+
+    ordered = sorted(i["METADATA_ID"] for i in marks)
+    response = client.get("/chalks", params={"limit": 3, "offset": 2})
+    assert [i["METADATA_ID"] for i in response.json()] == ordered[2:5]
+
+    # CHALK_IDs which are not first in their report are in other shards
+    mark = chalk()
+    first = chalk(CHALK_ID=marks[0]["CHALK_ID"])
+    response = client.post("/report", json=[report([first, mark])])
+    assert response.status_code == 200
+    response = client.post("/chalks/batch", json={"chalk_ids": [mark["CHALK_ID"]]})
+    assert response.json()["chalk_ids"] == {mark["CHALK_ID"]: [mark["METADATA_ID"]]}
+
+    assert client.get("/changes").status_code == 501
+
+
+def test_api_partially_stored(sharded, client, monkeypatch):
+    reports = [report([chalk()]) for _ in range(12)]
+    failing = shards.index(shards.routing_key(reports[0]))
+    fail_commits(monkeypatch, sharded[failing])
+    response = client.post("/report", json=reports)
+    assert response.status_code == 500
+    assert response.json()["detail"] == {
+        "error": "Partially stored",
+        "stored": [
+            n
+            for n, r in enumerate(reports)
+            if shards.index(shards.routing_key(r)) != failing
+        ],
+    }
+
+
+def queried(monkeypatch) -> list[int]:
+    """
+    shards which run queries
+    """
+    calls = []
+    run = shards.run
+
+    def spy(shard: int, fn):
+        calls.append(shard)
+        return run(shard, fn)
+
+    monkeypatch.setattr(shards, "run", spy)
+    return calls
+
+
+def test_store_records_shards(sharded, db):
+    reports = [report([chalk(), chalk()]) for _ in range(6)]
+    shards.store(reports, 0)
+    for r in reports:
+        for mark in r["_CHALKS"]:
+            home = db.get(models.ChalkShard, mark["METADATA_ID"])
+            assert home.shard == shards.index(shards.routing_key(r))
+
+
+def test_point_lookups(sharded, client, db, monkeypatch):
+    marks = [chalk() for _ in range(6)]
+    assert client.post("/report", json=[report([i]) for i in marks]).status_code == 200
+    calls = queried(monkeypatch)
+
+    mark = marks[0]
+    home = shards.index(mark["CHALK_ID"])
+    response = client.get(f"/chalks/{mark['METADATA_ID']}", params={"fields": "HASH"})
+    assert response.json() == {"HASH": mark["HASH"]}
+    assert calls == [home]
+
+    calls.clear()
+    ids = [i["METADATA_ID"] for i in marks[:3]]
+    response = client.post("/chalks/batch", json={"metadata_ids": ids})
+    assert sorted(response.json()["chalks"]) == sorted(ids)
+    assert sorted(calls) == sorted({shards.index(i["CHALK_ID"]) for i in marks[:3]})
+
+    # chalkmarks whose shard is not recorded are looked up everywhere
+    db.query(models.ChalkShard).filter(
+        models.ChalkShard.metadata_id == mark["METADATA_ID"]
+    ).delete()
+    db.commit()
+    calls.clear()
+    response = client.get(f"/chalks/{mark['METADATA_ID']}", params={"fields": "HASH"})
+    assert response.json() == {"HASH": mark["HASH"]}
+    assert sorted(calls) == list(range(len(sharded)))
+
+    shards.locate_all(home)
+    assert db.get(models.ChalkShard, mark["METADATA_ID"]).shard == home
+
+
+def test_api_stores_off_event_loop(sharded, client, monkeypatch):
+    store = shards.store
+    loops = []
+
+    def spy(reports, received_at):
+        try:
+            loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            loops.append(None)
+        return store(reports, received_at)
+
+    monkeypatch.setattr(shards, "store", spy)
+    assert client.post("/report", json=[report([chalk()])]).status_code == 200
+    assert loops == [None]
@@ -0,0 +1,134 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import secrets
+
+from server import stats
+from server.db import models, schemas
+
+
+def beacon(platform: str, timestamp: int, chalks: int = 1):
+    return {
+        "_OPERATION": "build",
+        "_TIMESTAMP": timestamp,
+        "_OP_CHALK_COUNT": chalks,
+        "_OP_CHALKER_COMMIT_ID": "abc",
+        "_OP_CHALKER_VERSION": "0.1.0",
+        "_OP_PLATFORM": platform,
+    }
+
+
+def test_ping_is_counted_not_stored(client, db):
+    platform = secrets.token_hex(8)
+    minute = 1700000000000 // stats.MINUTE * stats.MINUTE
+    stored = db.query(models.Stat).count()
+
+    pings = [beacon(platform, minute + 1, 2), beacon(platform, minute + 2, 3)]
+    assert client.post("/ping", json=pings).json() == {"ping": "pong"}
+    client.post("/ping", json=[beacon(platform, minute + stats.MINUTE)])
+
+    assert not stats.STATS_RAW
+    assert db.query(models.Stat).count() == stored
+
+    def summary():
+        response = client.get(
+            "/stats/summary", params={"group_by": "op_platform", "bucket": "minute"}
+        )
+        assert response.status_code == 200
+        return [i for i in response.json() if i["op_platform"] == platform]
+
+    # counts are only visible once flushed
+    assert summary() == []
+    stats.counters.flush()
+    assert summary() == [
+        {"op_platform": platform, "bucket": minute, "count": 2, "chalks": 5},
+        {
+            "op_platform": platform,
+            "bucket": minute + stats.MINUTE,
+            "count": 1,
+            "chalks": 1,
+        },
+    ]
+
+    # flushing again adds to existing counts
+    client.post("/ping", json=[beacon(platform, minute)])
+    stats.counters.flush()
+    assert summary()[0]["count"] == 3
+
+
+def summarize(client, platform: str, **params):
+    response = client.get("/stats/summary", params=params)
+    assert response.status_code == 200
+    return [i for i in response.json() if i.get("op_platform") == platform]
+
+
+def test_summary(client):
+    platform = secrets.token_hex(8)
+    hour = 1700000000000 // (60 * stats.MINUTE) * 60 * stats.MINUTE
+    pings = [
+        beacon(platform, hour, 1),
+        beacon(platform, hour + 30 * stats.MINUTE, 2),
+        {**beacon(platform, hour + 90 * stats.MINUTE, 4), "_OPERATION": "exec"},
+    ]
+    client.post("/ping", json=pings)
+    stats.counters.flush()
+
+    by_hour = {"group_by": "op_platform", "bucket": "hour"}
+    assert summarize(client, platform, **by_hour) == [
+        {"op_platform": platform, "bucket": hour, "count": 2, "chalks": 3},
+        {
+            "op_platform": platform,
+            "bucket": hour + 60 * stats.MINUTE,
+            "count": 1,
+            "chalks": 4,
+        },
+    ]
+    by_operation = [
+        {"op_platform": platform, "operation": "build", "count": 2, "chalks": 3},
+        {"op_platform": platform, "operation": "exec", "count": 1, "chalks": 4},
+    ]
+    assert summarize(client, platform, group_by="op_platform,operation") == by_operation
+    assert summarize(client, platform, group_by=["op_platform", "operation"]) == (
+        by_operation
+    )
+    assert summarize(
+        client,
+        platform,
+        group_by="op_platform",
+        since=hour + 30 * stats.MINUTE,
+        until=hour + 90 * stats.MINUTE,
+    ) == [{"op_platform": platform, "count": 1, "chalks": 2}]
+
+    # cached summaries are invalidated by the next flush
+    client.post("/ping", json=[beacon(platform, hour)])
+    assert summarize(client, platform, **by_hour)[0]["count"] == 2
+    stats.counters.flush()
+    assert summarize(client, platform, **by_hour)[0]["count"] == 3
+
+
+def test_summary_invalid(client):
+    response = client.get("/stats/summary", params={"group_by": "op_platform,raw"})
+    assert response.status_code == 400
+    assert client.get("/stats/summary", params={"bucket": "week"}).status_code == 400
+
+
+def test_backfill(client, db):
+    # stats stored before stat_counts was added
+    platform = secrets.token_hex(8)
+    minute = 1700000000000 // stats.MINUTE * stats.MINUTE
+    client.post("/ping", json=[beacon(secrets.token_hex(8), minute)])
+    stats.counters.flush()
+    for i in [beacon(platform, minute, 2), beacon(platform, minute + 1, 3)]:
+        db.add(models.Stat(**dict(schemas.Stat.model_validate(i))))
+    db.flush()
+
+    # nothing is backfilled once anything was counted
+    stats.backfill(db)
+    assert db.query(models.StatCount).filter_by(op_platform=platform).count() == 0
+
+    db.query(models.StatCount).delete()
+    stats.backfill(db)
+    (row,) = db.query(models.StatCount).filter_by(op_platform=platform)
+    assert (row.minute, row.count, row.chalks) == (minute, 2, 5)
+    db.rollback()
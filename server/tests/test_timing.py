@@ -0,0 +1,84 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from server.db import timing
+from server.db.database import connect
+
+
+@pytest.fixture()
+def slow(monkeypatch):
+    # every statement is slow
+    monkeypatch.setattr(timing, "SLOW_QUERY_MS", 0)
+    monkeypatch.setattr(timing, "SLOW_QUERY_EXPLAIN", True)
+    timing.reset()
+    yield
+    timing._plans.join()
+    timing.reset()
+
+
+def stats(statement: str) -> timing.StatementStats:
+    return next(i for i in timing.top(1000) if i.statement == statement)
+
+
+def test_normalize():
+    assert (
+        timing.normalize(
+            "SELECT *  FROM t\nWHERE x = 5 AND y IN (?, ?, ?) AND z = 'a''b'"
+        )
+        == "SELECT * FROM t WHERE x = ? AND y IN (?, ...) AND z = ?"
+    )
+
+
+def test_slow_query_is_explained_later(slow, tmp_path: Path):
+    engine = connect(f"sqlite:///{tmp_path / 'timing.sqlite'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE t (x INTEGER PRIMARY KEY, y TEXT)"))
+    with engine.connect() as conn:
+        conn.execute(text("INSERT INTO t VALUES (1, 'a')"))
+        for _ in range(3):
+            conn.execute(text("SELECT y FROM t WHERE x = 1"))
+        # explaining does not touch the transaction of the statement
+        assert conn.in_transaction()
+        conn.commit()
+    timing._plans.join()
+
+    select = stats("SELECT y FROM t WHERE x = ?")
+    assert select.count == 3
+    assert select.slow == 3
+    assert select.max_ms <= select.total_ms
+    assert any("USING INTEGER PRIMARY KEY" in i for i in select.plan)
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT y FROM t")).scalar() == "a"
+    engine.dispose()
+
+
+def test_single_connection_pools_are_not_explained(slow):
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    timing.install(engine)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE t (x INTEGER)"))
+        conn.execute(text("INSERT INTO t VALUES (1)"))
+        assert conn.execute(text("SELECT x FROM t")).scalar() == 1
+        assert conn.in_transaction()
+    assert timing._plans.empty()
+    assert stats("SELECT x FROM t").plan is None
+
+
+def test_slow_queries_endpoint(client, slow):
+    assert client.get("/chalks", params={"limit": 1}).status_code == 200
+    response = client.get("/admin/slow-queries", params={"limit": 1000})
+    assert response.status_code == 200
+    assert any("FROM chalks" in i["statement"] for i in response.json()["queries"])
+    assert client.delete("/admin/slow-queries").status_code == 200
+    assert client.get("/admin/slow-queries").json()["queries"] == []
@@ -0,0 +1,123 @@
+# Copyright (c) 2023, Crash Override, Inc.
+#
+# This file is part of Chalk
+# (see https://crashoverride.com/docs/chalk)
+import asyncio
+from pathlib import Path
+
+import sqlalchemy
+from fastapi import HTTPException
+
+from server import writer
+from server.db import models
+from server.db.database import SessionLocal
+
+from .reports import chalk, report
+
+
+def sessions(monkeypatch) -> list:
+    """
+    sessions opened by writer.commit, one per transaction
+    """
+    opened = []
+
+    def session():
+        opened.append(SessionLocal())
+        return opened[-1]
+
+    monkeypatch.setattr(writer, "SessionLocal", session)
+    return opened
+
+
+def stored(db, *reports: dict) -> list[bool]:
+    ids = [i["_ACTION_ID"] for i in reports]
+    found = {
+        i.raw["_ACTION_ID"]
+        for i in db.query(models.Report).filter(
+            models.Report.raw["_ACTION_ID"].as_string().in_(ids)
+        )
+    }
+    return [i in found for i in ids]
+
+
+def test_outcome():
+    duplicate = sqlalchemy.exc.IntegrityError("INSERT", {}, Exception("UNIQUE"))
+    assert writer.outcome(duplicate) == (202, None)
+    assert writer.outcome(KeyError("CHALK_ID")) == (400, "Chalk missing: 'CHALK_ID'")
+    assert writer.outcome(HTTPException(status_code=413, detail="big")) == (413, "big")
+    assert writer.outcome(ValueError("boom")) == (500, "Unhandled data")
+
+
+def test_commit_group(db, monkeypatch):
+    opened = sessions(monkeypatch)
+    requests = [([report([chalk()])], 1), ([report([chalk()]), report([])], 2)]
+    results = writer.commit(requests)
+    assert [response for response, _ in results] == [(200, None), (200, None)]
+    assert [i.received_at for _, i in results] == [1, 2]
+    assert len(opened) == 1
+    assert stored(db, *(r for reports, _ in requests for r in reports)) == [True] * 3
+
+
+def test_commit_falls_back_to_each_request(client, db, monkeypatch):
+    existing = chalk()
+    assert client.post("/report", json=[report([existing])]).status_code == 200
+    opened = sessions(monkeypatch)
+    first, duplicate, missing, last = (
+        report([chalk()]),
+        report([existing]),
+        report([{"CHALK_ID": "abc"}]),
+        report([chalk()]),
+    )
+    results = writer.commit([([i], 1) for i in (first, duplicate, missing, last)])
+    assert [response for response, _ in results] == [
+        (200, None),
+        (202, None),
+        (400, "Chalk missing: 'METADATA_HASH'"),
+        (200, None),
+    ]
+    assert [i is not None for _, i in results] == [True, False, False, True]
+    # rolled back group and a transaction per request
+    assert len(opened) == 5
+    assert stored(db, first, duplicate, missing, last) == [True, False, False, True]
+
+
+def test_group(monkeypatch):
+    monkeypatch.setattr(writer, "WRITER_BATCH", 3)
+
+    async def main():
+        w = writer.Writer()
+        for i in range(5):
+            w.queue.put_nowait((([], i), None))
+        return [[r[1] for r, _ in await w.group()] for _ in range(2)]
+
+    assert asyncio.run(main()) == [[0, 1, 2], [3, 4]]
+
+
+def test_submit(db, monkeypatch, tmp_path: Path):
+    path = tmp_path / "writer.sock"
+    monkeypatch.setattr(writer, "WRITER_SOCKET", str(path))
+    existing = chalk()
+    new = report([existing])
+
+    async def main():
+        w = writer.Writer()
+        server = await asyncio.start_unix_server(w.handle, path=str(path))
+        task = asyncio.create_task(w.commit_forever())
+        try:
+            return await asyncio.gather(
+                writer.submit([new], 1),
+                writer.submit([report([chalk()])], 1),
+                writer.submit([report([{"CHALK_ID": "abc"}])], 1),
+            )
+        finally:
+            task.cancel()
+            server.close()
+
+    assert asyncio.run(main()) == [
+        (200, None),
+        (200, None),
+        (400, "Chalk missing: 'METADATA_HASH'"),
+    ]
+    assert stored(db, new) == [True]
+    path.unlink()
+    assert asyncio.run(writer.submit([new], 1)) == (503, "Writer is unavailable")